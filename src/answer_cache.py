@@ -0,0 +1,259 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+
+def template_key(prompt_template: str) -> str:
+    """把 prompt 模板压缩成一个短哈希，作为缓存分区键。"""
+    return hashlib.sha1(prompt_template.encode("utf-8")).hexdigest()[:16]
+
+
+def normalize_vector(vector) -> np.ndarray:
+    """转换为 float32 并做 L2 归一化，归一化后点积即余弦相似度。"""
+    vec = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+
+class _Partition:
+    """
+    一个模板分区的向量矩阵：写入时追加一行（容量按倍数增长），删除时把该行置零，
+    空行超过一半时压缩；查找不需要每次重新堆叠整个分区。
+    """
+
+    def __init__(self, ids, vectors):
+        self.ids = list(ids)
+        self.size = len(self.ids)
+        self.matrix = np.stack(vectors) if vectors else None
+        self.positions = {entry_id: i for i, entry_id in enumerate(self.ids)}
+
+    def add(self, entry_id, vector):
+        if self.matrix is None:
+            self.matrix = np.zeros((16, len(vector)), dtype=np.float32)
+        elif self.size == len(self.matrix):
+            grown = np.zeros((2 * len(self.matrix), self.matrix.shape[1]), dtype=np.float32)
+            grown[:self.size] = self.matrix[:self.size]
+            self.matrix = grown
+        self.matrix[self.size] = vector
+        self.ids.append(entry_id)
+        self.positions[entry_id] = self.size
+        self.size += 1
+
+    def remove(self, entry_id):
+        position = self.positions.pop(entry_id, None)
+        if position is None:
+            return
+        # 置零的行与任何查询的相似度都是 0，不会达到命中阈值
+        self.matrix[position] = 0
+        self.ids[position] = None
+        if len(self.positions) * 2 < self.size:
+            live = [i for i, eid in enumerate(self.ids[:self.size]) if eid is not None]
+            self.matrix = self.matrix[live] if live else None
+            self.ids = [self.ids[i] for i in live]
+            self.size = len(live)
+            self.positions = {eid: i for i, eid in enumerate(self.ids)}
+
+    def view(self):
+        """返回 (ids, 矩阵)，ids 中已删除的位置为 None。"""
+        if not self.positions:
+            return [], None
+        return self.ids, self.matrix[:self.size]
+
+class SemanticAnswerCache:
+    """
+    基于问题向量相似度的答案缓存。
+    - 按 prompt 模板分区，同一模板内与已缓存问题的余弦相似度 >= threshold 即视为命中；
+    - 条目数量受 max_entries 限制（LRU 淘汰），并在 ttl_seconds 后过期；
+    - 指定 persist_path 时写入 SQLite 文件，重启后自动恢复（最新的 max_entries 条）。
+      文件中的条目只按 ttl_seconds 过期删除，容量淘汰只作用于内存：max_entries 不同的进程
+      （例如离线批处理和线上服务）共用同一个文件时，不会删掉对方写入的条目。
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 24 * 3600,
+                 similarity_threshold: float = 0.95, persist_path: str = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.persist_path = persist_path
+
+        self._lock = threading.Lock()
+        # key: entry_id, value: dict(template, vector, question, answer, created_at)
+        self._entries = OrderedDict()
+        # 每个模板分区的向量矩阵（_Partition），首次查找时构建，之后随写入和删除增量更新
+        self._matrices = {}
+        # 过期清理需要遍历全部条目，最多每隔这么多秒做一次；命中的条目另外单独检查是否过期
+        self._expire_interval = min(60.0, ttl_seconds / 10)
+        self._last_expire = 0.0
+        self._next_id = 1
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._best_scores = []
+
+        self._db = None
+        if persist_path:
+            self._open_db()
+            # SQLite 连接不能跨 fork 使用：pre-fork 部署时 worker 进程重新打开连接（内存中的条目保留）
+            if hasattr(os, "register_at_fork"):
+                ref = weakref.ref(self)
+                os.register_at_fork(after_in_child=lambda: ref() is not None and ref()._reconnect())
+
+    # --- 持久化 ---
+
+    def _open_db(self):
+        directory = os.path.dirname(self.persist_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.persist_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "id INTEGER PRIMARY KEY, template TEXT, question TEXT, answer TEXT, "
+            "vector BLOB, created_at REAL)"
+        )
+        self._db.commit()
+
+        now = time.time()
+        self._db.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl_seconds,))
+        self._db.commit()
+        rows = self._db.execute(
+            "SELECT id, template, question, answer, vector, created_at FROM answers ORDER BY id DESC LIMIT ?",
+            (self.max_entries,)
+        ).fetchall()
+        rows.reverse()
+        for entry_id, template, question, answer, blob, created_at in rows:
+            self._entries[entry_id] = {
+                "template": template,
+                "vector": np.frombuffer(blob, dtype=np.float32),
+                "question": question,
+                "answer": answer,
+                "created_at": created_at,
+            }
+        if rows:
+            print(f"已从 {self.persist_path} 恢复 {len(self._entries)} 条缓存答案。")
+
+    def _reconnect(self):
+        self._db = sqlite3.connect(self.persist_path, check_same_thread=False)
+
+    def _db_delete(self, entry_id):
+        if self._db is not None:
+            self._db.execute("DELETE FROM answers WHERE id = ?", (entry_id,))
+            self._db.commit()
+
+    # --- 查询与写入 ---
+
+    def lookup(self, template: str, question_vector):
+        """查找语义相近的已缓存答案，未命中返回 None。"""
+        query = normalize_vector(question_vector)
+        now = time.time()
+        with self._lock:
+            if now - self._last_expire >= self._expire_interval:
+                self._expire(now)
+            ids, matrix = self._matrix_for(template)
+            if not ids:
+                self._misses += 1
+                return None
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            best_score = float(scores[best])
+            self._best_scores.append(best_score)
+            if len(self._best_scores) > 1000:
+                del self._best_scores[:500]
+            if best_score < self.similarity_threshold:
+                self._misses += 1
+                return None
+            entry_id = ids[best]
+            if entry_id is None or now - self._entries[entry_id]["created_at"] > self.ttl_seconds:
+                if entry_id is not None:
+                    self._remove(entry_id)
+                    self._db_delete(entry_id)
+                self._misses += 1
+                return None
+            self._entries.move_to_end(entry_id)
+            self._hits += 1
+            return self._entries[entry_id]["answer"]
+
+    def put(self, template: str, question_vector, question: str, answer: str):
+        """写入一条答案，超出容量时淘汰最久未使用的条目。"""
+        if not answer:
+            return
+        vector = normalize_vector(question_vector)
+        now = time.time()
+        with self._lock:
+            if self._db is not None:
+                # 由 SQLite 分配 id：其他进程可能同时向同一个文件写入
+                cursor = self._db.execute(
+                    "INSERT INTO answers (template, question, answer, vector, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (template, question, answer, vector.tobytes(), now)
+                )
+                self._db.commit()
+                entry_id = cursor.lastrowid
+            else:
+                entry_id = self._next_id
+                self._next_id += 1
+            self._entries[entry_id] = {
+                "template": template,
+                "vector": vector,
+                "question": question,
+                "answer": answer,
+                "created_at": now,
+            }
+            partition = self._matrices.get(template)
+            if partition is not None:
+                partition.add(entry_id, vector)
+            while len(self._entries) > self.max_entries:
+                self._evict_oldest()
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        partition = self._matrices.get(entry["template"])
+        if partition is not None:
+            partition.remove(entry_id)
+
+    def _evict_oldest(self):
+        # 只从内存中淘汰，文件中的条目保留到过期（见类说明）
+        self._remove(next(iter(self._entries)))
+        self._evictions += 1
+
+    def _expire(self, now: float):
+        self._last_expire = now
+        expired = [eid for eid, e in self._entries.items() if now - e["created_at"] > self.ttl_seconds]
+        for entry_id in expired:
+            self._remove(entry_id)
+            self._db_delete(entry_id)
+
+    def _matrix_for(self, template: str):
+        partition = self._matrices.get(template)
+        if partition is None:
+            ids = [eid for eid, e in self._entries.items() if e["template"] == template]
+            partition = self._matrices[template] = _Partition(ids, [self._entries[eid]["vector"] for eid in ids])
+        return partition.view()
+
+    def stats(self) -> dict:
+        """返回命中率和最近一批查询的最高相似度分布，用于调整阈值。"""
+        with self._lock:
+            total = self._hits + self._misses
+            scores = sorted(self._best_scores)
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / total, 4) if total else 0.0,
+                "evictions": self._evictions,
+                "similarity_threshold": self.similarity_threshold,
+                "best_score_p50": round(scores[len(scores) // 2], 4) if scores else None,
+                "best_score_p90": round(scores[int(len(scores) * 0.9)], 4) if scores else None,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrices.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM answers")
+                self._db.commit()
@@ -1,10 +1,8 @@
 import os
 import os
 import sys
-import base64
 from prompt_toolkit import prompt
 from prompt_toolkit.completion import WordCompleter
-from langchain_core.messages import HumanMessage
 from langchain_core.runnables import RunnableConfig
 
 from dotenv import load_dotenv
@@ -12,7 +10,9 @@ from dotenv import load_dotenv
 # 将项目根目录添加到 sys.path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from src.rag_chain import create_rag_chain, get_deepseek_llm, get_zhipu_llm
+from src.rag_chain import create_rag_chain, get_deepseek_llm, get_multimodal_llm, TimedStream, DEFAULT_PROMPT_TEMPLATE
+from src.startup import startup_profile, start_background_warm_up
+from src.multimodal_pipeline import ImagePipeline
 
 def main_menu():
     """显示主菜单并获取用户选择。"""
@@ -32,6 +32,14 @@ def main_menu():
         else:
             print("无效输入，请重新选择。")
 
+def print_streaming_answer(rag_chain, query, config):
+    """流式调用 RAG 链并逐字打印回答，结束后显示首字延迟和总耗时。"""
+    stream = TimedStream(rag_chain, {"question": query}, config=config)
+    for chunk in stream:
+        print(chunk, end="", flush=True)
+    print(f"\n\n（{stream.summary()}）\n")
+    return stream.text
+
 def normal_qa_mode(rag_chain):
     """普通问答模式。"""
     print("\n--- 进入普通问答模式 ---")
@@ -44,8 +52,8 @@ def normal_qa_mode(rag_chain):
             if query.lower() == '返回':
                 break
             if query:
-                answer = rag_chain.invoke({"question": query}, config=config)
-                print(f"\nA: {answer}\n")
+                print("\nA: ", end="", flush=True)
+                print_streaming_answer(rag_chain, query, config)
         except (EOFError, KeyboardInterrupt):
             break
 
@@ -84,9 +92,9 @@ def role_play_mode(llm):
     【{char_name}】的回答:
     """
     
-    # 为这个特定角色创建一个专用的 RAG 链
+    # 为这个特定角色创建一个专用的 RAG 链（检索全文和角色档案中提到该角色的文档块）
     print(f"正在为【{char_name}】配置专属思维模块...")
-    role_rag_chain = create_rag_chain(llm, prompt_template=ROLE_PLAY_TEMPLATE)
+    role_rag_chain = create_rag_chain(llm, prompt_template=ROLE_PLAY_TEMPLATE, profile=f"role_play:{char_name}")
     if not role_rag_chain:
         print("角色模块配置失败，返回主菜单。")
         return
@@ -99,8 +107,8 @@ def role_play_mode(llm):
             if query.lower() == '返回':
                 break
             if query:
-                answer = role_rag_chain.invoke({"question": query}, config=config)
-                print(f"\n【{char_name}】: {answer}\n")
+                print(f"\n【{char_name}】: ", end="", flush=True)
+                print_streaming_answer(role_rag_chain, query, config)
         except (EOFError, KeyboardInterrupt):
             break
 
@@ -133,7 +141,8 @@ def decision_simulation_mode(llm):
     """
     
     print("正在配置战略分析模块...")
-    decision_rag_chain = create_rag_chain(llm, prompt_template=DECISION_TEMPLATE)
+    # 决策分析使用更多背景资料（更大的 k 和上下文预算）
+    decision_rag_chain = create_rag_chain(llm, prompt_template=DECISION_TEMPLATE, profile="decision")
     if not decision_rag_chain:
         print("战略分析模块配置失败，返回主菜单。")
         return
@@ -146,30 +155,43 @@ def decision_simulation_mode(llm):
             if query.lower() == '返回':
                 break
             if query:
-                answer = decision_rag_chain.invoke({"question": query}, config=config)
                 print("\n--- 战略分析报告 ---")
-                print(answer)
+                print_streaming_answer(decision_rag_chain, query, config)
                 print("---------------------\n")
         except (EOFError, KeyboardInterrupt):
             break
 
-def image_to_base64(image_path):
-    """将图片文件转换为 Base64 编码的字符串"""
-    try:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-    except Exception as e:
-        print(f"读取或编码图片时出错: {e}")
-        return None
+def image_question_prompt(image_description, retrieved_context, user_question):
+    """生成结合用户问题、图片描述和知识库内容的最终回答 prompt。"""
+    return f"""
+    你是一个知识渊博的《三体》专家。请结合以下所有信息，回答用户的问题。
+
+    ---
+    用户信息：
+    - 原始问题: {user_question}
+    - 提供的图片内容描述: {image_description}
+
+    ---
+    从《三体》知识库中检索到的相关背景知识：
+    {retrieved_context}
+    ---
+
+    请根据以上所有信息，给出一个全面、准确的回答。
+    """
+
+# 图片问答流水线，图片描述按内容哈希缓存，同一张图片再次提问时跳过描述阶段
+image_pipeline = ImagePipeline(image_question_prompt)
 
 def multi_modal_mode(text_rag_chain):
     """多模态（图片问答）模式。"""
     print("\n--- 进入图片问答模式 ---")
-    
-    # 1. 初始化多模态 LLM
+    if not text_rag_chain:
+        print("错误：文本知识库未初始化，无法进行检索。")
+        return
+
+    # 1. 初始化多模态 LLM（进程内只创建一次）
     print("正在初始化多模态识别核心 (ZhipuAI GLM-4V)...")
-    zhipu_llm = get_zhipu_llm(is_multimodal=True)
-    if not zhipu_llm:
+    if not get_multimodal_llm():
         print("多模态核心初始化失败，请检查 ZHIPUAI_API_KEY。")
         return
     print("多模态核心已就绪！")
@@ -185,71 +207,18 @@ def multi_modal_mode(text_rag_chain):
     except (EOFError, KeyboardInterrupt):
         return
 
-    # 3. 图片描述阶段
-    print("\n[步骤 1/3] 正在识别和描述图片内容...")
-    b64_image = image_to_base64(image_path)
-    if not b64_image:
-        return
-
-    desc_message = HumanMessage(
-        content=[
-            {"type": "text", "text": "你是一个专业的图像分析师。请详细、客观地描述这幅图像的内容，重点描述其主要物体、场景和风格。"},
-            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_image}"}},
-        ]
-    )
-    
+    # 3. 描述图片（同时按问题检索）-> 按描述检索知识库 -> 结合图文生成回答
+    print("\n正在识别图片、检索相关知识并生成回答...")
     try:
-        image_description = zhipu_llm.invoke([desc_message]).content
-        print(f"图片描述: {image_description}")
+        final_answer, image_description, _ = image_pipeline.run(image_path, user_question)
     except Exception as e:
-        print(f"调用多模态模型描述图片时出错: {e}")
+        print(f"图片问答流程出错: {e}")
         return
 
-    # 4. 文本检索阶段
-    print("\n[步骤 2/3] 正在基于图片描述检索相关知识...")
-    if not text_rag_chain:
-        print("错误：文本知识库未初始化，无法进行检索。")
-        return
-    
-    # 将图片描述和用户问题结合起来，进行更精准的检索
-    retrieval_query = f"关于“{image_description}”，{user_question}"
-    config = RunnableConfig(configurable={"session_id": "local_test_session_multimodal"})
-    retrieved_context = text_rag_chain.invoke({"question": retrieval_query}, config=config)
-    print("相关知识检索完成。")
-
-    # 5. 最终回答生成阶段
-    print("\n[步骤 3/3] 正在结合图文信息生成最终回答...")
-    final_prompt = f"""
-    你是一个知识渊博的《三体》专家。请结合以下所有信息，回答用户的问题。
-
-    ---
-    用户信息：
-    - 原始问题: {user_question}
-    - 提供的图片内容描述: {image_description}
-
-    ---
-    从《三体》知识库中检索到的相关背景知识：
-    {retrieved_context}
-    ---
-
-    请根据以上所有信息，给出一个全面、准确的回答。
-    """
-    
-    final_message = HumanMessage(
-        content=[
-            {"type": "text", "text": final_prompt},
-            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_image}"}},
-        ]
-    )
-
-    try:
-        final_answer = zhipu_llm.invoke([final_message]).content
-        print("\n--- 最终回答 ---")
-        print(final_answer)
-        print("------------------\n")
-    except Exception as e:
-        print(f"生成最终回答时出错: {e}")
-        return
+    print(f"图片描述: {image_description}")
+    print("\n--- 最终回答 ---")
+    print(final_answer)
+    print("------------------\n")
 
 def run_app():
     """运行主应用程序。"""
@@ -263,20 +232,23 @@ def run_app():
     else:
         print("文本处理核心已就绪！")
 
-    # 为普通问答模式预先构建一个基础 RAG 链
-    base_rag_chain = None
+    # 在后台加载知识库并构建基础 RAG 链，菜单立即可用
     if deepseek_llm:
-        print("正在构建基础知识库...")
-        base_rag_chain = create_rag_chain(deepseek_llm)
-        if base_rag_chain:
-            print("基础知识库构建完成！")
-        else:
-            print("基础知识库构建失败。")
+        print("正在后台构建基础知识库，可以先选择功能模式...")
+        start_background_warm_up(deepseek_llm, [DEFAULT_PROMPT_TEMPLATE], report=False)
 
+    def get_base_rag_chain():
+        """获取基础 RAG 链；后台仍在加载时等待加载完成（链和共享资源只会加载一次）。"""
+        if not deepseek_llm:
+            return None
+        if not startup_profile.ready.is_set():
+            print("基础知识库仍在加载，请稍候...")
+        return create_rag_chain(deepseek_llm, profile="qa")
 
     while True:
         choice = main_menu()
         if choice == '1':
+            base_rag_chain = get_base_rag_chain()
             if base_rag_chain:
                 normal_qa_mode(base_rag_chain)
             else:
@@ -287,7 +259,7 @@ def run_app():
             decision_simulation_mode(deepseek_llm)
         elif choice == '4':
             # 图片问答模式需要基础的文本 RAG 链来进行上下文检索
-            multi_modal_mode(base_rag_chain)
+            multi_modal_mode(get_base_rag_chain())
         elif choice == '0':
             print("感谢使用，再见！")
             break
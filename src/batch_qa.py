@@ -0,0 +1,265 @@
+"""
+离线批量问答：从 JSONL 或 CSV 读取问题，经与线上相同的 RAG 链（create_rag_chain）生成回答，逐条写入 JSONL。
+用于预先回答常见问题（FAQ）或批量评估。
+
+- 问题按批（--batch-size）处理：一批问题的向量一次性计算（缓存未命中的部分合成一次模型调用），
+  检索在线程池中并行执行，结果直接交给链，链中不再重复计算；
+- LLM 调用在 --concurrency 个线程中执行，同时在途的请求数不超过并发数的两倍，内存占用与问题总数无关；
+- 每个回答生成后立即追加写入输出文件并刷新，任务中断后用同样的命令重新运行，已成功的问题会被跳过
+  （失败的问题会重试；同一个 id 出现多行时以最后一行为准）；
+- 每隔 --report-every 秒打印进度、吞吐量和预计剩余时间，结束时打印延迟分位数和缓存命中情况；
+- 链生成的回答同时写入语义答案缓存：用 --answer-cache-path 指定与线上服务相同的 ANSWER_CACHE_PATH，
+  线上遇到相同或相近的问题时直接返回；也可以用 --seed-only 把已有的输出文件导入答案缓存，不调用 LLM。
+  缓存条目的有效期由 ANSWER_CACHE_TTL 决定（默认 24 小时），预先回答的 FAQ 需要线上服务和批处理都调大这个值。
+  相近的问题会命中缓存中另一个问题的回答，输出中 cached 字段标记回答是否来自缓存；
+  --no-cache-lookup 不查缓存，每个问题都由链生成（生成的回答仍写入缓存），适合批量评估。
+
+输入格式：
+    JSONL 每行一个对象：{"id": "faq-1", "question": "黑暗森林法则是什么？"}（id 可省略，默认为行号）
+    CSV 带表头，问题列名为 question（或用 --question-field 指定），可选 id 列
+
+示例：
+    python src/batch_qa.py faq.jsonl --output faq_answers.jsonl --concurrency 8 --answer-cache-path runtime/answers.sqlite3
+    python src/batch_qa.py eval.csv --output eval_answers.jsonl --mode decision
+    python src/batch_qa.py faq.jsonl --output faq_answers.jsonl --seed-only --answer-cache-path runtime/answers.sqlite3
+"""
+import os
+import sys
+# 将项目根目录添加到 sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import csv
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from langchain_core.runnables import RunnableConfig
+
+def _percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+# --- 输入与输出 ---
+
+def load_questions(path: str, question_field: str = "question", id_field: str = "id") -> list:
+    """读取 JSONL 或 CSV（按扩展名判断），返回 [{"id", "question"}]，跳过空问题。"""
+    items = []
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for line_no, row in enumerate(rows, 1):
+            question = (row.get(question_field) or "").strip()
+            if not question:
+                continue
+            item_id = row.get(id_field)
+            items.append({"id": str(item_id) if item_id not in (None, "") else str(line_no), "question": question})
+    ids = [item["id"] for item in items]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"{path} 中存在重复的 id，无法断点续跑。")
+    return items
+
+def load_results(path: str) -> dict:
+    """读取已有的输出文件，返回 {id: 最后一行记录}；最后一行可能因中断而不完整，忽略即可。"""
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            results[str(record.get("id"))] = record
+    return results
+
+# --- 批处理 ---
+
+class Progress:
+    """按时间间隔打印完成数、吞吐量和预计剩余时间。"""
+
+    def __init__(self, total: int, report_every: float):
+        self.total = total
+        self.report_every = report_every
+        self.start = time.perf_counter()
+        self._last_report = self.start
+        self.done = 0
+        self.errors = 0
+        self.cached = 0
+        self.latencies = []
+
+    def add(self, seconds: float, error: bool, cached: bool = False):
+        self.done += 1
+        self.errors += error
+        self.cached += cached
+        if not error:
+            self.latencies.append(seconds)
+        now = time.perf_counter()
+        if now - self._last_report >= self.report_every or self.done == self.total:
+            self._last_report = now
+            print(self.line())
+
+    def line(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else 0.0
+        return (f"[进度] {self.done}/{self.total}（{self.done / max(self.total, 1):.1%}），失败 {self.errors}，"
+                f"{rate:.2f} 个/s，已用 {elapsed:.0f}s，预计剩余 {eta:.0f}s")
+
+def _prepare_batch(batch, profile, embeddings, retrieval_pool):
+    """一批问题：批量计算问题向量，并行检索，返回每个问题的 (向量, 文档块)。"""
+    from src.rag_chain import get_reranker, search_documents
+
+    questions = [item["question"] for item in batch]
+    vectors = embeddings.embed_queries(questions)
+    reranker = get_reranker()
+    docs = list(retrieval_pool.map(
+        lambda qv: search_documents(profile, qv[0], qv[1], reranker=reranker), zip(questions, vectors)
+    ))
+    return list(zip(vectors, docs))
+
+def _answer(chain, item, vector, docs, mode: str, answer_cache=None, partition: str = None) -> dict:
+    """
+    回答一个问题。answer_cache 不为 None 时先查语义答案缓存，命中的回答标记 cached；
+    缓存查找在这里完成，链中不再查找（生成的回答仍由链写入缓存）。
+    """
+    from src.history import get_session_history
+
+    # 每个问题使用独立的会话，回答后立即清空，避免历史串题和内存增长
+    session_id = f"batch:{item['id']}"
+    start = time.perf_counter()
+    record = {"id": item["id"], "question": item["question"], "mode": mode}
+    try:
+        answer = answer_cache.lookup(partition, vector) if answer_cache is not None else None
+        record["cached"] = answer is not None
+        if answer is None:
+            answer = chain.invoke(
+                {"question": item["question"], "question_vector": vector, "docs": docs, "skip_cache_lookup": True},
+                config=RunnableConfig(configurable={"session_id": session_id}),
+            )
+        record["answer"] = answer
+        record["chapters"] = [doc.metadata.get("chapter") for doc in docs]
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        get_session_history(session_id).clear()
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+def run_batch(args):
+    from src.rag_chain import (answer_cache_partition, create_rag_chain, get_answer_cache, get_deepseek_llm,
+                               get_embeddings, llm_stats)
+    from src.wechat_modes import DECISION_TEMPLATE, PROMPT_TEMPLATE
+
+    template, profile = (DECISION_TEMPLATE, "decision") if args.mode == "decision" else (PROMPT_TEMPLATE, "qa")
+    items = load_questions(args.input, args.question_field, args.id_field)
+    finished = {item_id for item_id, record in load_results(args.output).items() if "answer" in record}
+    pending = [item for item in items if item["id"] not in finished]
+    print(f"共 {len(items)} 个问题，已完成 {len(items) - len(pending)} 个，", end="")
+    if args.limit:
+        pending = pending[:args.limit]
+    print(f"本次处理 {len(pending)} 个。")
+    if not pending:
+        return
+
+    llm = get_deepseek_llm()
+    if llm is None:
+        raise RuntimeError("LLM 初始化失败，请检查 API Key。")
+    chain = create_rag_chain(llm, prompt_template=template, profile=profile)
+    if chain is None:
+        raise RuntimeError("无法创建 RAG 链，请检查向量数据库。")
+    embeddings = get_embeddings()
+    answer_cache = None if args.no_cache_lookup else get_answer_cache()
+    partition = answer_cache_partition(template, profile)
+
+    progress = Progress(len(pending), args.report_every)
+    max_in_flight = args.concurrency * 2
+    in_flight = set()
+    with open(args.output, "a", encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="batch-llm") as llm_pool, \
+            ThreadPoolExecutor(max_workers=args.retrieval_threads, thread_name_prefix="batch-search") as retrieval_pool:
+
+        def drain(block_until: int):
+            nonlocal in_flight
+            while len(in_flight) > block_until:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record = future.result()
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    out.flush()
+                    progress.add(record["seconds"], "error" in record, record.get("cached", False))
+
+        for start in range(0, len(pending), args.batch_size):
+            batch = pending[start:start + args.batch_size]
+            prepared = _prepare_batch(batch, profile, embeddings, retrieval_pool)
+            for item, (vector, docs) in zip(batch, prepared):
+                # 在途请求达到上限时先等待已完成的回答写出
+                drain(max_in_flight - 1)
+                in_flight.add(llm_pool.submit(_answer, chain, item, vector, docs, args.mode, answer_cache, partition))
+        drain(0)
+
+    elapsed = time.perf_counter() - progress.start
+    latencies = progress.latencies
+    print(f"\n===== 批量问答完成：{progress.done} 个问题，失败 {progress.errors}，用时 {elapsed:.1f}s，"
+          f"{progress.done / elapsed:.2f} 个/s =====")
+    print(f"单个问题耗时 p50 {_percentile(latencies, 0.5):.2f}s，p95 {_percentile(latencies, 0.95):.2f}s，"
+          f"p99 {_percentile(latencies, 0.99):.2f}s")
+    answer_cache = get_answer_cache()
+    print(f"语义答案缓存: {answer_cache.stats() if answer_cache else '未启用'}，"
+          f"本次 {progress.cached} 个回答来自缓存{'（已关闭查找）' if args.no_cache_lookup else ''}")
+    print(f"LLM: {llm_stats()}")
+    if progress.errors:
+        print(f"有 {progress.errors} 个问题失败，重新运行同样的命令即可只重试这些问题。")
+
+def seed_answer_cache(args):
+    """把已有输出文件中的回答写入语义答案缓存（与线上链使用同一个分区），不调用 LLM。"""
+    from src.rag_chain import answer_cache_partition, get_answer_cache, get_embeddings
+    from src.wechat_modes import DECISION_TEMPLATE, PROMPT_TEMPLATE
+
+    answer_cache = get_answer_cache()
+    if answer_cache is None:
+        raise RuntimeError("语义答案缓存未启用（ANSWER_CACHE_SIZE=0）。")
+    records = [r for r in load_results(args.output).values() if r.get("answer") and r.get("mode", args.mode) == args.mode]
+    template, profile = (DECISION_TEMPLATE, "decision") if args.mode == "decision" else (PROMPT_TEMPLATE, "qa")
+    partition = answer_cache_partition(template, profile)
+    embeddings = get_embeddings()
+    start = time.perf_counter()
+    for i in range(0, len(records), args.batch_size):
+        batch = records[i:i + args.batch_size]
+        vectors = embeddings.embed_queries([r["question"] for r in batch])
+        for record, vector in zip(batch, vectors):
+            answer_cache.put(partition, vector, record["question"], record["answer"])
+    print(f"已把 {len(records)} 个回答写入语义答案缓存（{time.perf_counter() - start:.1f}s），"
+          f"当前共 {answer_cache.stats()['entries']} 条。")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="离线批量问答（可断点续跑，结果可写入语义答案缓存）")
+    parser.add_argument("input", help="问题文件（.jsonl 或 .csv）")
+    parser.add_argument("--output", required=True, help="输出 JSONL，已存在时追加并跳过已完成的问题")
+    parser.add_argument("--mode", choices=["qa", "decision"], default="qa", help="使用的 prompt 模板和检索配置")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时进行的 LLM 调用数")
+    parser.add_argument("--batch-size", type=int, default=32, help="每批计算向量和检索的问题数")
+    parser.add_argument("--retrieval-threads", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=0, help="本次最多处理的问题数（0 表示全部）")
+    parser.add_argument("--report-every", type=float, default=10.0, help="打印进度的间隔（秒）")
+    parser.add_argument("--question-field", default="question")
+    parser.add_argument("--id-field", default="id")
+    parser.add_argument("--answer-cache-path", default=None,
+                        help="语义答案缓存的 SQLite 文件（覆盖 ANSWER_CACHE_PATH），线上服务使用同一文件即可复用回答")
+    parser.add_argument("--seed-only", action="store_true", help="只把 --output 中已有的回答写入答案缓存")
+    parser.add_argument("--no-cache-lookup", action="store_true",
+                        help="不查语义答案缓存，每个问题都调用 LLM 生成（回答仍写入缓存）")
+    args = parser.parse_args()
+
+    # 环境变量必须在导入 rag_chain 之前设置
+    os.environ.setdefault("HISTORY_BACKEND", "memory")
+    if args.answer_cache_path:
+        os.environ["ANSWER_CACHE_PATH"] = args.answer_cache_path
+        # 批量写入的回答不应被容量上限淘汰（只影响本进程内存中的条目，文件中的条目只按有效期删除）
+        os.environ["ANSWER_CACHE_SIZE"] = str(max(int(os.getenv("ANSWER_CACHE_SIZE", "1000")), 100000))
+    if args.seed_only:
+        seed_answer_cache(args)
+    else:
+        run_batch(args)
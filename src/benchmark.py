@@ -0,0 +1,437 @@
+"""
+离线基准测试：不需要网络和 API Key，把一份 JSONL 请求日志回放到
+- wechat：微信后端的 process_request_in_background（真实的线程、链、流式分段和客服消息投递），
+- chain：直接调用 create_rag_chain 得到的 RAG 链，
+LLM 换成延迟可配置、输出固定的本地假模型，客服消息发到本地桩服务（src/stub_servers.py）。
+
+报告吞吐量、各阶段（embed / search / prompt / llm / delivery / total）的 p50/p95/p99 和进程峰值 RSS，
+可以保存为 JSON，并与上一次的结果比较，p95 变慢超过阈值时以非零状态退出。
+
+请求日志每行一个 JSON 对象，字段与微信表单一致：
+    {"from_user": "u1", "content": "黑暗森林法则是什么？", "type": "text", "at": 0.5}
+（也接受 user_id / question 作为字段名；at 为可选的相对发送时间，配合 --speed 使用）
+不提供 --log 时按内置问题生成 --requests 条请求。
+
+示例：
+    python src/benchmark.py --target wechat --synthetic-corpus "data/三体 (刘慈欣) (Z-Library).txt"
+    python src/benchmark.py --target chain --index-path vector_store/faiss_index_three_body_full --embeddings model
+    python src/benchmark.py --log replay.jsonl --output bench.json --baseline last_bench.json
+"""
+import os
+import sys
+# 将项目根目录添加到 sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import asyncio
+import atexit
+import contextvars
+import json
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from src.load_test import QUESTIONS, percentile
+from src.stub_servers import DEFAULT_ANSWER, StubCustomerServiceServer, start_site
+
+STAGES = ("embed", "search", "prompt", "llm", "delivery", "total")
+
+# --- 分阶段计时 ---
+
+# 当前请求的计时记录；LangChain 在线程池中执行子步骤时会复制 contextvars，记录对象本身是共享的
+_current_request = contextvars.ContextVar("benchmark_request", default=None)
+
+def _add_stage(stage: str, seconds: float):
+    record = _current_request.get()
+    if record is not None:
+        record[stage] += seconds
+
+def _mark(name: str):
+    record = _current_request.get()
+    if record is not None:
+        record[name] = time.perf_counter()
+
+class StageStats:
+    """汇总每个请求各阶段的耗时（同一请求内多次调用的耗时相加）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.requests = 0
+        self.errors = 0
+
+    def run(self, fn, *args):
+        record = defaultdict(float)
+        token = _current_request.set(record)
+        start = time.perf_counter()
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"回放请求出错: {e}")
+            with self._lock:
+                self.errors += 1
+        finally:
+            record["total"] = time.perf_counter() - start
+            _current_request.reset(token)
+        with self._lock:
+            self.requests += 1
+            for stage in STAGES:
+                if stage in record:
+                    self.samples[stage].append(record[stage])
+
+    def summary(self) -> dict:
+        with self._lock:
+            result = {}
+            for stage in STAGES:
+                values = self.samples.get(stage, [])
+                result[stage] = {
+                    "count": len(values),
+                    "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+                    "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+                    "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+                }
+            return result
+
+class TimedEmbeddings(Embeddings):
+    """记录问题向量计算耗时（embed 阶段）的 Embedding 包装器。"""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        start = time.perf_counter()
+        try:
+            return self.embeddings.embed_query(text)
+        finally:
+            _add_stage("embed", time.perf_counter() - start)
+
+    async def aembed_query(self, text):
+        start = time.perf_counter()
+        try:
+            return await self.embeddings.aembed_query(text)
+        finally:
+            _add_stage("embed", time.perf_counter() - start)
+
+def timed_search(search_documents):
+    """包装 rag_chain.search_documents，记录 search 阶段耗时和检索结束的时间点。"""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return search_documents(*args, **kwargs)
+        finally:
+            _add_stage("search", time.perf_counter() - start)
+            _mark("search_end")
+    return wrapper
+
+def timed_delivery(send):
+    """包装客服消息投递函数，记录 delivery 阶段耗时。"""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return send(*args, **kwargs)
+        finally:
+            _add_stage("delivery", time.perf_counter() - start)
+    return wrapper
+
+# --- 假 LLM ---
+
+class FakeStreamingChatModel(BaseChatModel):
+    """
+    输出固定回答的本地聊天模型：first_token_delay 秒后开始输出，之后每 chunk_chars 个字符间隔 token_delay 秒。
+    被调用时把“检索结束到 LLM 开始”的时间记为 prompt 阶段（上下文组装 + 模板渲染）。
+    """
+
+    answer: str = DEFAULT_ANSWER
+    first_token_delay: float = 0.5
+    token_delay: float = 0.01
+    chunk_chars: int = 4
+
+    @property
+    def _llm_type(self) -> str:
+        return "benchmark-fake-chat"
+
+    def _pieces(self):
+        return [self.answer[i:i + self.chunk_chars] for i in range(0, len(self.answer), self.chunk_chars)]
+
+    def _start(self) -> float:
+        now = time.perf_counter()
+        record = _current_request.get()
+        if record is not None and "search_end" in record:
+            record["prompt"] += now - record.pop("search_end")
+        return now
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        start = self._start()
+        time.sleep(self.first_token_delay + self.token_delay * len(self._pieces()))
+        _add_stage("llm", time.perf_counter() - start)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        start = self._start()
+        time.sleep(self.first_token_delay)
+        for piece in self._pieces():
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+            time.sleep(self.token_delay)
+        _add_stage("llm", time.perf_counter() - start)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        start = self._start()
+        await asyncio.sleep(self.first_token_delay + self.token_delay * len(self._pieces()))
+        _add_stage("llm", time.perf_counter() - start)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        start = self._start()
+        await asyncio.sleep(self.first_token_delay)
+        for piece in self._pieces():
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                await run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+            await asyncio.sleep(self.token_delay)
+        _add_stage("llm", time.perf_counter() - start)
+
+# --- 请求日志 ---
+
+def load_replay_log(path: str) -> list:
+    """读取 JSONL 请求日志，返回 [{"from_user", "content", "type", "at"}, ...]。"""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            content = item.get("content", item.get("question"))
+            if content is None:
+                print(f"跳过第 {line_no} 行：缺少 content 字段。")
+                continue
+            records.append({
+                "from_user": str(item.get("from_user", item.get("user_id", f"replay-user-{line_no}"))),
+                "content": content,
+                "type": item.get("type", "text"),
+                "at": item.get("at"),
+            })
+    return records
+
+def synthetic_log(requests: int, users: int) -> list:
+    return [
+        {"from_user": f"bench-user-{i % users}", "content": QUESTIONS[i % len(QUESTIONS)], "type": "text", "at": None}
+        for i in range(requests)
+    ]
+
+def build_synthetic_index(corpus_path: str, dim: int, embeddings) -> str:
+    """用假 Embedding 为语料建一个临时索引（含倒排索引和元数据过滤索引），检索结果没有语义，但索引规模与真实语料一致。"""
+    from langchain_community.vectorstores import FAISS
+    from src.chunk_store import save_vector_store
+    from src.lexical_index import build_lexical_index
+    from src.load_and_split import DEFAULT_CHARACTERS, iter_split_documents
+    from src.metadata_index import build_metadata_index
+
+    index_path = tempfile.mkdtemp(prefix="rag-bench-index-")
+    atexit.register(shutil.rmtree, index_path, True)
+    docs = list(iter_split_documents(corpus_path, characters=DEFAULT_CHARACTERS))
+    vector_store = FAISS.from_documents(docs, embeddings)
+    save_vector_store(vector_store, index_path)
+    build_lexical_index(vector_store, index_path)
+    build_metadata_index(vector_store, index_path)
+    print(f"已为 {corpus_path} 构建临时索引：{len(docs)} 个文档块，{dim} 维，{index_path}")
+    return index_path
+
+def index_dimension(index_path: str) -> int:
+    import faiss
+    from src.chunk_store import vector_index_path
+    return faiss.read_index(vector_index_path(index_path), faiss.IO_FLAG_MMAP).d
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def start_cs_stub(port: int, delay: float) -> StubCustomerServiceServer:
+    """在后台线程的事件循环中启动桩客服消息服务。"""
+    stub = StubCustomerServiceServer(delay=delay)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(start_site(stub.app, "127.0.0.1", port))
+    threading.Thread(target=loop.run_forever, name="cs-stub", daemon=True).start()
+    return stub
+
+# --- 回放 ---
+
+def replay(records, handle, stats: StageStats, concurrency: int, speed: float):
+    """
+    按用户分组回放：同一用户的请求按顺序处理（与后端的按用户串行一致），不同用户最多 concurrency 个并行。
+    speed > 0 时按日志中的 at 字段（除以 speed）控制发送时间，否则尽快发送。
+    """
+    by_user = defaultdict(list)
+    for record in records:
+        by_user[record["from_user"]].append(record)
+    start = time.perf_counter()
+
+    def run_user(user_records):
+        for record in user_records:
+            if speed > 0 and record["at"] is not None:
+                delay = start + record["at"] / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            stats.run(handle, record)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="replay") as executor:
+        list(executor.map(run_user, by_user.values()))
+    return time.perf_counter() - start
+
+def run_benchmark(args) -> dict:
+    # 环境变量必须在导入 rag_chain / wechat_app 之前设置
+    os.environ.setdefault("HISTORY_BACKEND", "memory")
+    os.environ["WECHAT_CUSTOMER_SERVICE_URL"] = f"http://127.0.0.1:{args.cs_port}/send_custom_message"
+    os.environ["WECHAT_OUTBOX_PATH"] = ""
+    if not args.answer_cache:
+        os.environ["ANSWER_CACHE_SIZE"] = "0"
+        os.environ["LLM_MEMO_SIZE"] = "0"
+
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from src.chunk_store import vector_index_path
+    from src.embedding_service import EmbeddingService
+
+    index_path = args.index_path
+    if args.synthetic_corpus:
+        index_path = build_synthetic_index(args.synthetic_corpus, args.fake_dim,
+                                           DeterministicFakeEmbedding(size=args.fake_dim))
+    elif not os.path.exists(vector_index_path(index_path)):
+        raise SystemExit(f"{index_path} 下没有 FAISS 索引，请先构建索引或使用 --synthetic-corpus。")
+    os.environ["RAG_VECTOR_STORE_PATH"] = index_path
+
+    import src.rag_chain as rag_chain
+    from src.wechat_modes import resolve_text_request
+
+    load_start = time.perf_counter()
+    if args.embeddings == "fake":
+        rag_chain._embeddings = EmbeddingService(DeterministicFakeEmbedding(size=index_dimension(index_path)))
+    embedding_service = rag_chain.get_embeddings()
+    rag_chain._embeddings = TimedEmbeddings(embedding_service)
+    rag_chain.search_documents = timed_search(rag_chain.search_documents)
+
+    llm = FakeStreamingChatModel(first_token_delay=args.first_token_delay, token_delay=args.token_delay)
+    cs_stub = start_cs_stub(args.cs_port, args.cs_delay)
+
+    if args.target == "wechat":
+        rag_chain.get_deepseek_llm = lambda: llm
+        import src.wechat_app as wechat_app
+        wechat_app.delivery_client.send = timed_delivery(wechat_app.delivery_client.send)
+
+        def handle(record):
+            wechat_app.process_request_in_background(record["from_user"], record["content"], record["type"])
+    else:
+        from langchain_core.runnables import RunnableConfig
+
+        def handle(record):
+            if record["type"] != "text":
+                return
+            reply, prompt_template, question, profile = resolve_text_request(record["from_user"], record["content"])
+            if reply is not None:
+                return
+            chain = rag_chain.create_rag_chain(llm, prompt_template=prompt_template, profile=profile)
+            config = RunnableConfig(configurable={"session_id": record["from_user"]})
+            for _ in chain.stream({"question": question}, config=config):
+                pass
+
+        # 预先编译默认链并加载索引，不计入回放耗时
+        rag_chain.create_rag_chain(llm)
+    rag_chain.get_vector_store()
+    rag_chain.get_lexical_index()
+    load_seconds = time.perf_counter() - load_start
+    rss_after_load = peak_rss_mb()
+
+    records = load_replay_log(args.log) if args.log else synthetic_log(args.requests, args.users)
+    stats = StageStats()
+    print(f"开始回放 {len(records)} 条请求（目标 {args.target}，并发 {args.concurrency}）...")
+    elapsed = replay(records, handle, stats, args.concurrency, args.speed)
+
+    return {
+        "target": args.target,
+        "requests": stats.requests,
+        "errors": stats.errors,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(stats.requests / elapsed, 2) if elapsed else 0.0,
+        "load_seconds": round(load_seconds, 3),
+        "peak_rss_after_load_mb": round(rss_after_load, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "cs_messages": len(cs_stub.messages),
+        "stages": stats.summary(),
+        "embeddings": embedding_service.stats() if isinstance(embedding_service, EmbeddingService) else None,
+        "prompt": rag_chain.prompt_stats(),
+    }
+
+def print_report(report: dict):
+    print("\n===== 离线基准测试报告 =====")
+    print(f"目标 {report['target']}：{report['requests']} 条请求（出错 {report['errors']}），"
+          f"用时 {report['seconds']:.2f}s，吞吐 {report['throughput_rps']} 请求/秒")
+    print(f"加载耗时 {report['load_seconds']:.2f}s，加载后峰值 RSS {report['peak_rss_after_load_mb']} MB，"
+          f"回放后峰值 RSS {report['peak_rss_mb']} MB，桩客服服务收到 {report['cs_messages']} 条消息")
+    print(f"{'阶段':<10}{'次数':>8}{'p50(ms)':>12}{'p95(ms)':>12}{'p99(ms)':>12}")
+    for stage, values in report["stages"].items():
+        print(f"{stage:<10}{values['count']:>8}{values['p50_ms']:>12.2f}{values['p95_ms']:>12.2f}{values['p99_ms']:>12.2f}")
+
+def compare_with_baseline(report: dict, baseline: dict, max_regression: float, min_ms: float = 1.0) -> list:
+    """返回 p95 比基线慢超过 max_regression（比例）的阶段；基线中低于 min_ms 的阶段只看绝对值是否超过 min_ms。"""
+    regressions = []
+    for stage, values in report["stages"].items():
+        old = baseline.get("stages", {}).get(stage)
+        if not old or not old["count"] or not values["count"]:
+            continue
+        limit = max(old["p95_ms"] * (1 + max_regression), min_ms)
+        if values["p95_ms"] > limit:
+            regressions.append(f"{stage}: p95 {old['p95_ms']:.2f} -> {values['p95_ms']:.2f} ms")
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="离线回放请求日志，测量各阶段延迟、吞吐量和峰值内存")
+    parser.add_argument("--target", choices=["wechat", "chain"], default="wechat")
+    parser.add_argument("--log", default=None, help="JSONL 请求日志，不提供时按内置问题生成")
+    parser.add_argument("--requests", type=int, default=200, help="未提供日志时生成的请求数")
+    parser.add_argument("--users", type=int, default=50, help="未提供日志时的用户数")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--speed", type=float, default=0, help="按日志 at 字段的倍速回放，0 表示尽快发送")
+    parser.add_argument("--index-path", default='vector_store/faiss_index_three_body_full')
+    parser.add_argument("--synthetic-corpus", default=None, help="用假 Embedding 为该语料构建临时索引")
+    parser.add_argument("--fake-dim", type=int, default=768)
+    parser.add_argument("--embeddings", choices=["fake", "model"], default="fake",
+                        help="fake: 确定性的假向量；model: 本地已缓存的 Embedding 模型")
+    parser.add_argument("--first-token-delay", type=float, default=0.5)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument("--cs-port", type=int, default=18002)
+    parser.add_argument("--cs-delay", type=float, default=0.0)
+    parser.add_argument("--answer-cache", action="store_true", help="保留语义答案缓存和 LLM 回答缓存（默认关闭）")
+    parser.add_argument("--output", default=None, help="把报告保存为 JSON")
+    parser.add_argument("--baseline", default=None, help="与之前保存的报告比较")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="p95 允许变慢的比例")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = run_benchmark(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"报告已保存到 {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(report, json.load(f), args.max_regression)
+        if regressions:
+            print("发现性能回退：\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("与基线相比没有性能回退。")
@@ -3,36 +3,282 @@ import sys
 # 将项目根目录添加到 sys.path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-import pickle
+import argparse
+import hashlib
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import HuggingFaceEmbeddings
-from src.load_and_split import load_and_split_text
+from src.load_and_split import DEFAULT_CHARACTERS, iter_split_documents, load_character_list
+from src.chunk_store import load_vector_store, save_vector_store, vector_index_path
+from src.lexical_index import build_lexical_index
+from src.metadata_index import build_metadata_index
+from src.faiss_index import INDEX_TYPES, all_vectors, build_index, recall_latency_report, write_derived_index
 
-def build_and_save_vector_store(docs, embeddings, index_path):
+def build_and_save_vector_store(docs, embeddings, index_path, embedding_model_name, workers=1, batch_size=64):
     """
-    根据文档和指定的 embedding 模型构建 FAISS 向量数据库，并将其保存到本地。
+    忽略已有索引，全量重建 FAISS 向量数据库并保存到本地。
+    与增量构建走同一流程（以内容哈希作为文档块 ID、分批并行计算向量），之后的增量运行可以直接复用。
     """
-    print("正在构建向量数据库...")
-    vector_store = FAISS.from_documents(docs, embeddings)
-    print("向量数据库构建完成。")
-    
-    print(f"正在将向量数据库保存到: {index_path}")
-    vector_store.save_local(index_path)
-    print("向量数据库已成功保存。")
+    print("正在全量重建向量数据库...")
+    return incremental_build_vector_store(docs, embeddings, index_path, embedding_model_name,
+                                          workers=workers, batch_size=batch_size, rebuild=True)
+
+# --- 增量构建 ---
+
+def chunk_id(doc) -> str:
+    """根据来源文件和文本内容计算文档块的内容哈希，作为其在索引中的 ID。"""
+    h = hashlib.sha1()
+    h.update(doc.metadata.get("source", "").encode("utf-8"))
+    h.update(b"\0")
+    h.update(doc.page_content.encode("utf-8"))
+    return h.hexdigest()
+
+# 子进程内的 Embedding 模型，由 _init_embedding_worker 在进程启动时加载一次
+_worker_embeddings = None
+
+def _init_embedding_worker(model_name, torch_threads):
+    global _worker_embeddings
+    if torch_threads:
+        import torch
+        torch.set_num_threads(torch_threads)
+    _worker_embeddings = HuggingFaceEmbeddings(model_name=model_name)
+
+def _embed_batch(texts):
+    return _worker_embeddings.embed_documents(texts)
+
+def _iter_embedded_batches(batches, embeddings, embedding_model_name, workers):
+    """按顺序产出每个批次的向量；workers > 1 时在多个子进程中并行计算。"""
+    if workers <= 1:
+        for batch in batches:
+            yield embeddings.embed_documents([doc.page_content for _, doc in batch])
+        return
+
+    # 每个子进程分到的 torch 线程数，避免多个进程争抢同一批 CPU 核心
+    torch_threads = max(1, (os.cpu_count() or workers) // workers)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_embedding_worker,
+        initargs=(embedding_model_name, torch_threads),
+    ) as executor:
+        texts = ([doc.page_content for _, doc in batch] for batch in batches)
+        yield from executor.map(_embed_batch, texts)
+
+# 增量构建的检查点：每个批次嵌入后追加写入（文档块 ID、正文、元数据和向量），索引只在构建结束时写出一次
+CHECKPOINT_FILE = "build.checkpoint.jsonl"
+
+def _load_checkpoint(index_path, embedding_model_name) -> dict:
+    """读取上次中断留下的检查点，返回 {文档块 ID: (正文, 元数据, 向量)}；模型不同时丢弃。"""
+    path = os.path.join(index_path, CHECKPOINT_FILE)
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    with open(path, encoding="utf-8") as f:
+        header = f.readline()
+        try:
+            model = json.loads(header).get("model")
+        except json.JSONDecodeError:
+            model = None
+        if model != embedding_model_name:
+            print(f"检查点 {path} 使用的模型 {model} 与本次不同，已忽略。")
+            return entries
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 最后一行可能因中断而不完整
+                continue
+            entries[record["id"]] = (record["text"], record["metadata"], record["vector"])
+    return entries
+
+def _open_checkpoint(index_path, embedding_model_name, restored: dict):
+    """重新写出仍然有效的检查点条目，返回追加写入的文件对象。"""
+    os.makedirs(index_path, exist_ok=True)
+    f = open(os.path.join(index_path, CHECKPOINT_FILE), "w", encoding="utf-8")
+    f.write(json.dumps({"model": embedding_model_name}) + "\n")
+    for doc_id, (text, metadata, vector) in restored.items():
+        _write_checkpoint_record(f, doc_id, text, metadata, vector)
+    return f
+
+def _write_checkpoint_record(f, doc_id, text, metadata, vector):
+    record = {"id": doc_id, "text": text, "metadata": metadata, "vector": [float(v) for v in vector]}
+    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def incremental_build_vector_store(docs, embeddings, index_path, embedding_model_name,
+                                   workers=1, batch_size=64, checkpoint_every=10, prune=False, rebuild=False):
+    """
+    增量构建 FAISS 向量数据库：
+    - 以内容哈希作为文档块 ID，只对索引中不存在的新块或修改过的块计算向量；
+    - 删除本次涉及的源文件中已不存在的旧块（prune=True 时删除所有不在本次文档中的块）；
+    - 每个批次的向量追加写入检查点文件（每 checkpoint_every 个批次刷到磁盘），索引和文档块存储只在结束时
+      写出一次，总写入量与文档块数成正比；中断后重新运行会从检查点恢复已嵌入的块，不再重新计算；
+    - rebuild=True 时不加载已有索引，所有文档块重新计算向量（全量重建）。
+    """
+    # 1. 计算内容哈希并去重
+    current = {}
+    for doc in docs:
+        current.setdefault(chunk_id(doc), doc)
+    sources = {doc.metadata.get("source", "") for doc in current.values()}
+
+    # 2. 加载已有索引
+    vector_store = None
+    if not rebuild and os.path.exists(vector_index_path(index_path)):
+        vector_store = load_vector_store(index_path, embeddings, mutable=True)
+        print(f"已加载现有索引，包含 {vector_store.index.ntotal} 个向量。")
+
+    # 3. 删除已过期的块
+    if vector_store is not None:
+        stale_ids = []
+        for doc_id in vector_store.index_to_docstore_id.values():
+            if doc_id in current:
+                continue
+            stored = vector_store.docstore.search(doc_id)
+            stored_source = getattr(stored, "metadata", {}).get("source", "")
+            if prune or stored_source in sources:
+                stale_ids.append(doc_id)
+        if stale_ids:
+            vector_store.delete(stale_ids)
+            print(f"已删除 {len(stale_ids)} 个过期的文档块。")
+
+    # 4. 找出需要计算向量的新块
+    existing_ids = set(vector_store.index_to_docstore_id.values()) if vector_store is not None else set()
+    pending = [(doc_id, doc) for doc_id, doc in current.items() if doc_id not in existing_ids]
+    print(f"文档块总数: {len(current)}，已在索引中: {len(current) - len(pending)}，待嵌入: {len(pending)}")
+
+    # 从上次中断留下的检查点恢复已经算好的向量
+    checkpoint = _load_checkpoint(index_path, embedding_model_name)
+    restored = {doc_id: checkpoint[doc_id] for doc_id, _ in pending if doc_id in checkpoint}
+    if restored:
+        text_embeddings = [(text, vector) for text, _, vector in restored.values()]
+        metadatas = [metadata for _, metadata, _ in restored.values()]
+        ids = list(restored)
+        if vector_store is None:
+            vector_store = FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas, ids=ids)
+        else:
+            vector_store.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+        pending = [(doc_id, doc) for doc_id, doc in pending if doc_id not in restored]
+        print(f"已从检查点恢复 {len(restored)} 个文档块，仍需嵌入: {len(pending)}")
+
+    checkpoint_path = os.path.join(index_path, CHECKPOINT_FILE)
+    if not pending:
+        if vector_store is not None:
+            save_vector_store(vector_store, index_path)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        print("索引已是最新，无需重新嵌入。")
+        return vector_store
+
+    # 5. 分批并行计算向量并写入索引
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    start = time.perf_counter()
+    done = 0
+    embedded = _iter_embedded_batches(batches, embeddings, embedding_model_name, workers)
+    checkpoint_file = _open_checkpoint(index_path, embedding_model_name, restored)
+    for batch_no, (batch, vectors) in enumerate(zip(batches, embedded), start=1):
+        for (doc_id, doc), vec in zip(batch, vectors):
+            _write_checkpoint_record(checkpoint_file, doc_id, doc.page_content, doc.metadata, vec)
+        text_embeddings = [(doc.page_content, vec) for (_, doc), vec in zip(batch, vectors)]
+        metadatas = [doc.metadata for _, doc in batch]
+        ids = [doc_id for doc_id, _ in batch]
+        if vector_store is None:
+            vector_store = FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas, ids=ids)
+        else:
+            vector_store.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+
+        done += len(batch)
+        elapsed = time.perf_counter() - start
+        print(f"[{batch_no}/{len(batches)}] 已嵌入 {done}/{len(pending)} 块，"
+              f"速度 {done / elapsed:.1f} 块/秒")
+
+        if batch_no % checkpoint_every == 0:
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+
+    checkpoint_file.close()
+    save_vector_store(vector_store, index_path)
+    os.remove(checkpoint_path)
+    elapsed = time.perf_counter() - start
+    print(f"增量构建完成：新增 {done} 块，用时 {elapsed:.1f} 秒，"
+          f"平均 {done / elapsed:.1f} 块/秒，索引共 {vector_store.index.ntotal} 个向量。")
     return vector_store
 
+# --- 压缩/近似索引 ---
+
+REPORT_QUESTIONS = [
+    "黑暗森林法则是什么？",
+    "智子是什么？",
+    "叶文洁在红岸基地做了什么？",
+    "古筝行动是怎么执行的？",
+    "ETO 的全称和目标是什么？",
+    "三体世界为什么会有乱纪元？",
+    "史强是个什么样的人？",
+    "汪淼看到的倒计时是怎么回事？",
+]
+
+def build_derived_index(flat_vector_store, index_path, index_type, output_path=None, **params):
+    """从 flat 主索引派生出 IVF/HNSW/PQ/SQ8 索引，写入单独的目录，主索引仍用于增量更新。"""
+    output_path = output_path or f"{index_path}_{index_type}"
+    print(f"正在构建 {index_type} 索引...")
+    start = time.perf_counter()
+    index = build_index(index_type, all_vectors(flat_vector_store.index), **params)
+    write_derived_index(index_path, output_path, index)
+    print(f"{index_type} 索引已保存到 {output_path}，用时 {time.perf_counter() - start:.1f} 秒。")
+    return output_path
+
+def run_recall_report(flat_vector_store, embeddings, k=3, sample_queries=200, **params):
+    """用固定问题集加上随机抽样的文档向量作为查询，输出各索引类型的召回率/延迟报告。"""
+    import numpy as np
+    base = all_vectors(flat_vector_store.index)
+    rng = np.random.default_rng(0)
+    sampled = base[rng.choice(len(base), size=min(sample_queries, len(base)), replace=False)]
+    # 在文档向量上加一点噪声，避免查询与某个库内向量完全重合
+    sampled = sampled + rng.normal(scale=0.01 * float(np.abs(base).mean()), size=sampled.shape)
+    questions = np.asarray(embeddings.embed_documents(REPORT_QUESTIONS), dtype=np.float32)
+    queries = np.vstack([questions, sampled]).astype(np.float32)
+    return recall_latency_report(base, queries, k=k, **params)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="构建或增量更新《三体》FAISS 向量数据库")
+    parser.add_argument("files", nargs="*", default=['data/三体 (刘慈欣) (Z-Library).txt'],
+                        help="要加入索引的文本文件")
+    parser.add_argument("--index-path", default='vector_store/faiss_index_three_body_full')
+    parser.add_argument("--model", default='moka-ai/m3e-base')
+    parser.add_argument("--workers", type=int, default=1, help="并行计算向量的进程数")
+    parser.add_argument("--split-workers", type=int, default=1, help="并行切分文本的进程数")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--checkpoint-every", type=int, default=10, help="每隔多少个批次把检查点刷到磁盘")
+    parser.add_argument("--prune", action="store_true", help="删除不属于本次文件的所有旧文档块")
+    parser.add_argument("--full", action="store_true", help="忽略已有索引，全量重建")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat",
+                        help="额外派生的索引类型，flat 表示只维护精确索引")
+    parser.add_argument("--output-path", default=None, help="派生索引的保存目录，默认为 <index-path>_<index-type>")
+    parser.add_argument("--nlist", type=int, default=None, help="IVF 聚类中心数，默认约 4*sqrt(n)")
+    parser.add_argument("--hnsw-m", type=int, default=32, help="HNSW 每个节点的邻居数")
+    parser.add_argument("--pq-m", type=int, default=64, help="PQ 子向量个数，需整除向量维度")
+    parser.add_argument("--pq-nbits", type=int, default=8, help="PQ 每个子向量的编码位数")
+    parser.add_argument("--no-lexical", action="store_true", help="不构建混合检索使用的 BM25 倒排索引")
+    parser.add_argument("--characters", default=None,
+                        help="人物名单文件（每行：规范名 别名...），用于记录文档块提到的人物，默认使用内置名单")
+    parser.add_argument("--no-metadata", action="store_true", help="不构建按部/章节/人物过滤的元数据索引")
+    parser.add_argument("--report", action="store_true", help="输出各索引类型相对 flat 的 recall@k/延迟报告")
+    return parser.parse_args()
+
 if __name__ == '__main__':
-    # 定义模型和路径
-    data_file_path = 'data/三体 (刘慈欣) (Z-Library).txt'
-    vector_store_path = 'vector_store/faiss_index_three_body_full'
-    embedding_model_name = 'moka-ai/m3e-base'
+    args = parse_args()
+    vector_store_path = args.index_path
+    embedding_model_name = args.model
 
     # 1. 加载并切分文档
-    if not os.path.exists(data_file_path):
-        print(f"错误: 数据文件 {data_file_path} 未找到。")
+    missing = [f for f in args.files if not os.path.exists(f)]
+    if missing:
+        print(f"错误: 数据文件 {', '.join(missing)} 未找到。")
     else:
-        documents = load_and_split_text(data_file_path)
-        
+        # 文档块以生成器形式流式产出，增量构建时边切分边计算内容哈希
+        # （内容哈希不含元数据：已在索引中的文档块保留旧的元数据，需要时用 --full 重建）
+        characters = load_character_list(args.characters) if args.characters else DEFAULT_CHARACTERS
+        documents = iter_split_documents(args.files, workers=args.split_workers, characters=characters)
+
         # 2. 初始化 Embedding 模型
         print(f"正在初始化 Embedding 模型: {embedding_model_name}")
         # model_kwargs = {'device': 'cpu'} # 如果没有GPU，可以明确指定使用CPU
@@ -45,15 +291,43 @@ if __name__ == '__main__':
         print("Embedding 模型初始化完成。")
 
         # 3. 构建并保存向量数据库
-        build_and_save_vector_store(documents, embeddings, vector_store_path)
+        if args.full:
+            vector_store = build_and_save_vector_store(
+                documents, embeddings, vector_store_path, embedding_model_name,
+                workers=args.workers,
+                batch_size=args.batch_size,
+            )
+        else:
+            vector_store = incremental_build_vector_store(
+                documents, embeddings, vector_store_path, embedding_model_name,
+                workers=args.workers,
+                batch_size=args.batch_size,
+                checkpoint_every=args.checkpoint_every,
+                prune=args.prune,
+            )
+
+        # 4. 构建与向量位置一一对应的字符二元组倒排索引，供混合检索使用
+        if not args.no_lexical:
+            build_lexical_index(vector_store, vector_store_path)
+        # 5. 构建部/章节/人物 -> 文档块编号的过滤索引，供角色扮演等模式在检索前过滤
+        if not args.no_metadata:
+            build_metadata_index(vector_store, vector_store_path, characters)
 
-        # 4. (可选) 测试加载和搜索
+        index_params = {"nlist": args.nlist, "hnsw_m": args.hnsw_m, "pq_m": args.pq_m, "pq_nbits": args.pq_nbits}
+        if args.index_type != "flat":
+            vector_store_path = build_derived_index(
+                vector_store, vector_store_path, args.index_type, args.output_path, **index_params
+            )
+        if args.report:
+            run_recall_report(vector_store, embeddings, **index_params)
+
+        # 6. (可选) 测试加载和搜索
         print("\n--- 测试加载和搜索 ---")
         try:
-            loaded_vector_store = FAISS.load_local(vector_store_path, embeddings, allow_dangerous_deserialization=True)
+            loaded_vector_store = load_vector_store(vector_store_path, embeddings)
             query = "黑暗森林法则是什么？"
             results = loaded_vector_store.similarity_search(query, k=2)
-            
+
             print(f"查询: '{query}'")
             print("找到的相关文档:")
             for doc in results:
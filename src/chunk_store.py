@@ -0,0 +1,293 @@
+"""
+基于内存映射（mmap）的只读文档块存储，用于替代 FAISS 旁边的 index.pkl。
+
+磁盘格式（<gen> 为每次写入生成的版本号）：
+- index.<gen>.faiss:    FAISS 索引（只迁移过、尚未重新保存的旧索引为 index.faiss）
+- chunks.<gen>.bin:     所有文档块的 UTF-8 正文和 JSON 元数据依次拼接而成的数据块
+- chunks.<gen>.offsets.npy: 形状为 (n, 4) 的 int64 数组，第 i 行为 FAISS 第 i 个向量对应文档块的
+                  [正文起点, 正文终点, 元数据起点, 元数据终点]
+- chunks.<gen>.ids:     每行一个 docstore ID，行号与 FAISS 向量位置一一对应
+- chunks.json:          当前版本号、文档块数和索引文件名；索引和三个数据文件都写完后才原子替换这个文件，
+                        读进程总是看到同一版本的索引和文档块，不会把新文档块和旧索引配在一起
+
+多个进程打开同一份文件时共享操作系统的页缓存；检索时只解码 retriever 返回的那几个文档块。
+不再读写 index.pkl（反序列化 pickle 可以执行任意代码）；旧索引用 migrate 命令转换一次即可。
+"""
+import os
+import sys
+# 将项目根目录添加到 sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import mmap
+import shutil
+import subprocess
+import time
+import uuid
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.docstore.base import Docstore
+
+MANIFEST_FILE = "chunks.json"
+# 没有版本号的旧格式（chunks.bin / chunks.offsets.npy / chunks.ids），仍可读取
+LEGACY_FILES = ("chunks.bin", "chunks.offsets.npy", "chunks.ids")
+
+def _generation_files(generation: str) -> tuple:
+    return f"chunks.{generation}.bin", f"chunks.{generation}.offsets.npy", f"chunks.{generation}.ids"
+
+def _read_manifest(index_path: str):
+    path = os.path.join(index_path, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def vector_index_path(index_path: str, manifest: dict = None) -> str:
+    """当前版本的 FAISS 索引文件路径（版本文件中没有记录索引文件名时为 index.faiss）。"""
+    if manifest is None:
+        manifest = _read_manifest(index_path)
+    return os.path.join(index_path, (manifest or {}).get("index", "index.faiss"))
+
+def _publish(index_path: str, generation: str, count: int, index=None):
+    """
+    写出本版本的 FAISS 索引（index 不为 None 时），然后原子替换版本文件，最后删除其他版本的文件。
+    版本文件是唯一的切换点：在此之前读进程和崩溃后的重启看到的都是完整的旧版本。
+    """
+    manifest = {"generation": generation, "count": count}
+    if index is not None:
+        import faiss
+        manifest["index"] = f"index.{generation}.faiss"
+        faiss.write_index(index, os.path.join(index_path, manifest["index"]))
+    manifest_tmp = os.path.join(index_path, MANIFEST_FILE + ".tmp")
+    with open(manifest_tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_tmp, os.path.join(index_path, MANIFEST_FILE))
+
+    # 已经打开旧版本的读进程持有文件描述符和 mmap，删除目录项不影响它们
+    keep = set(_generation_files(generation)) | {MANIFEST_FILE, manifest.get("index", "index.faiss")}
+    for name in os.listdir(index_path):
+        stale_index = name.startswith("index.") and name.endswith(".faiss")
+        if (name.startswith("chunks.") or stale_index) and name not in keep:
+            os.remove(os.path.join(index_path, name))
+
+def has_chunk_store(index_path: str) -> bool:
+    """判断索引目录下是否已有 mmap 文档块存储。"""
+    if os.path.exists(os.path.join(index_path, MANIFEST_FILE)):
+        return True
+    return all(os.path.exists(os.path.join(index_path, name)) for name in LEGACY_FILES)
+
+def write_chunk_store(index_path: str, index_to_docstore_id: dict, docstore, index=None):
+    """
+    把 FAISS 的 docstore 按向量位置顺序写成新版本的 mmap 文档块存储，写完后切换版本并删除旧版本的文件。
+    index 不为 None 时同一版本中一起写出 FAISS 索引（见 _publish）。
+    """
+    os.makedirs(index_path, exist_ok=True)
+    generation = uuid.uuid4().hex[:12]
+    blob_name, offsets_name, ids_name = _generation_files(generation)
+    n = len(index_to_docstore_id)
+    offsets = np.zeros((n, 4), dtype=np.int64)
+    ids = []
+    position = 0
+    with open(os.path.join(index_path, blob_name), "wb") as blob:
+        for i in range(n):
+            doc_id = index_to_docstore_id[i]
+            doc = docstore.search(doc_id)
+            text = doc.page_content.encode("utf-8")
+            meta = json.dumps(doc.metadata, ensure_ascii=False).encode("utf-8")
+            blob.write(text)
+            blob.write(meta)
+            offsets[i] = (position, position + len(text), position + len(text), position + len(text) + len(meta))
+            position += len(text) + len(meta)
+            ids.append(doc_id)
+
+    np.save(os.path.join(index_path, offsets_name), offsets)
+    with open(os.path.join(index_path, ids_name), "w", encoding="utf-8") as f:
+        f.write("\n".join(ids))
+
+    _publish(index_path, generation, n, index)
+
+def copy_chunk_store(source_path: str, output_path: str, index):
+    """把 source_path 当前版本的文档块文件复制到 output_path，并与 index（例如派生的压缩索引）组成一个新版本。"""
+    os.makedirs(output_path, exist_ok=True)
+    manifest = _read_manifest(source_path)
+    source_files = _generation_files(manifest["generation"]) if manifest else LEGACY_FILES
+    generation = uuid.uuid4().hex[:12]
+    for source_name, target_name in zip(source_files, _generation_files(generation)):
+        shutil.copy2(os.path.join(source_path, source_name), os.path.join(output_path, target_name))
+    count = manifest["count"] if manifest else index.ntotal
+    _publish(output_path, generation, count, index)
+
+class MmapChunkStore(Docstore):
+    """只读的 mmap 文档块存储，实现 LangChain 的 Docstore 接口，按需解码单个文档块。"""
+
+    def __init__(self, index_path: str, retries: int = 3, manifest: dict = None):
+        """manifest 不为 None 时打开它指定的版本（由调用方负责重试），否则读取当前版本。"""
+        self.index_path = index_path
+        if manifest is not None:
+            self._open(manifest)
+        else:
+            for attempt in range(retries):
+                try:
+                    self._open(_read_manifest(index_path))
+                    break
+                except FileNotFoundError:
+                    # 读版本文件和打开数据文件之间正好切换了版本（旧文件已删除）：重新读取版本文件
+                    if attempt == retries - 1:
+                        raise
+        self._positions = {doc_id: i for i, doc_id in enumerate(self.ids)}
+
+    def _open(self, manifest):
+        if manifest is None:
+            blob_name, offsets_name, ids_name = LEGACY_FILES
+            expected = None
+        else:
+            blob_name, offsets_name, ids_name = _generation_files(manifest["generation"])
+            expected = manifest["count"]
+        with open(os.path.join(self.index_path, ids_name), encoding="utf-8") as f:
+            content = f.read()
+        self.ids = content.split("\n") if content else []
+        self._offsets = np.load(os.path.join(self.index_path, offsets_name), mmap_mode="r")
+        self._file = open(os.path.join(self.index_path, blob_name), "rb")
+        if expected is not None and not (len(self.ids) == len(self._offsets) == expected):
+            raise ValueError(f"文档块存储 {self.index_path} 的文件不完整（版本 {manifest['generation']}）。")
+        size = os.fstat(self._file.fileno()).st_size
+        # 空文件无法 mmap，此时用空字节串代替
+        self._blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index_to_docstore_id(self) -> dict:
+        """返回 FAISS 所需的向量位置到 docstore ID 的映射。"""
+        return dict(enumerate(self.ids))
+
+    def get_by_position(self, position: int) -> Document:
+        text_start, text_end, meta_start, meta_end = (int(v) for v in self._offsets[position])
+        return Document(
+            id=self.ids[position],
+            page_content=self._blob[text_start:text_end].decode("utf-8"),
+            metadata=json.loads(self._blob[meta_start:meta_end].decode("utf-8")),
+        )
+
+    def search(self, search: str):
+        position = self._positions.get(search)
+        if position is None:
+            return f"ID {search} not found."
+        return self.get_by_position(position)
+
+    def to_in_memory(self):
+        """把全部文档块读入一个可修改的 InMemoryDocstore（构建索引时使用）。"""
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+        return InMemoryDocstore({doc_id: self.get_by_position(i) for i, doc_id in enumerate(self.ids)})
+
+def load_vector_store(index_path: str, embeddings, mutable: bool = False, retries: int = 3):
+    """
+    加载 FAISS 向量数据库（同一版本的 FAISS 索引 + mmap 文档块存储）。
+    mutable=True 时返回可增删的内存 docstore，供增量构建使用。
+    只有 index.pkl 的旧索引不会被自动反序列化，需要先运行 migrate 转换。
+    """
+    import faiss
+    from langchain_community.vectorstores import FAISS
+
+    if not has_chunk_store(index_path):
+        raise FileNotFoundError(
+            f"{index_path} 下没有 mmap 文档块存储。如果这是只有 index.pkl 的旧索引，"
+            f"请确认来源可信后运行: python src/chunk_store.py migrate --index-path {index_path}"
+        )
+
+    for attempt in range(retries):
+        manifest = _read_manifest(index_path)
+        try:
+            index = faiss.read_index(vector_index_path(index_path, manifest))
+            store = MmapChunkStore(index_path, manifest=manifest)
+            break
+        except (FileNotFoundError, RuntimeError):
+            # 读版本文件和打开文件之间正好切换了版本（旧文件已删除）：重新读取版本文件
+            if attempt == retries - 1 or _read_manifest(index_path) == manifest:
+                raise
+    if index.ntotal != len(store):
+        raise ValueError(f"索引向量数 ({index.ntotal}) 与文档块数 ({len(store)}) 不一致，请重新迁移。")
+    docstore = store.to_in_memory() if mutable else store
+    return FAISS(embeddings, index, docstore, store.index_to_docstore_id())
+
+def save_vector_store(vector_store, index_path: str):
+    """保存 FAISS 向量数据库：同一版本的 FAISS 索引和 mmap 文档块存储，不再写出 index.pkl。"""
+    write_chunk_store(index_path, vector_store.index_to_docstore_id, vector_store.docstore, vector_store.index)
+    # 旧的 index.pkl 已与新索引不一致，删除以免被误用
+    legacy = os.path.join(index_path, "index.pkl")
+    if os.path.exists(legacy):
+        os.remove(legacy)
+        print(f"已删除过期的 {legacy}。")
+
+# --- 迁移与基准测试 ---
+
+def migrate(index_path: str):
+    """从现有的 index.pkl 生成 mmap 文档块存储（只需运行一次；pickle 可以执行任意代码，只迁移可信来源的索引）。"""
+    import pickle
+    with open(os.path.join(index_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    write_chunk_store(index_path, index_to_docstore_id, docstore)
+    print(f"迁移完成：{len(index_to_docstore_id)} 个文档块已写入 {index_path}（版本 {_read_manifest(index_path)['generation']}）")
+
+def _read_rss_kb() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+def _measure_load(mode: str, index_path: str):
+    """在当前进程中加载一次文档存储并输出耗时和内存增量（由 benchmark 在子进程中调用）。"""
+    rss_before = _read_rss_kb()
+    start = time.perf_counter()
+    if mode == "pickle":
+        import pickle
+        with open(os.path.join(index_path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        first_id = index_to_docstore_id[0]
+    else:
+        docstore = MmapChunkStore(index_path)
+        first_id = docstore.ids[0]
+    load_seconds = time.perf_counter() - start
+    # 模拟一次检索：取出 3 个文档块
+    start = time.perf_counter()
+    for _ in range(3):
+        docstore.search(first_id)
+    fetch_seconds = time.perf_counter() - start
+    print(json.dumps({
+        "mode": mode,
+        "load_ms": round(load_seconds * 1000, 2),
+        "fetch_3_ms": round(fetch_seconds * 1000, 3),
+        "rss_delta_mb": round((_read_rss_kb() - rss_before) / 1024, 2),
+    }))
+
+def benchmark(index_path: str, repeat: int = 3):
+    """分别在全新子进程中加载 pickle 与 mmap 文档存储，比较加载耗时和常驻内存（没有 index.pkl 时只测 mmap）。"""
+    modes = ("pickle", "mmap") if os.path.exists(os.path.join(index_path, "index.pkl")) else ("mmap",)
+    for mode in modes:
+        results = []
+        for _ in range(repeat):
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "_measure", mode, index_path],
+                capture_output=True, text=True, check=True,
+            ).stdout.strip().splitlines()[-1]
+            results.append(json.loads(out))
+        best = min(results, key=lambda r: r["load_ms"])
+        print(f"{mode:>6}: 加载 {best['load_ms']} ms，取 3 个文档块 {best['fetch_3_ms']} ms，"
+              f"RSS 增量 {best['rss_delta_mb']} MB（{repeat} 次取最快）")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="mmap 文档块存储的迁移与基准测试工具")
+    parser.add_argument("command", choices=["migrate", "benchmark", "_measure"])
+    parser.add_argument("args", nargs="*")
+    parser.add_argument("--index-path", default='vector_store/faiss_index_three_body_full')
+    parsed = parser.parse_args()
+
+    if parsed.command == "migrate":
+        migrate(parsed.index_path)
+    elif parsed.command == "benchmark":
+        benchmark(parsed.index_path)
+    else:
+        _measure_load(parsed.args[0], parsed.args[1])
@@ -0,0 +1,174 @@
+"""
+上下文组装：把检索到的文档块整理成送给 LLM 的上下文文本。
+
+- 去重：完全重复、互相包含或字符二元组相似度很高的文档块只保留排名靠前的一个；
+- 合并：同一文件中重叠或紧邻的文档块（包括切分器留下的 50 字重叠）按偏移拼接成一段连续文本，
+  没有偏移元数据的旧索引则按“前一块结尾 == 后一块开头”的文本重叠拼接；
+- 预算：按排名依次放入上下文，直到达到 token 预算，最后一段在句子边界处截断。
+
+token 数使用与会话历史相同的估算方法（src/history.estimate_tokens）。
+"""
+import threading
+from collections import deque
+
+from src.history import estimate_tokens
+
+# 同一文件中两个文档块间隔不超过这么多字符（通常只是换行）时视为相邻
+ADJACENT_GAP = 2
+# 字符二元组 Jaccard 相似度超过该值视为近似重复
+NEAR_DUPLICATE_THRESHOLD = 0.8
+# 没有偏移元数据时，文本首尾重叠至少这么多字符才拼接
+MIN_TEXT_OVERLAP = 20
+MAX_TEXT_OVERLAP = 200
+# 截断后剩余不足这么多 token 的片段直接丢弃
+MIN_PIECE_TOKENS = 30
+
+_SENTENCE_BREAKS = "。！？!?\n"
+
+def _bigrams(text: str) -> set:
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+def _text_overlap(a: str, b: str) -> int:
+    """a 的结尾与 b 的开头重叠的最大字符数，小于 MIN_TEXT_OVERLAP 时返回 0。"""
+    for n in range(min(len(a), len(b), MAX_TEXT_OVERLAP), MIN_TEXT_OVERLAP - 1, -1):
+        if a.endswith(b[:n]):
+            return n
+    return 0
+
+def _piece(doc, rank: int):
+    metadata = doc.metadata or {}
+    text = doc.page_content.strip()
+    start, end = metadata.get("start_index"), metadata.get("end_index")
+    # 只有正文与 [start_index, end_index) 完全对应时才能按偏移拼接
+    aligned = start is not None and end is not None and end - start == len(text) == len(doc.page_content)
+    return {
+        "text": text,
+        "source": metadata.get("source"),
+        "start": start if aligned else None,
+        "end": end if aligned else None,
+        "rank": rank,
+        "chunks": 1,
+    }
+
+def _merge(a: dict, b: dict):
+    """尝试把两个片段合并成一个，返回 (合并结果, 原因)，无法合并时返回 (None, None)。"""
+    rank = min(a["rank"], b["rank"])
+    chunks = a["chunks"] + b["chunks"]
+    if a["source"] == b["source"] and a["start"] is not None and b["start"] is not None:
+        first, second = (a, b) if a["start"] <= b["start"] else (b, a)
+        if second["start"] > first["end"] + ADJACENT_GAP:
+            return None, None
+        if second["end"] <= first["end"]:
+            return dict(first, rank=rank, chunks=chunks), "duplicate"
+        if second["start"] <= first["end"]:
+            text = first["text"] + second["text"][first["end"] - second["start"]:]
+            reason = "overlap"
+        else:
+            text = first["text"] + "\n" + second["text"]
+            reason = "adjacent"
+        return dict(first, text=text, end=second["end"], rank=rank, chunks=chunks), reason
+
+    # 没有可用的偏移：按文本判断包含、近似重复和首尾重叠
+    if b["text"] in a["text"]:
+        return dict(a, rank=rank, chunks=chunks), "duplicate"
+    if a["text"] in b["text"]:
+        return dict(b, rank=rank, chunks=chunks), "duplicate"
+    grams_a, grams_b = _bigrams(a["text"]), _bigrams(b["text"])
+    if grams_a and grams_b and len(grams_a & grams_b) / len(grams_a | grams_b) >= NEAR_DUPLICATE_THRESHOLD:
+        keep = a if a["rank"] <= b["rank"] else b
+        return dict(keep, rank=rank, chunks=chunks), "duplicate"
+    for first, second in ((a, b), (b, a)):
+        overlap = _text_overlap(first["text"], second["text"])
+        if overlap:
+            return dict(first, text=first["text"] + second["text"][overlap:], start=None, end=None,
+                        rank=rank, chunks=chunks), "overlap"
+    return None, None
+
+def _truncate_to_tokens(text: str, tokens: int) -> str:
+    """截断到不超过 tokens 个 token，尽量停在句子结尾。"""
+    if estimate_tokens(text) <= tokens:
+        return text
+    cut = int(len(text) * tokens / estimate_tokens(text))
+    while cut > 0 and estimate_tokens(text[:cut]) > tokens:
+        cut = int(cut * 0.9)
+    prefix = text[:cut]
+    boundary = max(prefix.rfind(ch) for ch in _SENTENCE_BREAKS)
+    return prefix[:boundary + 1] if boundary >= len(prefix) // 2 else prefix
+
+def pack_context(docs, token_budget: int, separator: str = "\n\n"):
+    """
+    去重、合并并按 token 预算组装上下文。
+    返回 (上下文文本, 统计信息)，统计信息包含输入块数、输出段数、去重/合并次数和上下文 token 数。
+    """
+    pieces = []
+    info = {"chunks": 0, "pieces": 0, "duplicates": 0, "merged": 0, "dropped": 0, "tokens": 0}
+    for rank, doc in enumerate(docs):
+        piece = _piece(doc, rank)
+        if not piece["text"]:
+            continue
+        info["chunks"] += 1
+        pieces.append(piece)
+
+    # 反复两两合并直到没有变化（一个新块可能把两个已有片段连起来）
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(pieces)):
+            for j in range(i + 1, len(pieces)):
+                merged, reason = _merge(pieces[i], pieces[j])
+                if merged is not None:
+                    pieces[i] = merged
+                    del pieces[j]
+                    info["duplicates" if reason == "duplicate" else "merged"] += 1
+                    changed = True
+                    break
+            if changed:
+                break
+
+    parts = []
+    used = 0
+    separator_tokens = estimate_tokens(separator)
+    for piece in sorted(pieces, key=lambda p: p["rank"]):
+        remaining = token_budget - used - (separator_tokens if parts else 0)
+        text = piece["text"]
+        tokens = estimate_tokens(text)
+        if tokens > remaining:
+            if remaining < MIN_PIECE_TOKENS:
+                info["dropped"] += 1
+                continue
+            text = _truncate_to_tokens(text, remaining)
+            tokens = estimate_tokens(text)
+        used += tokens + (separator_tokens if parts else 0)
+        parts.append(text)
+
+    info["pieces"] = len(parts)
+    info["tokens"] = used
+    return separator.join(parts), info
+
+class PromptTokenMeter:
+    """记录每次请求的 prompt token 构成，汇总分位数。"""
+
+    def __init__(self, sample_size: int = 1000):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=sample_size)
+        self.requests = 0
+        self.over_budget = 0
+
+    def record(self, template: int, context: int, history: int, question: int, budget: int):
+        total = template + context + history + question
+        with self._lock:
+            self._samples.append((total, context, history))
+            self.requests += 1
+            if total > budget:
+                self.over_budget += 1
+        return total
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            samples = list(self._samples)
+        result = {"requests": self.requests, "over_budget": self.over_budget}
+        for i, name in enumerate(("total", "context", "history")):
+            values = sorted(s[i] for s in samples)
+            result[f"{name}_tokens_p50"] = values[len(values) // 2] if values else 0
+            result[f"{name}_tokens_p95"] = values[min(len(values) - 1, int(0.95 * len(values)))] if values else 0
+        return result
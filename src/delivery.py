@@ -0,0 +1,502 @@
+"""
+客服消息投递子系统：
+- 持久连接池（requests.Session / aiohttp.ClientSession），避免每条消息重新握手；
+- 对连接错误、超时、429 和 5xx 做有限次数的重试，退避时间带随机抖动；
+- 重试仍失败的回复写入 SQLite 发件箱，由后台任务定期补发，同一用户的多条积压文本会合并成一条发送；
+  多个进程（gunicorn worker、asyncio 服务）可以共用同一个发件箱文件：补发前先原子地认领（带租约）一批消息，
+  同一用户的消息同一时刻只会被一个进程认领，不会重复发送；
+- 用户在发件箱中还有积压消息时，新回复也排进发件箱，保证同一用户的消息按顺序送达；
+- 统计投递延迟、重试和失败次数。
+
+自检（使用本地桩客服服务，模拟失败和服务中断）：
+    python src/delivery.py --selftest
+"""
+import os
+import sys
+# 将项目根目录添加到 sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import json
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """第 attempt 次重试前的等待时间（指数退避 + 全抖动）。"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+class DeliveryOutbox:
+    """
+    基于 SQLite 的发件箱，保存暂时无法投递的回复，进程重启后仍可补发。
+    claim 认领的消息在租约（lease 秒）内不会被其他进程再次认领；进程崩溃后租约到期，消息由其他进程补发。
+    """
+
+    def __init__(self, path: str, lease: float = 300):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, msg_type TEXT, content TEXT, "
+            "created_at REAL, attempts INTEGER DEFAULT 0, last_error TEXT, claimed_by TEXT, claimed_until REAL)"
+        )
+        # 旧版本创建的发件箱没有认领字段
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(outbox)")}
+        for column, column_type in (("claimed_by", "TEXT"), ("claimed_until", "REAL")):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE outbox ADD COLUMN {column} {column_type}")
+        self._db.execute("CREATE INDEX IF NOT EXISTS outbox_user ON outbox (user_id)")
+        self._db.commit()
+
+    def add(self, user_id: str, content: str, msg_type: str, error: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO outbox (user_id, msg_type, content, created_at, attempts, last_error) "
+                "VALUES (?, ?, ?, ?, 1, ?)",
+                (user_id, msg_type, content, time.time(), error)
+            )
+            self._db.commit()
+
+    def has_pending(self, user_id: str) -> bool:
+        """该用户在发件箱中是否还有未送达的消息（包括其他进程正在补发的）。"""
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM outbox WHERE user_id = ? LIMIT 1", (user_id,)).fetchone() is not None
+
+    def claim(self, limit: int):
+        """
+        按写入顺序认领最多 limit 条待补发消息并返回。
+        跳过已被其他进程认领（租约未到期）的用户的全部消息，避免同一用户的新消息被另一个进程抢先发出。
+        """
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "UPDATE outbox SET claimed_by = ?, claimed_until = ? WHERE id IN ("
+                    "SELECT id FROM outbox WHERE (claimed_until IS NULL OR claimed_until < ?) "
+                    "AND user_id NOT IN (SELECT user_id FROM outbox WHERE claimed_until >= ?) "
+                    "ORDER BY id LIMIT ?)",
+                    (token, now + self.lease, now, now, limit)
+                )
+                rows = self._db.execute(
+                    "SELECT id, user_id, msg_type, content, attempts FROM outbox WHERE claimed_by = ? ORDER BY id",
+                    (token,)
+                ).fetchall()
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+        return rows
+
+    def delete(self, ids):
+        with self._lock:
+            self._db.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+            self._db.commit()
+
+    def mark_failed(self, ids, error: str):
+        """记录一次失败并释放认领，下次补发时重试。"""
+        with self._lock:
+            self._db.executemany(
+                "UPDATE outbox SET attempts = attempts + 1, last_error = ?, claimed_by = NULL, claimed_until = NULL "
+                "WHERE id = ?",
+                [(error, i) for i in ids]
+            )
+            self._db.commit()
+
+    def release(self, ids):
+        """释放认领但不计为失败（例如同一用户更早的消息补发失败，后面的消息本轮不发送）。"""
+        with self._lock:
+            self._db.executemany(
+                "UPDATE outbox SET claimed_by = NULL, claimed_until = NULL WHERE id = ?", [(i,) for i in ids]
+            )
+            self._db.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+def group_outbox_rows(rows):
+    """
+    把发件箱中的消息按用户分组，同一用户连续的文本消息合并成一条，减少补发调用次数。
+    返回 [(user_id, msg_type, content, [row_id, ...]), ...]，保持每个用户内的原始顺序。
+    """
+    groups = []
+    last_by_user = {}
+    for row_id, user_id, msg_type, content, _ in rows:
+        last = last_by_user.get(user_id)
+        if last is not None and msg_type == "text" and last[1] == "text":
+            last[2] = last[2] + "\n" + content
+            last[3].append(row_id)
+            continue
+        entry = [user_id, msg_type, content, [row_id]]
+        groups.append(entry)
+        last_by_user[user_id] = entry
+    return [tuple(g) for g in groups]
+
+class DeliveryMetrics:
+    """线程安全的投递统计。"""
+
+    def __init__(self, sample_size: int = 1000):
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.attempts = 0
+        self.retries = 0
+        self.failed = 0
+        self.dropped = 0
+        self.outbox_delivered = 0
+        self._latencies = deque(maxlen=sample_size)
+
+    def record(self, ok: bool, attempts: int, latency: float):
+        with self._lock:
+            self.attempts += attempts
+            self.retries += attempts - 1
+            if ok:
+                self.sent += 1
+                self._latencies.append(latency)
+            else:
+                self.failed += 1
+
+    def add(self, name: str, value: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                "sent": self.sent,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "attempts": self.attempts,
+                "retries": self.retries,
+                "outbox_delivered": self.outbox_delivered,
+                "latency_p50_ms": round(_percentile(latencies, 0.5) * 1000, 2),
+                "latency_p95_ms": round(_percentile(latencies, 0.95) * 1000, 2),
+                "latency_max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            }
+
+class _BaseDeliveryClient:
+    def __init__(self, url: str, timeout: float = 10, max_retries: int = 3, backoff_base: float = 0.5,
+                 backoff_max: float = 8.0, outbox_path: str = None, outbox_interval: float = 30,
+                 outbox_max_attempts: int = 20, outbox_batch: int = 100, outbox_lease: float = 300):
+        self.url = url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.outbox = DeliveryOutbox(outbox_path, outbox_lease) if outbox_path else None
+        self.outbox_interval = outbox_interval
+        self.outbox_max_attempts = outbox_max_attempts
+        self.outbox_batch = outbox_batch
+        self.metrics = DeliveryMetrics()
+
+    @staticmethod
+    def _payload(user_id: str, content: str, msg_type: str) -> bytes:
+        payload = {
+            "openid": user_id,
+            "message_type": msg_type,
+            "content": content
+        }
+        return json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+    def _park(self, user_id: str, content: str, msg_type: str, error: str):
+        """投递失败后写入发件箱；未配置发件箱时只能丢弃并计数。"""
+        if self.outbox is not None:
+            self.outbox.add(user_id, content, msg_type, error)
+            print(f"消息暂时无法投递给用户 [{user_id}]，已写入发件箱: {error}")
+        else:
+            self.metrics.add("dropped")
+            print(f"错误：调用客服消息 API 失败，消息已丢弃: {error}")
+
+    def _must_queue(self, user_id: str) -> bool:
+        """用户还有积压消息时，新消息也进入发件箱排在后面，不能抢先发出。"""
+        return self.outbox is not None and self.outbox.has_pending(user_id)
+
+    def _queue_behind(self, user_id: str, content: str, msg_type: str):
+        self.outbox.add(user_id, content, msg_type, "排在发件箱中的积压消息之后")
+        print(f"用户 [{user_id}] 在发件箱中还有积压消息，新消息排队补发。")
+
+    def _settle_outbox_group(self, ok: bool, row_ids, attempts_by_id, error: str):
+        if ok:
+            self.outbox.delete(row_ids)
+            self.metrics.add("outbox_delivered", len(row_ids))
+            return
+        expired = [i for i in row_ids if attempts_by_id[i] + 1 >= self.outbox_max_attempts]
+        if expired:
+            self.outbox.delete(expired)
+            self.metrics.add("dropped", len(expired))
+            print(f"发件箱中有 {len(expired)} 条消息超过最大重试次数，已放弃。")
+        remaining = [i for i in row_ids if i not in expired]
+        if remaining:
+            self.outbox.mark_failed(remaining, error)
+
+    def stats(self) -> dict:
+        stats = self.metrics.snapshot()
+        stats["outbox_depth"] = self.outbox.count() if self.outbox is not None else None
+        return stats
+
+class CustomerServiceClient(_BaseDeliveryClient):
+    """同步投递客户端：供 Flask 后端的工作线程使用。"""
+
+    def __init__(self, url: str, pool_size: int = 20, **kwargs):
+        super().__init__(url, **kwargs)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        self._worker = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def _post_with_retry(self, user_id: str, content: str, msg_type: str):
+        """返回 (是否成功, 尝试次数, 是否值得稍后重试, 错误信息)。"""
+        data = self._payload(user_id, content, msg_type)
+        error = ""
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(backoff_delay(attempt - 1, self.backoff_base, self.backoff_max))
+            try:
+                res = self.session.post(self.url, data=data, timeout=self.timeout)
+                if res.status_code < 400:
+                    return True, attempt + 1, False, ""
+                error = f"HTTP {res.status_code}"
+                if res.status_code not in RETRYABLE_STATUS:
+                    return False, attempt + 1, False, error
+            except requests.exceptions.RequestException as e:
+                error = str(e) or type(e).__name__
+        return False, self.max_retries + 1, True, error
+
+    def send(self, user_id: str, content: str, msg_type: str = "text") -> bool:
+        """投递一条消息；重试耗尽后写入发件箱，返回是否已即时送达。"""
+        if self._must_queue(user_id):
+            self._queue_behind(user_id, content, msg_type)
+            self._wake.set()
+            return False
+        start = time.perf_counter()
+        ok, attempts, retryable, error = self._post_with_retry(user_id, content, msg_type)
+        self.metrics.record(ok, attempts, time.perf_counter() - start)
+        if not ok:
+            if retryable:
+                self._park(user_id, content, msg_type, error)
+            else:
+                self.metrics.add("dropped")
+                print(f"错误：客服消息 API 拒绝了发给用户 [{user_id}] 的消息: {error}")
+        return ok
+
+    def flush_outbox(self) -> int:
+        """认领并补发一批发件箱中的消息，返回成功补发的消息条数。"""
+        if self.outbox is None:
+            return 0
+        rows = self.outbox.claim(self.outbox_batch)
+        attempts_by_id = {row[0]: row[4] for row in rows}
+        delivered = 0
+        failed_users = set()
+        for user_id, msg_type, content, row_ids in group_outbox_rows(rows):
+            if user_id in failed_users:
+                # 该用户更早的消息没有送达，后面的消息本轮不发送，保持顺序
+                self.outbox.release(row_ids)
+                continue
+            start = time.perf_counter()
+            ok, attempts, _, error = self._post_with_retry(user_id, content, msg_type)
+            self.metrics.record(ok, attempts, time.perf_counter() - start)
+            self._settle_outbox_group(ok, row_ids, attempts_by_id, error)
+            if ok:
+                delivered += len(row_ids)
+            else:
+                failed_users.add(user_id)
+        return delivered
+
+    def start_outbox_worker(self):
+        """启动后台线程，定期补发发件箱中的消息。"""
+        if self.outbox is None or self._worker is not None:
+            return
+
+        def loop():
+            while not self._stop.is_set():
+                # 定期补发；有新消息排进发件箱时提前唤醒
+                self._wake.wait(self.outbox_interval)
+                self._wake.clear()
+                if self._stop.is_set():
+                    break
+                try:
+                    delivered = self.flush_outbox()
+                    if delivered:
+                        print(f"发件箱补发成功 {delivered} 条消息。")
+                except Exception as e:
+                    print(f"补发发件箱消息时出错: {e}")
+
+        self._worker = threading.Thread(target=loop, name="delivery-outbox", daemon=True)
+        self._worker.start()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        self.session.close()
+
+class AsyncCustomerServiceClient(_BaseDeliveryClient):
+    """asyncio 投递客户端：供 wechat_async_app 使用，需在事件循环中调用 start()。"""
+
+    def __init__(self, url: str, pool_size: int = 100, **kwargs):
+        super().__init__(url, **kwargs)
+        self.pool_size = pool_size
+        self.session = None
+        self._flush_task = None
+        self._wake = None
+
+    async def start(self):
+        from aiohttp import ClientSession, ClientTimeout, TCPConnector
+        self.session = ClientSession(
+            connector=TCPConnector(limit=self.pool_size),
+            timeout=ClientTimeout(total=self.timeout),
+            headers={"Content-Type": "application/json"},
+        )
+        if self.outbox is not None:
+            self._wake = asyncio.Event()
+            self._flush_task = asyncio.create_task(self._outbox_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        if self.session is not None:
+            await self.session.close()
+
+    async def _post_with_retry(self, user_id: str, content: str, msg_type: str):
+        from aiohttp import ClientError
+        data = self._payload(user_id, content, msg_type)
+        error = ""
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(backoff_delay(attempt - 1, self.backoff_base, self.backoff_max))
+            try:
+                async with self.session.post(self.url, data=data) as res:
+                    await res.read()
+                    if res.status < 400:
+                        return True, attempt + 1, False, ""
+                    error = f"HTTP {res.status}"
+                    if res.status not in RETRYABLE_STATUS:
+                        return False, attempt + 1, False, error
+            except (ClientError, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+        return False, self.max_retries + 1, True, error
+
+    async def send(self, user_id: str, content: str, msg_type: str = "text") -> bool:
+        # 发件箱的 SQLite 调用放到线程中执行，不阻塞事件循环
+        if self.outbox is not None and await asyncio.to_thread(self._must_queue, user_id):
+            await asyncio.to_thread(self._queue_behind, user_id, content, msg_type)
+            if self._wake is not None:
+                self._wake.set()
+            return False
+        start = time.perf_counter()
+        ok, attempts, retryable, error = await self._post_with_retry(user_id, content, msg_type)
+        self.metrics.record(ok, attempts, time.perf_counter() - start)
+        if not ok:
+            if retryable:
+                await asyncio.to_thread(self._park, user_id, content, msg_type, error)
+            else:
+                self.metrics.add("dropped")
+                print(f"错误：客服消息 API 拒绝了发给用户 [{user_id}] 的消息: {error}")
+        return ok
+
+    async def flush_outbox(self) -> int:
+        """flush_outbox 的异步版本，SQLite 调用在线程中执行。"""
+        if self.outbox is None:
+            return 0
+        rows = await asyncio.to_thread(self.outbox.claim, self.outbox_batch)
+        attempts_by_id = {row[0]: row[4] for row in rows}
+        delivered = 0
+        failed_users = set()
+        for user_id, msg_type, content, row_ids in group_outbox_rows(rows):
+            if user_id in failed_users:
+                await asyncio.to_thread(self.outbox.release, row_ids)
+                continue
+            start = time.perf_counter()
+            ok, attempts, _, error = await self._post_with_retry(user_id, content, msg_type)
+            self.metrics.record(ok, attempts, time.perf_counter() - start)
+            await asyncio.to_thread(self._settle_outbox_group, ok, row_ids, attempts_by_id, error)
+            if ok:
+                delivered += len(row_ids)
+            else:
+                failed_users.add(user_id)
+        return delivered
+
+    async def _outbox_loop(self):
+        while True:
+            # 定期补发；有新消息排进发件箱时提前唤醒
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.outbox_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                delivered = await self.flush_outbox()
+                if delivered:
+                    print(f"发件箱补发成功 {delivered} 条消息。")
+            except Exception as e:
+                print(f"补发发件箱消息时出错: {e}")
+
+# --- 自检 ---
+
+def _selftest(messages: int = 200, failure_rate: float = 0.3):
+    """在本地桩客服服务上验证重试、发件箱和补发流程。"""
+    import tempfile
+    from src.stub_servers import StubCustomerServiceServer, start_site
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    stub = StubCustomerServiceServer(failure_rate=failure_rate)
+    port = 18012
+    runner = asyncio.run_coroutine_threadsafe(start_site(stub.app, "127.0.0.1", port), loop).result()
+
+    outbox_path = os.path.join(tempfile.mkdtemp(), "outbox.sqlite3")
+    client = CustomerServiceClient(
+        f"http://127.0.0.1:{port}/send_custom_message",
+        max_retries=3, backoff_base=0.01, backoff_max=0.05, outbox_path=outbox_path,
+    )
+
+    # 1. 服务端随机失败：依靠重试送达
+    start = time.perf_counter()
+    for i in range(messages):
+        client.send(f"user-{i % 10}", f"消息 {i}")
+    print(f"[1] 失败率 {failure_rate:.0%} 下发送 {messages} 条，用时 {time.perf_counter() - start:.2f}s: {client.stats()}")
+
+    # 2. 服务中断：消息进入发件箱
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    for i in range(20):
+        client.send(f"user-{i % 3}", f"中断期间的消息 {i}。")
+    print(f"[2] 服务中断期间发送 20 条后，发件箱深度 {client.outbox.count()}")
+
+    # 3. 服务恢复：补发并按用户合并
+    stub.failure_rate = 0.0
+    received_before = len(stub.messages)
+    asyncio.run_coroutine_threadsafe(start_site(stub.app, "127.0.0.1", port), loop).result()
+    delivered = client.flush_outbox()
+    print(f"[3] 服务恢复后补发 {delivered} 条，实际调用 {len(stub.messages) - received_before} 次，"
+          f"发件箱剩余 {client.outbox.count()}")
+    print(f"最终统计: {client.stats()}")
+    client.close()
+
+if __name__ == '__main__':
+    if "--selftest" in sys.argv:
+        _selftest()
+    else:
+        print("用法: python src/delivery.py --selftest")
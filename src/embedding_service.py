@@ -0,0 +1,268 @@
+"""
+问题向量服务：包装 Embedding 模型，为在线问答提供
+- 以规范化问题文本为键的 LRU 缓存，重复问题不再做前向计算；
+- 微批处理：把几毫秒内并发到达的问题合并成一次批量前向计算，避免多个线程各自做 batch=1 的计算争抢 CPU；
+- 统计信息：缓存命中率、批大小和单次查询延迟分位数。
+
+压测不同并发下的吞吐和延迟：
+    python src/embedding_service.py --concurrency 1 4 16 64 --torch-threads 4
+"""
+import os
+import sys
+# 将项目根目录添加到 sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import asyncio
+import queue
+import re
+import threading
+import time
+import unicodedata
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from langchain_core.embeddings import Embeddings
+
+def normalize_query(text: str) -> str:
+    """全角转半角、合并连续空白并去掉首尾空白，作为缓存键和实际送入模型的文本。"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class MicroBatcher:
+    """
+    把并发提交的文本攒成批次交给 batch_fn 计算：收到第一条后最多再等 window_ms 毫秒或攒满 max_batch 条。
+    由单个后台线程执行，保证同一时刻只有一次前向计算。
+    """
+
+    def __init__(self, batch_fn, window_ms: float = 5, max_batch: int = 32, name: str = "embedding-batcher"):
+        self.batch_fn = batch_fn
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self._start()
+        _batchers.add(self)
+
+    def _start(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # 整个批次的处理都放在 try 中：任何异常只让本批次的请求失败，后台线程继续服务后续请求
+            try:
+                self._process(batch)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _process(self, batch):
+        # 同一批次中的重复文本只计算一次
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        vectors = list(self.batch_fn(texts))
+        if len(vectors) != len(texts):
+            raise ValueError(f"批量计算返回了 {len(vectors)} 个向量，期望 {len(texts)} 个")
+        by_text = dict(zip(texts, vectors))
+        self.batches += 1
+        self.items += len(texts)
+        for text, future in batch:
+            future.set_result(by_text[text])
+
+# fork 出的子进程（如 gunicorn --preload 的 worker）中没有父进程的后台线程，需要为每个批处理器重新启动
+_batchers = weakref.WeakSet()
+
+def _restart_batchers_after_fork():
+    for batcher in list(_batchers):
+        batcher._start()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_batchers_after_fork)
+
+class EmbeddingService(Embeddings):
+    """
+    带 LRU 缓存和微批处理的 Embedding 包装器，可直接作为 FAISS 的 embedding_function 使用。
+    embed_documents（构建索引）直接透传给底层模型。
+    """
+
+    def __init__(self, embeddings, cache_size: int = 2048, batch_window_ms: float = 5, max_batch: int = 32,
+                 sample_size: int = 2000):
+        self.embeddings = embeddings
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.batcher = MicroBatcher(embeddings.embed_documents, batch_window_ms, max_batch) if batch_window_ms > 0 else None
+        self.hits = 0
+        self.misses = 0
+        self._latencies = deque(maxlen=sample_size)
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        start = time.perf_counter()
+        key = normalize_query(text)
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if vector is None:
+            if self.batcher is not None:
+                vector = self.batcher.submit(key).result()
+            else:
+                vector = self.embeddings.embed_query(key)
+            self._remember(key, vector)
+        self._latencies.append(time.perf_counter() - start)
+        return vector
+
+    def embed_queries(self, texts):
+        """批量计算问题向量（离线批处理用）：缓存未命中的问题一次性交给底层模型，结果写入缓存。"""
+        keys = [normalize_query(text) for text in texts]
+        vectors = {}
+        with self._lock:
+            for key in keys:
+                vector = self._cache.get(key)
+                if vector is not None:
+                    self._cache.move_to_end(key)
+                    vectors[key] = vector
+            missing = list(dict.fromkeys(key for key in keys if key not in vectors))
+            self.hits += sum(1 for key in keys if key in vectors)
+            self.misses += len(missing)
+        if missing:
+            for key, vector in zip(missing, self.embeddings.embed_documents(missing)):
+                vectors[key] = vector
+                self._remember(key, vector)
+        return [vectors[key] for key in keys]
+
+    async def aembed_query(self, text):
+        start = time.perf_counter()
+        key = normalize_query(text)
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                self._latencies.append(time.perf_counter() - start)
+                return vector
+            self.misses += 1
+        if self.batcher is not None:
+            vector = await asyncio.wrap_future(self.batcher.submit(key))
+        else:
+            vector = await asyncio.to_thread(self.embeddings.embed_query, key)
+        self._remember(key, vector)
+        self._latencies.append(time.perf_counter() - start)
+        return vector
+
+    def _remember(self, key, vector):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def stats(self) -> dict:
+        latencies = list(self._latencies)
+        total = self.hits + self.misses
+        batcher = self.batcher
+        return {
+            "cache_entries": len(self._cache),
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+            "cache_hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "batches": batcher.batches if batcher else 0,
+            "avg_batch_size": round(batcher.items / batcher.batches, 2) if batcher and batcher.batches else 0.0,
+            "embed_p50_ms": round(_percentile(latencies, 0.5) * 1000, 2),
+            "embed_p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+        }
+
+def set_torch_threads(threads: int):
+    """限制 torch 的 CPU 线程数（0 表示保持默认）。"""
+    if threads and threads > 0:
+        import torch
+        torch.set_num_threads(threads)
+
+# --- 压测 ---
+
+BENCHMARK_QUESTIONS = [
+    "黑暗森林法则是什么？",
+    "智子是什么？",
+    "叶文洁为什么要回复三体文明？",
+    "古筝行动是怎么执行的？",
+    "红岸基地是做什么的？",
+    "ETO 的目标是什么？",
+    "史强是个什么样的人？",
+    "三体世界为什么会有乱纪元？",
+]
+
+def run_benchmark(embeddings, concurrency_levels, queries: int, window_ms: float, max_batch: int):
+    """
+    在不同并发下比较“每个线程单独计算”与“微批处理”两种方式的吞吐和延迟。
+    每个查询文本都不相同，缓存不会命中，测的是纯计算路径。
+    """
+    modes = {
+        "direct": lambda: EmbeddingService(embeddings, cache_size=0, batch_window_ms=0),
+        "batched": lambda: EmbeddingService(embeddings, cache_size=0, batch_window_ms=window_ms, max_batch=max_batch),
+    }
+    # 预热，避免把模型首次加载的耗时算进去
+    embeddings.embed_query(BENCHMARK_QUESTIONS[0])
+
+    print(f"{'模式':<10}{'并发':>6}{'QPS':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'平均批大小':>12}")
+    counter = 0
+    for concurrency in concurrency_levels:
+        for mode, factory in modes.items():
+            service = factory()
+            texts = [f"{BENCHMARK_QUESTIONS[i % len(BENCHMARK_QUESTIONS)]}（{counter + i}）" for i in range(queries)]
+            counter += queries
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(service.embed_query, texts))
+            elapsed = time.perf_counter() - start
+            stats = service.stats()
+            print(f"{mode:<10}{concurrency:>6}{queries / elapsed:>10.1f}{stats['embed_p50_ms']:>10.1f}"
+                  f"{stats['embed_p99_ms']:>10.1f}{stats['avg_batch_size']:>12}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="问题向量服务的并发压测")
+    parser.add_argument("--model", default='moka-ai/m3e-base')
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--queries", type=int, default=256, help="每种并发/模式下发送的查询数")
+    parser.add_argument("--window-ms", type=float, default=5)
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--torch-threads", type=int, default=0, help="torch CPU 线程数，0 表示默认")
+    args = parser.parse_args()
+
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    set_torch_threads(args.torch_threads)
+    run_benchmark(HuggingFaceEmbeddings(model_name=args.model), args.concurrency, args.queries,
+                  args.window_ms, args.max_batch)
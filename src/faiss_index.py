@@ -0,0 +1,132 @@
+"""
+FAISS 索引类型的构建、查询参数设置和召回率/延迟评估。
+
+支持的索引类型（均为 L2 距离，与 LangChain FAISS 默认的 IndexFlatL2 一致）：
+- flat:     精确检索（基线）
+- ivf_flat: 倒排 + 原始向量，查询参数 nprobe
+- hnsw:     分层图索引，查询参数 efSearch（不支持删除，只适合作为只读副本）
+- ivf_pq:   倒排 + 乘积量化，内存占用最小，查询参数 nprobe
+- ivf_sq8:  倒排 + 8 bit 标量量化，查询参数 nprobe
+"""
+import math
+import os
+import shutil
+import time
+
+import numpy as np
+
+INDEX_TYPES = ["flat", "ivf_flat", "hnsw", "ivf_pq", "ivf_sq8"]
+
+def default_nlist(n_vectors: int) -> int:
+    """倒排聚类中心数：约 4*sqrt(n)，并保证每个中心至少有 39 个训练样本。"""
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+def factory_string(index_type: str, n_vectors: int, nlist: int = None,
+                   hnsw_m: int = 32, pq_m: int = 64, pq_nbits: int = 8) -> str:
+    """把索引类型和参数转换为 faiss.index_factory 描述串。"""
+    nlist = nlist or default_nlist(n_vectors)
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "ivf_flat":
+        return f"IVF{nlist},Flat"
+    if index_type == "hnsw":
+        return f"HNSW{hnsw_m},Flat"
+    if index_type == "ivf_pq":
+        return f"IVF{nlist},PQ{pq_m}x{pq_nbits}"
+    if index_type == "ivf_sq8":
+        return f"IVF{nlist},SQ8"
+    raise ValueError(f"不支持的索引类型: {index_type}，可选: {', '.join(INDEX_TYPES)}")
+
+def build_index(index_type: str, vectors: np.ndarray, **params):
+    """根据向量训练（如有需要）并构建指定类型的 FAISS 索引，向量顺序保持不变。"""
+    import faiss
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    description = factory_string(index_type, len(vectors), **params)
+    index = faiss.index_factory(vectors.shape[1], description, faiss.METRIC_L2)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+def set_search_params(index, nprobe: int = None, ef_search: int = None):
+    """设置查询时参数；对不支持该参数的索引类型自动忽略。"""
+    import faiss
+    params = faiss.ParameterSpace()
+    if nprobe and faiss.try_extract_index_ivf(index) is not None:
+        params.set_index_parameter(index, "nprobe", nprobe)
+    if ef_search and hasattr(faiss.downcast_index(index), "hnsw"):
+        params.set_index_parameter(index, "efSearch", ef_search)
+
+def filtered_search_params(index, selector):
+    """构造只在 selector 允许的向量中检索的查询参数，保留索引当前的 nprobe / efSearch 设置。"""
+    import faiss
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    downcast = faiss.downcast_index(index)
+    if hasattr(downcast, "hnsw"):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=downcast.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+def all_vectors(index) -> np.ndarray:
+    """从精确索引中取回全部向量（用于从 flat 主索引派生压缩索引）。"""
+    return index.reconstruct_n(0, index.ntotal)
+
+def write_derived_index(source_path: str, output_path: str, index):
+    """把派生索引写入 output_path，并复制与之向量顺序一致的文档块文件、倒排索引和元数据过滤索引。"""
+    from src.chunk_store import copy_chunk_store
+    copy_chunk_store(source_path, output_path, index)
+    for name in os.listdir(source_path):
+        if name.startswith(("lexical.", "filters.")):
+            shutil.copy2(os.path.join(source_path, name), os.path.join(output_path, name))
+
+def recall_latency_report(base_vectors: np.ndarray, queries: np.ndarray, index_types=None,
+                          k: int = 3, nprobes=(1, 4, 16), ef_searches=(16, 64, 128), **params):
+    """
+    以 flat 精确检索为基线，评估各索引类型在不同查询参数下的 recall@k 和单次查询延迟。
+    返回结果行列表，同时打印表格。
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    index_types = index_types or INDEX_TYPES
+
+    flat = build_index("flat", base_vectors)
+    _, truth = flat.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        start = time.perf_counter()
+        index = build_index(index_type, base_vectors, **params)
+        build_seconds = time.perf_counter() - start
+
+        if index_type.startswith("ivf"):
+            settings = [{"nprobe": v} for v in nprobes]
+        elif index_type == "hnsw":
+            settings = [{"ef_search": v} for v in ef_searches]
+        else:
+            settings = [{}]
+
+        for setting in settings:
+            set_search_params(index, **setting)
+            latencies = []
+            hits = 0
+            for i in range(len(queries)):
+                t0 = time.perf_counter()
+                _, found = index.search(queries[i:i + 1], k)
+                latencies.append(time.perf_counter() - t0)
+                hits += len(set(found[0]) & set(truth[i]))
+            latencies.sort()
+            rows.append({
+                "index_type": index_type,
+                "params": ", ".join(f"{key}={val}" for key, val in setting.items()) or "-",
+                "recall_at_k": hits / (k * len(queries)),
+                "p50_ms": latencies[len(latencies) // 2] * 1000,
+                "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+                "build_s": build_seconds,
+            })
+
+    print(f"\n召回率/延迟报告（{len(base_vectors)} 个向量，{len(queries)} 个查询，k={k}）")
+    print(f"{'索引类型':<10}{'查询参数':<16}{'recall@k':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'构建(s)':>10}")
+    for row in rows:
+        print(f"{row['index_type']:<14}{row['params']:<20}{row['recall_at_k']:>10.3f}"
+              f"{row['p50_ms']:>10.3f}{row['p99_ms']:>10.3f}{row['build_s']:>10.2f}")
+    return rows
@@ -0,0 +1,38 @@
+"""
+gunicorn 的 pre-fork 部署配置：master 进程导入 wechat_app 时加载一次 Embedding 模型、向量数据库和倒排索引，
+worker 进程 fork 后以写时复制方式共享这些只读内存，不必每个 worker 各自加载。
+
+启动方式（在项目根目录下）：
+    gunicorn -c src/gunicorn_conf.py src.wechat_app:app
+
+注意：
+- master 进程不创建线程池和投递客户端（fork 前启动的线程不会被子进程继承），
+  每个 worker 进程在 post_fork 中创建自己的一份，按用户串行只在单个 worker 内成立；
+- 多个 worker 时会话历史应使用 HISTORY_BACKEND=sqlite，否则同一用户的消息落到不同 worker 会丢失上下文。
+"""
+import gc
+import os
+
+# 必须在 gunicorn 加载应用（导入 wechat_app）之前设置
+os.environ.setdefault("RAG_WARMUP_MODE", "prefork")
+
+bind = f"0.0.0.0:{os.getenv('WECHAT_PORT', '8081')}"
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+# 每个请求只是把任务放进后台线程池后立即返回，少量线程即可
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = 30
+preload_app = True
+
+def when_ready(server):
+    # 把加载阶段创建的对象移出垃圾回收的跟踪范围，避免 worker 中的 GC 遍历触碰这些页面而破坏写时复制
+    gc.freeze()
+    server.log.info("模型和索引已在 master 进程中加载，开始创建 worker 进程")
+
+def post_fork(server, worker):
+    # torch 在 master 中没有做过推理；每个 worker 默认只用 CPU 核数 / worker 数个线程，避免互相争抢核心
+    from src.embedding_service import set_torch_threads
+    torch_threads = int(os.getenv("EMBEDDING_TORCH_THREADS", "0")) or max(1, (os.cpu_count() or 1) // workers)
+    set_torch_threads(torch_threads)
+    from src.wechat_app import start_runtime
+    start_runtime()
@@ -1,38 +1,384 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
 from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_core.messages import BaseMessage
+from langchain_core.messages import BaseMessage, SystemMessage, message_to_dict, messages_from_dict
+
+# --- 配置 ---
+
+# 历史存储后端: memory（进程内 LRU）或 sqlite（磁盘文件，可在多个工作进程间共享）
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "memory")
+HISTORY_SQLITE_PATH = os.getenv("HISTORY_SQLITE_PATH", "runtime/history.sqlite3")
+# 最多保留的会话数（memory 后端）和会话空闲多久后被清理（秒）
+HISTORY_MAX_SESSIONS = int(os.getenv("HISTORY_MAX_SESSIONS", "10000"))
+HISTORY_IDLE_TTL = float(os.getenv("HISTORY_IDLE_TTL", str(24 * 3600)))
+# 每个会话最多保存的消息条数
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "200"))
+# 每次发送给 LLM 的历史消息 token 预算
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+# 是否把超出预算的旧消息用 LLM 压缩成摘要（关闭时直接丢弃旧消息）
+HISTORY_SUMMARY_ENABLED = os.getenv("HISTORY_SUMMARY", "0") == "1"
+# 超出预算的旧消息累计到多少条后重新生成一次摘要
+HISTORY_SUMMARY_STEP = int(os.getenv("HISTORY_SUMMARY_STEP", "6"))
+
+def estimate_tokens(text) -> int:
+    """
+    粗略估算 token 数：中日韩字符按 1 个 token 计，其余字符按 4 个字符 1 个 token 计。
+    不依赖具体模型的分词器，用于预算控制已足够。
+    """
+    if not isinstance(text, str):
+        text = json.dumps(text, ensure_ascii=False)
+    cjk = sum(1 for ch in text if '⺀' <= ch <= '鿿' or '豈' <= ch <= '﫿' or '＀' <= ch <= '￯')
+    return cjk + (len(text) - cjk + 3) // 4
+
+def _message_bytes(message: BaseMessage) -> int:
+    content = message.content if isinstance(message.content, str) else json.dumps(message.content, ensure_ascii=False)
+    return len(content.encode("utf-8"))
+
+# --- 存储后端 ---
+
+class InMemoryHistoryStore:
+    """
+    进程内的会话历史存储：按最近使用顺序淘汰超出 max_sessions 的会话，并清理空闲超过 idle_ttl 的会话。
+    每条消息带有一个单调递增的序号，供摘要缓存记录“已总结到哪里”。
+    """
+
+    def __init__(self, max_sessions: int, idle_ttl: float, max_messages: int):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        # key: session_id, value: {"items": deque[(seq, message)], "last_active", "summary": (upto_seq, text)}
+        self._sessions = OrderedDict()
+        self._next_seq = 1
+        self.evicted = 0
+        self.expired = 0
 
-# 全局会话存储字典
-# Key: session_id (即微信的 from_user)
-# Value: BaseChatMessageHistory 对象
-_session_storage = {}
+    def _touch(self, session_id: str, create: bool):
+        now = time.time()
+        # OrderedDict 头部是最久未使用的会话，空闲过期只需从头部检查
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if now - oldest["last_active"] <= self.idle_ttl:
+                break
+            del self._sessions[oldest_id]
+            self.expired += 1
+        session = self._sessions.get(session_id)
+        if session is None:
+            if not create:
+                return None
+            session = self._sessions[session_id] = {
+                "items": deque(maxlen=self.max_messages), "last_active": now, "summary": None
+            }
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+        session["last_active"] = now
+        self._sessions.move_to_end(session_id)
+        return session
 
-class InMemoryChatMessageHistory(BaseChatMessageHistory):
+    def load(self, session_id: str):
+        with self._lock:
+            session = self._touch(session_id, create=False)
+            return list(session["items"]) if session else []
+
+    def append(self, session_id: str, messages):
+        with self._lock:
+            session = self._touch(session_id, create=True)
+            for message in messages:
+                session["items"].append((self._next_seq, message))
+                self._next_seq += 1
+
+    def clear(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def get_summary(self, session_id: str):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session["summary"] if session else None
+
+    def set_summary(self, session_id: str, upto_seq: int, text: str):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session:
+                session["summary"] = (upto_seq, text)
+
+    def stats(self) -> dict:
+        with self._lock:
+            sizes = [sum(_message_bytes(m) for _, m in s["items"]) for s in self._sessions.values()]
+            return {
+                "backend": "memory",
+                "sessions": len(sizes),
+                "session_bytes_avg": round(sum(sizes) / len(sizes), 1) if sizes else 0,
+                "session_bytes_max": max(sizes, default=0),
+                "evicted": self.evicted,
+                "expired": self.expired,
+            }
+
+class SQLiteHistoryStore:
     """
-    一个基于内存字典的聊天消息历史记录存储类。
-    用于在单个应用实例的生命周期内暂存对话历史。
+    基于 SQLite 文件的会话历史存储，多个工作进程可共享同一个文件（WAL 模式）。
+    消息的自增主键即为其序号。
     """
-    def __init__(self):
-        self.messages = []
+
+    # 每写入多少次清理一次空闲会话
+    _PURGE_EVERY = 200
+
+    def __init__(self, path: str, idle_ttl: float, max_messages: int):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.idle_ttl = idle_ttl
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, data TEXT, created_at REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, id)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, last_active REAL, summary_upto INTEGER, summary TEXT)"
+        )
+        self._db.commit()
+
+    def load(self, session_id: str):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, data FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, self.max_messages)
+            ).fetchall()
+        rows.reverse()
+        messages = messages_from_dict([json.loads(data) for _, data in rows])
+        return [(row[0], message) for row, message in zip(rows, messages)]
+
+    def append(self, session_id: str, messages):
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO messages (session_id, data, created_at) VALUES (?, ?, ?)",
+                [(session_id, json.dumps(message_to_dict(m), ensure_ascii=False), now) for m in messages]
+            )
+            self._db.execute(
+                "INSERT INTO sessions (session_id, last_active) VALUES (?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET last_active = excluded.last_active",
+                (session_id, now)
+            )
+            # 只保留每个会话最近的 max_messages 条消息
+            self._db.execute(
+                "DELETE FROM messages WHERE session_id = ? AND id <= ("
+                "SELECT id FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (session_id, session_id, self.max_messages)
+            )
+            self._writes += 1
+            if self._writes % self._PURGE_EVERY == 0:
+                self._purge_idle(now)
+            self._db.commit()
+
+    def _purge_idle(self, now: float):
+        cutoff = now - self.idle_ttl
+        self._db.execute(
+            "DELETE FROM messages WHERE session_id IN (SELECT session_id FROM sessions WHERE last_active < ?)",
+            (cutoff,)
+        )
+        self._db.execute("DELETE FROM sessions WHERE last_active < ?", (cutoff,))
+
+    def clear(self, session_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._db.commit()
+
+    def get_summary(self, session_id: str):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT summary_upto, summary FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return (row[0], row[1]) if row and row[1] is not None else None
+
+    def set_summary(self, session_id: str, upto_seq: int, text: str):
+        with self._lock:
+            self._db.execute(
+                "UPDATE sessions SET summary_upto = ?, summary = ? WHERE session_id = ?",
+                (upto_seq, text, session_id)
+            )
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            sizes = [row[0] for row in self._db.execute(
+                "SELECT SUM(LENGTH(CAST(data AS BLOB))) FROM messages GROUP BY session_id"
+            )]
+        return {
+            "backend": "sqlite",
+            "sessions": len(sizes),
+            "session_bytes_avg": round(sum(sizes) / len(sizes), 1) if sizes else 0,
+            "session_bytes_max": max(sizes, default=0),
+        }
+
+# --- 按 token 预算裁剪的历史视图 ---
+
+_SUMMARY_PROMPT = """请把下面这段对话压缩成一段不超过150字的中文摘要，保留用户关心的问题、已给出的关键结论和人物/事件名称。
+
+已有摘要:
+{previous}
+
+新增对话:
+{dialogue}
+
+摘要:"""
+
+def make_llm_summarizer(llm):
+    """用聊天模型生成对话摘要的函数：summarizer(previous_summary, messages) -> str。"""
+    def summarize(previous_summary: str, messages) -> str:
+        dialogue = "\n".join(f"{m.type}: {m.content}" for m in messages)
+        prompt = _SUMMARY_PROMPT.format(previous=previous_summary or "（无）", dialogue=dialogue)
+        return llm.invoke(prompt).content.strip()
+    return summarize
+
+class _PromptTokenStats:
+    def __init__(self, sample_size: int = 1000):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=sample_size)
+        self.trimmed = 0
+        self.summaries = 0
+
+    def record(self, tokens: int, trimmed: bool):
+        with self._lock:
+            self._samples.append(tokens)
+            if trimmed:
+                self.trimmed += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            samples = sorted(self._samples)
+            pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0
+            return {
+                "history_tokens_p50": pick(0.5),
+                "history_tokens_p95": pick(0.95),
+                "history_tokens_max": samples[-1] if samples else 0,
+                "trimmed_requests": self.trimmed,
+                "summaries_generated": self.summaries,
+            }
+
+class TrimmedSessionHistory(BaseChatMessageHistory):
+    """
+    会话历史的只读视图：messages 只返回最近的、总量不超过 token_budget 的若干条消息，
+    超出预算的旧消息在配置了 summarizer 时会被压缩成一条摘要放在最前面（摘要按会话缓存）。
+    写入（add_messages）总是追加到完整的存储中。
+    """
+
+    def __init__(self, store, session_id: str, token_budget: int, summarizer=None, stats=None):
+        self.store = store
+        self.session_id = session_id
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+        self.stats = stats
 
     @property
     def messages(self):
-        return self._messages
+        items = self.store.load(self.session_id)
+        summary = None
+        budget = self.token_budget
+        cached = self.store.get_summary(self.session_id) if self.summarizer else None
+        if cached:
+            budget -= estimate_tokens(cached[1])
+
+        # 从最新的消息往前累加，直到超出预算
+        kept = 0
+        used = 0
+        for _, message in reversed(items):
+            tokens = estimate_tokens(message.content)
+            if used + tokens > budget:
+                break
+            used += tokens
+            kept += 1
+        start = len(items) - kept
+        # 保证保留的历史从一条用户消息开始，避免孤立的 AI 回复
+        while start < len(items) and items[start][1].type != "human":
+            used -= estimate_tokens(items[start][1].content)
+            start += 1
+
+        overflow = items[:start]
+        if overflow and self.summarizer:
+            summary = self._summary(overflow, cached)
+        result = [message for _, message in items[start:]]
+        if summary:
+            used += estimate_tokens(summary)
+            # 新生成的摘要可能比缓存的旧摘要长，超出预算时再丢掉最早的一轮对话
+            while used > self.token_budget and len(result) > 2:
+                used -= estimate_tokens(result.pop(0).content) + estimate_tokens(result.pop(0).content)
+            result.insert(0, SystemMessage(content=f"此前对话摘要：{summary}"))
+        if self.stats is not None:
+            self.stats.record(used, trimmed=bool(overflow))
+        return result
 
-    @messages.setter
-    def messages(self, value: list[BaseMessage]) -> None:
-        self._messages = value
+    def _summary(self, overflow, cached):
+        last_seq = overflow[-1][0]
+        covered_seq, previous = cached if cached else (0, "")
+        pending = [message for seq, message in overflow if seq > covered_seq]
+        if len(pending) < HISTORY_SUMMARY_STEP:
+            return previous or None
+        try:
+            text = self.summarizer(previous, pending)
+        except Exception as e:
+            print(f"生成对话摘要失败: {e}")
+            return previous or None
+        self.store.set_summary(self.session_id, last_seq, text)
+        if self.stats is not None:
+            self.stats.summaries += 1
+        return text
 
     def add_messages(self, messages: list[BaseMessage]) -> None:
-        self.messages.extend(messages)
+        self.store.append(self.session_id, messages)
 
     def clear(self) -> None:
-        self.messages = []
+        self.store.clear(self.session_id)
 
-def get_session_history(session_id: str) -> InMemoryChatMessageHistory:
+# --- 全局入口 ---
+
+_store = None
+_store_lock = threading.Lock()
+_summarizer = None
+_prompt_stats = _PromptTokenStats()
+
+def get_history_store():
+    """获取进程内共享的历史存储后端，首次调用时按配置创建。"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if HISTORY_BACKEND == "sqlite":
+                    _store = SQLiteHistoryStore(HISTORY_SQLITE_PATH, HISTORY_IDLE_TTL, HISTORY_MAX_MESSAGES)
+                else:
+                    _store = InMemoryHistoryStore(HISTORY_MAX_SESSIONS, HISTORY_IDLE_TTL, HISTORY_MAX_MESSAGES)
+    return _store
+
+def set_history_summarizer(summarizer):
+    """设置超出预算的旧消息的摘要函数（例如 make_llm_summarizer(llm)），传入 None 则直接丢弃旧消息。"""
+    global _summarizer
+    _summarizer = summarizer
+
+def get_session_history(session_id: str) -> TrimmedSessionHistory:
     """
     根据 session_id 获取用户的对话历史。
-    如果不存在，则创建一个新的。
+    返回的视图只包含符合 token 预算的最近消息，新消息会写入共享的历史存储。
     """
-    if session_id not in _session_storage:
-        _session_storage[session_id] = InMemoryChatMessageHistory()
-    return _session_storage[session_id]
+    return TrimmedSessionHistory(
+        get_history_store(), session_id, HISTORY_TOKEN_BUDGET, summarizer=_summarizer, stats=_prompt_stats
+    )
+
+def history_stats() -> dict:
+    """返回会话数量、每个会话占用的字节数以及历史 token 数分布。"""
+    stats = get_history_store().stats()
+    stats.update(_prompt_stats.snapshot())
+    stats["token_budget"] = HISTORY_TOKEN_BUDGET
+    return stats
@@ -0,0 +1,333 @@
+"""
+多索引注册表与检索配置。
+
+- IndexRegistry：按名称登记多个向量索引（整本书、角色档案、百科……），首次使用时才加载，
+  加载后在所有链之间共享；每个索引目录下若有倒排索引则同时加载，用于混合检索；
+- RetrievalProfile：一种对话模式的检索配置（使用哪些索引、返回几个文档块、是否混合检索、元数据过滤、上下文预算）；
+  索引目录下有元数据过滤索引（src/metadata_index.py）时在检索前过滤，否则多取候选后在检索后过滤；
+- IndexRegistry.search：在 profile 的各个索引上并行检索，再按分数合并。FAISS 和 numpy 检索时会释放 GIL，
+  多个索引的耗时取决于最慢的一个，而不是逐个相加。
+
+分数合并：所有索引的结果类型相同时（都是混合检索的 RRF 分数，或都是同一度量下的向量相似度）直接按分数排序；
+类型不同时按各索引内的排名做倒数排名融合。所有索引必须使用同一个 Embedding 模型构建。
+
+索引通过环境变量登记（默认索引由 RAG_VECTOR_STORE_PATH 指定，名称为 three_body）：
+    RAG_INDEXES="characters=vector_store/faiss_index_characters,wiki=vector_store/faiss_index_wiki"
+检索配置可以用 JSON 覆盖部分字段：
+    RAG_RETRIEVAL_PROFILES='{"decision": {"indexes": ["three_body", "wiki"], "k": 6}}'
+"""
+import os
+import json
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from src.metadata_index import MetadataIndex, has_metadata_index
+from src.lexical_index import (
+    LexicalIndex,
+    dense_search_with_scores,
+    documents_at,
+    has_lexical_index,
+    hybrid_search_with_scores,
+)
+from src.tracing import span
+
+# 没有元数据过滤索引时，每个索引先多取这么多倍的候选再过滤
+FILTER_OVERSAMPLE = 4
+
+def parse_index_paths(spec: str) -> OrderedDict:
+    """解析 "name=path,name2=path2" 形式的索引登记字符串。"""
+    paths = OrderedDict()
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, sep, path = item.partition("=")
+        if not sep or not name.strip() or not path.strip():
+            print(f"忽略无法解析的索引配置: {item!r}（格式为 name=path）")
+            continue
+        paths[name.strip()] = path.strip()
+    return paths
+
+class RetrievalProfile:
+    """
+    一种对话模式的检索配置。
+    indexes 为按优先级排列的索引名称，未登记的索引会被跳过；filter 为元数据过滤条件，
+    例如 {"characters": "叶文洁"} 或 {"part": ["第一部", "第二部"]}（多个条件同时满足，列表中满足其一即可）。
+    过滤后没有任何结果时，fallback=True 会退回不过滤的检索。
+    """
+
+    def __init__(self, name: str, indexes, k: int, candidates: int = 20, hybrid: bool = True,
+                 filter: dict = None, context_tokens: int = None, fallback: bool = True):
+        self.name = name
+        self.indexes = tuple(indexes)
+        self.k = k
+        self.candidates = candidates
+        self.hybrid = hybrid
+        self.filter = dict(filter) if filter else None
+        self.context_tokens = context_tokens
+        self.fallback = fallback
+
+    def with_overrides(self, **overrides) -> "RetrievalProfile":
+        fields = {
+            "name": self.name, "indexes": self.indexes, "k": self.k, "candidates": self.candidates,
+            "hybrid": self.hybrid, "filter": self.filter, "context_tokens": self.context_tokens,
+            "fallback": self.fallback,
+        }
+        fields.update(overrides)
+        return RetrievalProfile(**fields)
+
+    def cache_key(self) -> tuple:
+        """用于已编译链的缓存键：字段完全相同的配置共享同一条链。"""
+        filter_key = tuple(sorted((key, repr(value)) for key, value in self.filter.items())) if self.filter else None
+        return (self.name, self.indexes, self.k, self.candidates, self.hybrid, filter_key, self.context_tokens,
+                self.fallback)
+
+    def matches(self, doc) -> bool:
+        if not self.filter:
+            return True
+        metadata = doc.metadata or {}
+        for key, expected in self.filter.items():
+            expected = expected if isinstance(expected, (list, tuple, set, frozenset)) else [expected]
+            value = metadata.get(key)
+            # 列表类型的元数据（如 characters）与期望值有交集即可
+            values = value if isinstance(value, list) else [value]
+            if not any(v in expected for v in values):
+                return False
+        return True
+
+    def __repr__(self):
+        return f"RetrievalProfile({self.name!r}, indexes={list(self.indexes)}, k={self.k})"
+
+def load_profile_overrides(profiles: dict, spec: str) -> dict:
+    """用 JSON 字符串覆盖检索配置的部分字段，也可以新增配置；解析失败时保留原配置。"""
+    if not spec:
+        return profiles
+    try:
+        overrides = json.loads(spec)
+    except ValueError as e:
+        print(f"无法解析 RAG_RETRIEVAL_PROFILES: {e}")
+        return profiles
+    result = dict(profiles)
+    for name, fields in overrides.items():
+        base = result.get(name) or result["qa"].with_overrides(name=name)
+        try:
+            result[name] = base.with_overrides(**fields)
+        except TypeError as e:
+            print(f"检索配置 {name} 中有未知字段: {e}")
+    return result
+
+class SearchIndex:
+    """一个已加载的索引：向量数据库加上可选的倒排索引和元数据过滤索引。"""
+
+    def __init__(self, name: str, path: str, vector_store, lexical_index=None, metadata_index=None):
+        self.name = name
+        self.path = path
+        self.vector_store = vector_store
+        self.lexical_index = lexical_index
+        self.metadata_index = metadata_index
+        self.searches = 0
+        self.prefiltered = 0
+
+    def __len__(self):
+        return self.vector_store.index.ntotal
+
+    def search(self, question: str, question_vector, k: int, candidates: int, rrf_k: int,
+               hybrid: bool = True, profile: RetrievalProfile = None, use_filter: bool = True):
+        """返回 (分数类型, [(文档块, 分数)])，分数越大越相关。"""
+        self.searches += 1
+        import faiss
+        kind = "ip" if self.vector_store.index.metric_type == faiss.METRIC_INNER_PRODUCT else "l2"
+        if hybrid and self.lexical_index is not None:
+            kind = "rrf"
+        conditions = profile.filter if profile is not None and use_filter else None
+        selection = None
+        post_filter = False
+        if conditions:
+            selection = self.metadata_index.select(conditions) if self.metadata_index is not None else None
+            if selection is not None:
+                self.prefiltered += 1
+                if not len(selection):
+                    return kind, []
+            else:
+                post_filter = True
+        fetch_k = k * FILTER_OVERSAMPLE if post_filter else k
+
+        if kind == "rrf":
+            hits = hybrid_search_with_scores(
+                self.vector_store, self.lexical_index, question, question_vector,
+                k=fetch_k, candidates=max(candidates, fetch_k), rrf_k=rrf_k, selection=selection
+            )
+        else:
+            hits = dense_search_with_scores(self.vector_store, question_vector, fetch_k, selection)
+        docs = documents_at(self.vector_store, [position for position, _ in hits])
+        results = [(doc, score) for doc, (_, score) in zip(docs, hits)]
+        if post_filter:
+            results = [(doc, score) for doc, score in results if profile.matches(doc)]
+        return kind, results[:k]
+
+def merge_by_score(results, k: int, rrf_k: int = 60) -> list:
+    """合并多个索引的 (分数类型, [(文档块, 分数)]) 结果，返回前 k 个文档块。"""
+    kinds = {kind for kind, hits in results if hits}
+    if len(kinds) <= 1:
+        merged = [hit for _, hits in results for hit in hits]
+    else:
+        # 分数尺度不同，无法直接比较：按各索引内的排名做倒数排名融合
+        merged = [(doc, 1.0 / (rrf_k + rank)) for _, hits in results for rank, (doc, _) in enumerate(hits, start=1)]
+    merged.sort(key=lambda hit: hit[1], reverse=True)
+    return [doc for doc, _ in merged[:k]]
+
+class IndexRegistry:
+    """
+    按名称登记的索引集合，索引在首次使用时加载（每个索引一把锁，不同索引可以同时加载）。
+    加载失败的索引会被记录并在之后的检索中跳过；只有 profile 中所有索引都不可用时检索才会失败。
+    """
+
+    def __init__(self, load_vector_store, hybrid: bool = True, max_workers: int = 4):
+        self._load_vector_store = load_vector_store
+        self.hybrid = hybrid
+        self.max_workers = max_workers
+        self._paths = OrderedDict()
+        self._indexes = {}
+        self._errors = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        _registries.add(self)
+
+    def register(self, name: str, path: str):
+        with self._lock:
+            self._paths[name] = path
+            self._locks.setdefault(name, threading.Lock())
+            self._indexes.pop(name, None)
+            self._errors.pop(name, None)
+
+    def names(self) -> list:
+        with self._lock:
+            return list(self._paths)
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._indexes
+
+    def get(self, name: str) -> SearchIndex:
+        """返回已加载的索引，首次调用时加载；未登记时抛出 KeyError，加载失败时抛出原异常。"""
+        index = self._indexes.get(name)
+        if index is not None:
+            return index
+        with self._lock:
+            if name not in self._paths:
+                raise KeyError(f"未登记的索引: {name}")
+            path, lock = self._paths[name], self._locks[name]
+        with lock:
+            index = self._indexes.get(name)
+            if index is None:
+                try:
+                    index = self._load(name, path)
+                except Exception as e:
+                    self._errors[name] = f"{type(e).__name__}: {e}"
+                    raise
+                self._errors.pop(name, None)
+                self._indexes[name] = index
+        return index
+
+    def _load(self, name: str, path: str) -> SearchIndex:
+        print(f"正在加载向量数据库 [{name}]: {path}")
+        vector_store = self._load_vector_store(path)
+        lexical_index = None
+        if self.hybrid:
+            if has_lexical_index(path):
+                print(f"正在加载倒排索引 [{name}]: {path}")
+                lexical_index = LexicalIndex.load(path)
+                vector_count = vector_store.index.ntotal
+                if len(lexical_index) != vector_count:
+                    print(f"倒排索引文档数 ({len(lexical_index)}) 与向量数 ({vector_count}) 不一致，"
+                          f"[{name}] 只使用向量检索。请运行 src/lexical_index.py build 重建。")
+                    lexical_index = None
+            else:
+                print(f"[{name}] 未找到倒排索引，只使用向量检索。")
+        metadata_index = None
+        if has_metadata_index(path):
+            metadata_index = MetadataIndex.load(path)
+            if len(metadata_index) != vector_store.index.ntotal:
+                print(f"元数据过滤索引文档数 ({len(metadata_index)}) 与向量数 ({vector_store.index.ntotal}) 不一致，"
+                      f"[{name}] 改为检索后过滤。请运行 src/metadata_index.py build 重建。")
+                metadata_index = None
+        return SearchIndex(name, path, vector_store, lexical_index, metadata_index)
+
+    def resolve(self, profile: RetrievalProfile) -> list:
+        """profile 中已登记且没有加载失败的索引名称。"""
+        with self._lock:
+            return [name for name in profile.indexes if name in self._paths and name not in self._errors]
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="index-search")
+        return self._executor
+
+    def _search_one(self, name: str, question: str, question_vector, k: int, rrf_k: int,
+                    profile: RetrievalProfile, use_filter: bool = True):
+        with span("search_index", index=name):
+            index = self.get(name)
+            return index.search(question, question_vector, k, profile.candidates, rrf_k,
+                                hybrid=self.hybrid and profile.hybrid, profile=profile, use_filter=use_filter)
+
+    def search(self, profile: RetrievalProfile, question: str, question_vector, k: int = None,
+               rrf_k: int = 60) -> list:
+        """在 profile 的各个索引上并行检索并按分数合并，返回前 k 个文档块（默认 profile.k）。"""
+        k = k or profile.k
+        names = self.resolve(profile)
+        if not names:
+            raise RuntimeError(f"检索配置 {profile.name} 没有可用的索引（{', '.join(profile.indexes)}）")
+        docs = self._fan_out(names, (question, question_vector, k, rrf_k, profile))
+        if not docs and profile.filter and profile.fallback:
+            print(f"检索配置 {profile.name} 过滤后没有结果，退回不过滤的检索。")
+            docs = self._fan_out(names, (question, question_vector, k, rrf_k, profile, False))
+        return docs
+
+    def _fan_out(self, names, args) -> list:
+        k, rrf_k = args[2], args[3]
+        if len(names) == 1:
+            return merge_by_score([self._search_one(names[0], *args)], k, rrf_k)
+
+        # 子任务在复制的上下文中执行，span 仍记录到当前请求的追踪中
+        executor = self._get_executor()
+        futures = [(name, executor.submit(copy_context().run, self._search_one, name, *args)) for name in names]
+        results, failures = [], []
+        for name, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"索引 [{name}] 检索失败，已跳过: {e}")
+                failures.append(e)
+        if not results:
+            raise failures[0]
+        return merge_by_score(results, k, rrf_k)
+
+    def stats(self) -> dict:
+        with self._lock:
+            names = list(self._paths)
+        result = {}
+        for name in names:
+            index = self._indexes.get(name)
+            entry = {"loaded": index is not None}
+            if index is not None:
+                entry.update({"vectors": len(index), "hybrid": index.lexical_index is not None,
+                              "prefilter": index.metadata_index is not None,
+                              "searches": index.searches, "prefiltered": index.prefiltered})
+            if name in self._errors:
+                entry["error"] = self._errors[name]
+            result[name] = entry
+        return result
+
+# fork 出的子进程中没有父进程的检索线程，需要重新创建线程池（已加载的索引保留，以写时复制方式共享）
+_registries = weakref.WeakSet()
+
+def _reset_executors_after_fork():
+    for registry in list(_registries):
+        registry._executor = None
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_executors_after_fork)
@@ -0,0 +1,304 @@
+"""
+基于中文字符二元组（bigram）的 BM25 倒排索引，用于补足 m3e 向量检索对专有名词（如“红岸”“ETO”“古筝行动”）不敏感的问题。
+
+磁盘格式（与 index.faiss 位于同一目录，文档编号与 FAISS 向量位置一一对应）：
+- lexical.terms:        每行一个词项，行号即词项 ID
+- lexical.offsets.npy:  int64 数组，长度为词项数 + 1，词项 t 的倒排表为 [offsets[t], offsets[t+1])
+- lexical.docs.npy:     int32 数组，所有倒排表依次拼接的文档编号
+- lexical.tfs.npy:      uint16 数组，与 lexical.docs.npy 对应的词频
+- lexical.doclen.npy:   int32 数组，每个文档的词项数
+
+倒排表以 mmap 方式加载，多个进程共享页缓存；查询时只读取问题中出现的几个词项的倒排表。
+
+用法：
+    python src/lexical_index.py build --index-path vector_store/faiss_index_three_body_full
+    python src/lexical_index.py benchmark --index-path vector_store/faiss_index_three_body_full
+"""
+import os
+import sys
+# 将项目根目录添加到 sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import math
+import re
+import time
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+TERMS_FILE = "lexical.terms"
+OFFSETS_FILE = "lexical.offsets.npy"
+DOCS_FILE = "lexical.docs.npy"
+TFS_FILE = "lexical.tfs.npy"
+DOCLEN_FILE = "lexical.doclen.npy"
+
+# 英文/数字按整词切分，中日韩字符按相邻二元组切分
+_TOKEN_RE = re.compile(r"[a-z0-9]+|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+
+def tokenize(text: str) -> list:
+    """把文本切分成词项：英文单词、数字整体保留，连续汉字拆成字符二元组（单个汉字保留为一元组）。"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    terms = []
+    for run in _TOKEN_RE.findall(text):
+        if run.isascii() or len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+def has_lexical_index(index_path: str) -> bool:
+    """判断索引目录下是否已有倒排索引。"""
+    names = (TERMS_FILE, OFFSETS_FILE, DOCS_FILE, TFS_FILE, DOCLEN_FILE)
+    return all(os.path.exists(os.path.join(index_path, name)) for name in names)
+
+class LexicalIndex:
+    """数组存储倒排表的 BM25 索引，文档编号即 FAISS 向量位置。"""
+
+    def __init__(self, terms, offsets, docs, tfs, doc_lengths, k1: float = 1.2, b: float = 0.75):
+        self.terms = terms
+        self._term_ids = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.avg_doc_length = float(np.mean(doc_lengths)) if len(doc_lengths) else 0.0
+        # BM25 分母中与词频无关的部分，每个文档预先计算一次
+        self._length_norm = (k1 * (1 - b + b * np.asarray(doc_lengths, dtype=np.float32)
+                                   / max(self.avg_doc_length, 1.0))).astype(np.float32)
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, texts, **params):
+        """从按向量位置排列的文档正文构建索引。"""
+        term_ids = {}
+        rows_term, rows_doc, rows_tf = [], [], []
+        doc_lengths = np.zeros(len(texts), dtype=np.int32)
+        for doc_no, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lengths[doc_no] = sum(counts.values())
+            for term, tf in counts.items():
+                rows_term.append(term_ids.setdefault(term, len(term_ids)))
+                rows_doc.append(doc_no)
+                rows_tf.append(min(tf, 65535))
+
+        rows_term = np.asarray(rows_term, dtype=np.int64)
+        # 稳定排序保证同一词项的倒排表内文档编号递增
+        order = np.argsort(rows_term, kind="stable")
+        offsets = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows_term, minlength=len(term_ids)), out=offsets[1:])
+        docs = np.asarray(rows_doc, dtype=np.int32)[order]
+        tfs = np.asarray(rows_tf, dtype=np.uint16)[order]
+        terms = [None] * len(term_ids)
+        for term, i in term_ids.items():
+            terms[i] = term
+        return cls(terms, offsets, docs, tfs, doc_lengths, **params)
+
+    def save(self, index_path: str):
+        """写入索引目录，先写临时文件再原子替换。"""
+        os.makedirs(index_path, exist_ok=True)
+        arrays = {OFFSETS_FILE: self.offsets, DOCS_FILE: self.docs, TFS_FILE: self.tfs, DOCLEN_FILE: self.doc_lengths}
+        written = []
+        for name, array in arrays.items():
+            tmp = os.path.join(index_path, name.replace(".npy", ".tmp.npy"))
+            np.save(tmp, np.asarray(array))
+            written.append((tmp, os.path.join(index_path, name)))
+        terms_tmp = os.path.join(index_path, TERMS_FILE + ".tmp")
+        with open(terms_tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(self.terms))
+        written.append((terms_tmp, os.path.join(index_path, TERMS_FILE)))
+        for tmp, final in written:
+            os.replace(tmp, final)
+
+    @classmethod
+    def load(cls, index_path: str, **params):
+        """以 mmap 方式加载倒排表。"""
+        with open(os.path.join(index_path, TERMS_FILE), encoding="utf-8") as f:
+            content = f.read()
+        terms = content.split("\n") if content else []
+        arrays = [np.load(os.path.join(index_path, name), mmap_mode="r")
+                  for name in (OFFSETS_FILE, DOCS_FILE, TFS_FILE, DOCLEN_FILE)]
+        return cls(terms, *arrays, **params)
+
+    def search(self, query: str, k: int = 20, allowed=None) -> list:
+        """
+        返回 BM25 得分最高的 k 个 (文档编号, 得分)，没有任何词项命中时返回空列表。
+        allowed 为按文档编号排列的布尔掩码时，只在允许的文档中取结果。
+        """
+        n = len(self)
+        if n == 0:
+            return []
+        scores = None
+        for term, qtf in Counter(tokenize(query)).items():
+            term_id = self._term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+            docs = self.docs[start:end]
+            tfs = self.tfs[start:end].astype(np.float32)
+            idf = math.log(1 + (n - (end - start) + 0.5) / ((end - start) + 0.5))
+            if scores is None:
+                scores = np.zeros(n, dtype=np.float32)
+            scores[docs] += qtf * idf * tfs * (self.k1 + 1) / (tfs + self._length_norm[docs])
+        if scores is None:
+            return []
+        if allowed is not None:
+            scores[~allowed] = 0
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(int(i), float(scores[i])) for i in hits]
+
+def build_lexical_index(vector_store, index_path: str) -> LexicalIndex:
+    """按 FAISS 向量位置顺序读取 docstore 中的正文，构建并保存倒排索引。"""
+    start = time.perf_counter()
+    mapping = vector_store.index_to_docstore_id
+    texts = [vector_store.docstore.search(mapping[i]).page_content for i in range(len(mapping))]
+    index = LexicalIndex.build(texts)
+    index.save(index_path)
+    size = sum(os.path.getsize(os.path.join(index_path, name))
+               for name in (TERMS_FILE, OFFSETS_FILE, DOCS_FILE, TFS_FILE, DOCLEN_FILE))
+    print(f"倒排索引已保存到 {index_path}：{len(index)} 个文档，{len(index.terms)} 个词项，"
+          f"{len(index.docs)} 条倒排记录，{size / 1024 / 1024:.1f} MB，用时 {time.perf_counter() - start:.1f} 秒。")
+    return index
+
+# --- 混合检索 ---
+
+def reciprocal_rank_fusion_scores(rankings, rrf_k: int = 60) -> list:
+    """倒数排名融合：每个结果列表中排第 r 名的文档得 1 / (rrf_k + r) 分，返回按总分排序的 (文档编号, 分数)。"""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_no in enumerate(ranking, start=1):
+            scores[doc_no] = scores.get(doc_no, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+def reciprocal_rank_fusion(rankings, rrf_k: int = 60) -> list:
+    """倒数排名融合，只返回按总分排序的文档编号。"""
+    return [doc_no for doc_no, _ in reciprocal_rank_fusion_scores(rankings, rrf_k)]
+
+def dense_search_with_scores(vector_store, query_vector, k: int, selection=None) -> list:
+    """
+    直接在 FAISS 索引上检索，返回 (向量位置, 相似度分数)，分数越大越相关：
+    内积索引直接使用内积，L2 索引使用负的距离，同一 Embedding 模型构建的索引之间分数可以比较。
+    selection（src/metadata_index.Selection）不为空时只在其中的向量上检索。
+    """
+    import faiss
+    vector = np.asarray([query_vector], dtype=np.float32)
+    if getattr(vector_store, "_normalize_L2", False):
+        faiss.normalize_L2(vector)
+    if selection is not None:
+        from src.faiss_index import filtered_search_params
+        params = filtered_search_params(vector_store.index, selection.selector())
+        distances, positions = vector_store.index.search(vector, k, params=params)
+    else:
+        distances, positions = vector_store.index.search(vector, k)
+    sign = 1.0 if vector_store.index.metric_type == faiss.METRIC_INNER_PRODUCT else -1.0
+    return [(int(p), sign * float(d)) for p, d in zip(positions[0], distances[0]) if p >= 0]
+
+def dense_search_positions(vector_store, query_vector, k: int) -> list:
+    """直接在 FAISS 索引上检索，返回向量位置列表（与 similarity_search_by_vector 的排序一致）。"""
+    return [position for position, _ in dense_search_with_scores(vector_store, query_vector, k)]
+
+def documents_at(vector_store, positions) -> list:
+    """按向量位置取出文档块，mmap 文档块存储可直接按位置读取。"""
+    docstore = vector_store.docstore
+    if hasattr(docstore, "get_by_position"):
+        return [docstore.get_by_position(p) for p in positions]
+    mapping = vector_store.index_to_docstore_id
+    return [docstore.search(mapping[p]) for p in positions]
+
+def hybrid_search_with_scores(vector_store, lexical_index, query: str, query_vector, k: int = 3,
+                              candidates: int = 20, rrf_k: int = 60, selection=None) -> list:
+    """
+    向量检索与 BM25 各取 candidates 个候选，倒数排名融合后返回前 k 个 (向量位置, RRF 分数)。
+    selection 不为空时两路检索都只在其中的文档块上进行。
+    """
+    dense = [p for p, _ in dense_search_with_scores(vector_store, query_vector, candidates, selection)]
+    allowed = selection.mask() if selection is not None else None
+    lexical = [doc_no for doc_no, _ in lexical_index.search(query, candidates, allowed)]
+    return reciprocal_rank_fusion_scores([dense, lexical], rrf_k)[:k]
+
+def hybrid_search(vector_store, lexical_index, query: str, query_vector, k: int = 3,
+                  candidates: int = 20, rrf_k: int = 60) -> list:
+    """向量检索与 BM25 各取 candidates 个候选，用倒数排名融合后返回前 k 个文档块。"""
+    fused = hybrid_search_with_scores(vector_store, lexical_index, query, query_vector, k, candidates, rrf_k)
+    return documents_at(vector_store, [doc_no for doc_no, _ in fused])
+
+# --- 基准测试 ---
+
+# 固定问题集：(问题, 正确上下文中必须出现的关键词)
+BENCHMARK_QUESTIONS = [
+    ("红岸基地是做什么的？", "红岸"),
+    ("ETO 的目标是什么？", "ETO"),
+    ("古筝行动是怎么执行的？", "古筝"),
+    ("智子是什么？", "智子"),
+    ("叶文洁为什么要回复三体文明？", "叶文洁"),
+    ("汪淼看到的倒计时是怎么回事？", "倒计时"),
+    ("史强是个什么样的人？", "史强"),
+    ("三体世界为什么会有乱纪元？", "乱纪元"),
+    ("射手和农场主假说讲的是什么？", "农场主"),
+    ("科学边界是一个什么组织？", "科学边界"),
+    ("魏成研究三体问题有什么进展？", "魏成"),
+    ("降临派和拯救派有什么区别？", "降临派"),
+]
+
+def run_benchmark(index_path: str, embedding_model_name: str, k: int = 3, candidates: int = 20,
+                  rrf_k: int = 60, repeat: int = 5):
+    """比较纯向量检索与混合检索在固定问题集上的 hit@k 和单次检索延迟（问题向量预先计算）。"""
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    from src.chunk_store import load_vector_store
+
+    embeddings = HuggingFaceEmbeddings(model_name=embedding_model_name)
+    vector_store = load_vector_store(index_path, embeddings)
+    lexical_index = LexicalIndex.load(index_path)
+    questions = [q for q, _ in BENCHMARK_QUESTIONS]
+    vectors = embeddings.embed_documents(questions)
+
+    methods = {
+        "dense": lambda q, v: vector_store.similarity_search_by_vector(v, k=k),
+        "hybrid": lambda q, v: hybrid_search(vector_store, lexical_index, q, v, k, candidates, rrf_k),
+    }
+    print(f"{'问题':<22}{'关键词':<8}" + "".join(f"{name:>10}" for name in methods))
+    hits = {name: 0 for name in methods}
+    latencies = {name: [] for name in methods}
+    for (question, keyword), vector in zip(BENCHMARK_QUESTIONS, vectors):
+        row = f"{question:<22}{keyword:<8}"
+        for name, search in methods.items():
+            for _ in range(repeat):
+                start = time.perf_counter()
+                docs = search(question, vector)
+                latencies[name].append(time.perf_counter() - start)
+            hit = any(keyword.lower() in unicodedata.normalize("NFKC", d.page_content).lower() for d in docs)
+            hits[name] += hit
+            row += f"{'命中' if hit else '-':>10}"
+        print(row)
+
+    print(f"\n===== 检索基准（k={k}，候选数 {candidates}，RRF k={rrf_k}）=====")
+    for name in methods:
+        values = sorted(latencies[name])
+        print(f"{name:>7}: hit@{k} {hits[name]}/{len(BENCHMARK_QUESTIONS)}，"
+              f"延迟 p50 {values[len(values) // 2] * 1000:.2f} ms，"
+              f"p95 {values[min(len(values) - 1, int(0.95 * len(values)))] * 1000:.2f} ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="字符二元组 BM25 倒排索引的构建与基准测试工具")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--index-path", default='vector_store/faiss_index_three_body_full')
+    parser.add_argument("--model", default='moka-ai/m3e-base')
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--candidates", type=int, default=20)
+    parser.add_argument("--rrf-k", type=int, default=60)
+    parsed = parser.parse_args()
+
+    if parsed.command == "build":
+        # 只需要 docstore，不加载 Embedding 模型
+        from src.chunk_store import load_vector_store
+        build_lexical_index(load_vector_store(parsed.index_path, None), parsed.index_path)
+    else:
+        run_benchmark(parsed.index_path, parsed.model, parsed.k, parsed.candidates, parsed.rrf_k)
@@ -0,0 +1,627 @@
+"""
+LLM 服务网关：进程内共享的 DeepSeek / 智谱 GLM 客户端，统一管理连接、并发、超时、对冲请求和熔断。
+
+- 每个服务（Provider）持有一个长期存在的客户端，底层 httpx 连接池复用 TCP/TLS 连接；
+  两家都通过 OpenAI 兼容接口调用，可以用本地桩服务（src/stub_servers.StubLLMServer）测试；
+- 每个服务有并发上限（等待名额超过 LLM_QUEUE_TIMEOUT 秒视为繁忙，直接换下一个服务）和请求超时；
+- 对冲请求：主服务在其首字延迟的 p95 内还没有返回第一个 token 时，向下一个服务再发一次同样的请求，
+  谁先返回第一个 token 就用谁的回答，另一个请求被取消；主服务出错时立即切换到下一个服务；
+- 熔断：连续失败 LLM_BREAKER_FAILURES 次后暂停使用该服务 LLM_BREAKER_COOLDOWN 秒，
+  之后放行一个试探请求，成功则恢复；
+- stats()：每个服务的请求数、失败/超时/繁忙次数、对冲次数与胜出次数、首字延迟和总耗时分位数、熔断状态。
+
+GatewayChatModel 把网关包装成 LangChain 聊天模型，可以直接放进 RAG 链（支持流式与异步）。
+回答一旦开始输出就不再切换服务，输出中途出错时异常照常抛给调用方。
+
+用本地桩服务演示对冲和熔断（主服务 3% 的请求首字延迟多 3 秒，20% 直接失败）：
+    python src/llm_gateway.py --requests 200 --slow-rate 0.03 --failure-rate 0.2
+"""
+import os
+import sys
+# 将项目根目录添加到 sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from pydantic import ConfigDict
+from langchain_core.language_models.chat_models import BaseChatModel, agenerate_from_stream, generate_from_stream
+
+# 服务调用顺序：第一个为主服务，其余依次作为对冲/备用服务
+LLM_PROVIDERS = [name.strip() for name in os.getenv("LLM_PROVIDERS", "deepseek,zhipu").split(",") if name.strip()]
+# 对冲请求：LLM_HEDGING=0 关闭；主服务首字延迟样本不足 LLM_HEDGE_MIN_SAMPLES 个时使用 LLM_HEDGE_DELAY_MS
+LLM_HEDGING = os.getenv("LLM_HEDGING", "1") == "1"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+LLM_HEDGE_DELAY_MS = float(os.getenv("LLM_HEDGE_DELAY_MS", "3000"))
+LLM_HEDGE_MIN_DELAY_MS = float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "300"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+# 熔断：连续失败次数和冷却时间（秒）
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+# 等待并发名额的最长时间（秒）、建立连接的超时（秒）和客户端自身的重试次数
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "5"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "1"))
+
+DEEPSEEK_MAX_CONCURRENCY = int(os.getenv("LLM_DEEPSEEK_MAX_CONCURRENCY", "16"))
+DEEPSEEK_TIMEOUT = float(os.getenv("LLM_DEEPSEEK_TIMEOUT", "60"))
+ZHIPU_API_BASE = os.getenv("ZHIPUAI_API_BASE", "https://open.bigmodel.cn/api/paas/v4/")
+ZHIPU_MAX_CONCURRENCY = int(os.getenv("LLM_ZHIPU_MAX_CONCURRENCY", "8"))
+ZHIPU_TIMEOUT = float(os.getenv("LLM_ZHIPU_TIMEOUT", "60"))
+
+_DONE = object()
+
+def _percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+class ProviderBusy(Exception):
+    """服务的并发名额在等待时间内没有空出来。"""
+
+class CircuitBreaker:
+    """连续失败达到阈值后打开，冷却结束后放行一个试探请求（半开），试探成功则关闭。"""
+
+    def __init__(self, failure_threshold: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self._opened_at >= self.cooldown else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self.opened += 1
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def release_probe(self):
+        """试探请求被取消（既没有成功也没有失败）时，允许下一个请求继续试探。"""
+        with self._lock:
+            self._probing = False
+
+class Provider:
+    """一个 LLM 服务：共享的 LangChain 聊天模型、并发名额、熔断器和延迟统计。"""
+
+    def __init__(self, name: str, llm, max_concurrency: int, breaker: CircuitBreaker = None, sample_size: int = 500):
+        self.name = name
+        self.llm = llm
+        self.max_concurrency = max_concurrency
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._first_token = deque(maxlen=sample_size)
+        self._total = deque(maxlen=sample_size)
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.last_error = None
+
+    # --- 并发名额 ---
+
+    def acquire(self, timeout: float) -> bool:
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+        return True
+
+    async def aacquire(self, timeout: float) -> bool:
+        """异步版本：轮询空闲名额，不阻塞事件循环；被取消时不会占用名额。"""
+        deadline = time.monotonic() + timeout
+        while not self._slots.acquire(blocking=False):
+            if time.monotonic() >= deadline:
+                with self._lock:
+                    self.rejected += 1
+                return False
+            await asyncio.sleep(0.01)
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    # --- 结果记录 ---
+
+    def record_first_token(self, seconds: float):
+        with self._lock:
+            self._first_token.append(seconds)
+        # 已经开始返回内容说明服务可用（即使随后作为对冲的落选方被取消）
+        self.breaker.record_success()
+
+    def record_success(self, seconds: float):
+        with self._lock:
+            self._total.append(seconds)
+        self.breaker.record_success()
+
+    def record_failure(self, error: Exception):
+        with self._lock:
+            self.errors += 1
+            if "timeout" in type(error).__name__.lower():
+                self.timeouts += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+        self.breaker.record_failure()
+
+    def record_cancelled(self):
+        with self._lock:
+            self.cancelled += 1
+        self.breaker.release_probe()
+
+    def hedge_delay(self) -> float:
+        """对冲延迟（秒）：最近首字延迟的 p95，样本不足时使用 LLM_HEDGE_DELAY_MS。"""
+        with self._lock:
+            samples = list(self._first_token)
+        if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return LLM_HEDGE_DELAY_MS / 1000
+        return max(_percentile(samples, LLM_HEDGE_QUANTILE), LLM_HEDGE_MIN_DELAY_MS / 1000)
+
+    def stats(self) -> dict:
+        with self._lock:
+            first_token = list(self._first_token)
+            total = list(self._total)
+            result = {
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "requests": self.requests,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "cancelled": self.cancelled,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "last_error": self.last_error,
+            }
+        result.update({
+            "breaker": self.breaker.state,
+            "breaker_opened": self.breaker.opened,
+            "first_token_p50_ms": round(_percentile(first_token, 0.5) * 1000, 1),
+            "first_token_p95_ms": round(_percentile(first_token, 0.95) * 1000, 1),
+            "total_p50_ms": round(_percentile(total, 0.5) * 1000, 1),
+            "total_p95_ms": round(_percentile(total, 0.95) * 1000, 1),
+            "hedge_delay_ms": round(self.hedge_delay() * 1000, 1),
+        })
+        return result
+
+class LLMGateway:
+    """按顺序使用多个服务：主服务优先，慢时对冲、出错或繁忙时切换到下一个，熔断中的服务被跳过。"""
+
+    def __init__(self, providers, hedging: bool = LLM_HEDGING, queue_timeout: float = LLM_QUEUE_TIMEOUT):
+        self.providers = list(providers)
+        self.hedging = hedging and len(self.providers) > 1
+        self.queue_timeout = queue_timeout
+        # 同步流式调用时每个服务请求在一个线程中读取响应
+        self._executor = ThreadPoolExecutor(
+            max_workers=sum(p.max_concurrency for p in self.providers) + 4, thread_name_prefix="llm-gateway"
+        )
+
+    @staticmethod
+    def _next_provider(pending: list):
+        """
+        从 pending 中按顺序取出下一个熔断器放行的服务，没有时返回 None。
+        真正发起请求时才调用 allow()：半开状态的服务只有在确实被使用时才占用试探名额。
+        """
+        while pending:
+            provider = pending.pop(0)
+            if provider.breaker.allow():
+                return provider
+        return None
+
+    def _all_open(self):
+        return RuntimeError(f"所有 LLM 服务均在熔断中（{', '.join(p.name for p in self.providers)}）")
+
+    # --- 同步流式 ---
+
+    def _run_attempt(self, attempt: dict, messages, stop, kwargs, out: queue.Queue):
+        provider = attempt["provider"]
+        if not provider.acquire(self.queue_timeout):
+            provider.breaker.release_probe()
+            out.put((attempt, ProviderBusy(f"{provider.name} 并发已满")))
+            return
+        start = time.perf_counter()
+        first = True
+        chunks = provider.llm._stream(messages, stop=stop, **kwargs)
+        try:
+            for chunk in chunks:
+                if first:
+                    provider.record_first_token(time.perf_counter() - start)
+                    first = False
+                if attempt["cancelled"]:
+                    provider.record_cancelled()
+                    return
+                out.put((attempt, chunk))
+            provider.record_success(time.perf_counter() - start)
+            out.put((attempt, _DONE))
+        except Exception as e:
+            provider.record_failure(e)
+            out.put((attempt, e))
+        finally:
+            # 落选的请求提前关闭响应流，连接归还连接池
+            chunks.close()
+            provider.release()
+
+    def stream(self, messages, stop=None, **kwargs):
+        """流式调用，产出 ChatGenerationChunk；先返回第一个 token 的请求胜出。"""
+        pending = list(self.providers)
+        out = queue.Queue()
+        attempts = []
+
+        def launch(hedge: bool = False):
+            provider = self._next_provider(pending)
+            if provider is None:
+                return None
+            attempt = {"provider": provider, "cancelled": False, "hedge": hedge}
+            if hedge:
+                with provider._lock:
+                    provider.hedges += 1
+            attempts.append(attempt)
+            self._executor.submit(copy_context().run, self._run_attempt, attempt, messages, stop, kwargs, out)
+            return attempt
+
+        primary = launch()
+        if primary is None:
+            raise self._all_open()
+        hedge_at = time.perf_counter() + primary["provider"].hedge_delay()
+        running = 1
+        winner = None
+        try:
+            while True:
+                timeout = None
+                if winner is None and self.hedging and pending and len(attempts) == 1:
+                    timeout = max(0.0, hedge_at - time.perf_counter())
+                try:
+                    attempt, item = out.get(timeout=timeout)
+                except queue.Empty:
+                    # 主服务在对冲延迟内没有返回第一个 token：向下一个服务再发一次请求
+                    if launch(hedge=True) is not None:
+                        running += 1
+                    continue
+                if winner is not None and attempt is not winner:
+                    continue
+                if isinstance(item, Exception):
+                    if attempt is winner:
+                        raise item
+                    running -= 1
+                    print(f"LLM 服务 {attempt['provider'].name} 调用失败: {type(item).__name__}: {item}")
+                    if running == 0:
+                        # 没有仍在进行的请求：立即切换到下一个服务
+                        if launch() is None:
+                            raise item
+                        running += 1
+                    continue
+                if winner is None:
+                    winner = attempt
+                    for other in attempts:
+                        if other is not attempt:
+                            other["cancelled"] = True
+                    if attempt["hedge"]:
+                        with attempt["provider"]._lock:
+                            attempt["provider"].hedge_wins += 1
+                if item is _DONE:
+                    return
+                yield item
+        finally:
+            for attempt in attempts:
+                attempt["cancelled"] = True
+
+    # --- 异步流式 ---
+
+    async def _arun_attempt(self, attempt: dict, messages, stop, kwargs, out: asyncio.Queue):
+        provider = attempt["provider"]
+        attempt["started"] = True
+        try:
+            acquired = await provider.aacquire(self.queue_timeout)
+        except asyncio.CancelledError:
+            # 等待并发名额时被取消（落选或调用方放弃）
+            provider.breaker.release_probe()
+            raise
+        if not acquired:
+            provider.breaker.release_probe()
+            await out.put((attempt, ProviderBusy(f"{provider.name} 并发已满")))
+            return
+        start = time.perf_counter()
+        first = True
+        chunks = provider.llm._astream(messages, stop=stop, **kwargs)
+        try:
+            async for chunk in chunks:
+                if first:
+                    provider.record_first_token(time.perf_counter() - start)
+                    first = False
+                await out.put((attempt, chunk))
+            provider.record_success(time.perf_counter() - start)
+            await out.put((attempt, _DONE))
+        except asyncio.CancelledError:
+            provider.record_cancelled()
+            raise
+        except Exception as e:
+            provider.record_failure(e)
+            await out.put((attempt, e))
+        finally:
+            await chunks.aclose()
+            provider.release()
+
+    async def astream(self, messages, stop=None, **kwargs):
+        """stream 的异步版本，落选的请求直接取消。"""
+        pending = list(self.providers)
+        out = asyncio.Queue()
+        attempts = []
+        tasks = {}
+
+        def launch(hedge: bool = False):
+            provider = self._next_provider(pending)
+            if provider is None:
+                return None
+            attempt = {"provider": provider, "cancelled": False, "hedge": hedge, "started": False}
+            if hedge:
+                with provider._lock:
+                    provider.hedges += 1
+            attempts.append(attempt)
+            task = asyncio.ensure_future(self._arun_attempt(attempt, messages, stop, kwargs, out))
+            # 任务在开始执行前就被取消时 _arun_attempt 里的代码不会运行，在这里释放试探名额
+            task.add_done_callback(
+                lambda t: t.cancelled() and not attempt["started"] and provider.breaker.release_probe()
+            )
+            tasks[id(attempt)] = task
+            return attempt
+
+        primary = launch()
+        if primary is None:
+            raise self._all_open()
+        hedge_at = time.perf_counter() + primary["provider"].hedge_delay()
+        running = 1
+        winner = None
+        try:
+            while True:
+                timeout = None
+                if winner is None and self.hedging and pending and len(attempts) == 1:
+                    timeout = max(0.0, hedge_at - time.perf_counter())
+                try:
+                    attempt, item = await asyncio.wait_for(out.get(), timeout)
+                except asyncio.TimeoutError:
+                    if launch(hedge=True) is not None:
+                        running += 1
+                    continue
+                if winner is not None and attempt is not winner:
+                    continue
+                if isinstance(item, Exception):
+                    if attempt is winner:
+                        raise item
+                    running -= 1
+                    print(f"LLM 服务 {attempt['provider'].name} 调用失败: {type(item).__name__}: {item}")
+                    if running == 0:
+                        if launch() is None:
+                            raise item
+                        running += 1
+                    continue
+                if winner is None:
+                    winner = attempt
+                    for other in attempts:
+                        if other is not attempt:
+                            tasks[id(other)].cancel()
+                    if attempt["hedge"]:
+                        with attempt["provider"]._lock:
+                            attempt["provider"].hedge_wins += 1
+                if item is _DONE:
+                    return
+                yield item
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {provider.name: provider.stats() for provider in self.providers}
+
+class GatewayChatModel(BaseChatModel):
+    """把 LLMGateway 包装成 LangChain 聊天模型；非流式调用同样经过流式对冲后拼接结果。"""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    gateway: LLMGateway
+
+    @property
+    def _llm_type(self) -> str:
+        return "llm-gateway"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"providers": [dict(p.llm._identifying_params, provider=p.name) for p in self.gateway.providers]}
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for chunk in self.gateway.stream(messages, stop=stop, **kwargs):
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        async for chunk in self.gateway.astream(messages, stop=stop, **kwargs):
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return await agenerate_from_stream(self._astream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    def stats(self) -> dict:
+        return self.gateway.stats()
+
+# --- 服务客户端 ---
+
+def _http_clients(max_connections: int, timeout: float):
+    """长期复用的 httpx 同步/异步客户端，连接池大小与并发上限一致。"""
+    import httpx
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    request_timeout = httpx.Timeout(timeout, connect=LLM_CONNECT_TIMEOUT)
+    return (httpx.Client(limits=limits, timeout=request_timeout),
+            httpx.AsyncClient(limits=limits, timeout=request_timeout))
+
+def deepseek_provider(model: str = "deepseek-chat", temperature: float = 0.1):
+    """DeepSeek 服务（未配置 DEEPSEEK_API_KEY 时返回 None），接口地址可用 DEEPSEEK_API_BASE 覆盖。"""
+    api_key = os.getenv("DEEPSEEK_API_KEY")
+    if not api_key:
+        return None
+    # 客户端库（连同 openai SDK）在首次创建时才导入，缩短启动时间
+    from langchain_deepseek import ChatDeepSeek
+    http_client, http_async_client = _http_clients(DEEPSEEK_MAX_CONCURRENCY, DEEPSEEK_TIMEOUT)
+    llm = ChatDeepSeek(
+        api_key=api_key,
+        model=model,
+        temperature=temperature,
+        timeout=DEEPSEEK_TIMEOUT,
+        max_retries=LLM_MAX_RETRIES,
+        http_client=http_client,
+        http_async_client=http_async_client,
+    )
+    return Provider("deepseek", llm, DEEPSEEK_MAX_CONCURRENCY)
+
+def zhipu_provider(model: str = "glm-4", temperature: float = 0.1):
+    """智谱 GLM 服务（未配置 ZHIPUAI_API_KEY 时返回 None），通过 OpenAI 兼容接口 ZHIPUAI_API_BASE 调用。"""
+    api_key = os.getenv("ZHIPUAI_API_KEY")
+    if not api_key:
+        return None
+    from langchain_openai import ChatOpenAI
+    http_client, http_async_client = _http_clients(ZHIPU_MAX_CONCURRENCY, ZHIPU_TIMEOUT)
+    llm = ChatOpenAI(
+        api_key=api_key,
+        base_url=ZHIPU_API_BASE,
+        model=model,
+        temperature=temperature,
+        timeout=ZHIPU_TIMEOUT,
+        max_retries=LLM_MAX_RETRIES,
+        http_client=http_client,
+        http_async_client=http_async_client,
+    )
+    return Provider("zhipu", llm, ZHIPU_MAX_CONCURRENCY)
+
+PROVIDER_FACTORIES = {
+    "deepseek": deepseek_provider,
+    "zhipu": zhipu_provider,
+}
+
+def create_chat_gateway(provider_names=LLM_PROVIDERS):
+    """按 LLM_PROVIDERS 的顺序创建已配置 API Key 的服务，一个都没有时返回 None。"""
+    providers = []
+    for name in provider_names:
+        factory = PROVIDER_FACTORIES.get(name)
+        if factory is None:
+            print(f"未知的 LLM 服务: {name}（可选: {', '.join(PROVIDER_FACTORIES)}）")
+            continue
+        provider = factory()
+        if provider is not None:
+            providers.append(provider)
+    if not providers:
+        return None
+    print(f"LLM 网关已创建：{' -> '.join(p.name for p in providers)}"
+          f"{'，启用对冲请求' if LLM_HEDGING and len(providers) > 1 else ''}")
+    return GatewayChatModel(gateway=LLMGateway(providers))
+
+# --- 本地桩服务演示 ---
+
+def _stub_provider(name: str, port: int, max_concurrency: int):
+    from langchain_openai import ChatOpenAI
+    http_client, http_async_client = _http_clients(max_concurrency, 10)
+    llm = ChatOpenAI(api_key="stub-key", base_url=f"http://127.0.0.1:{port}/v1", model=name,
+                     max_retries=0, http_client=http_client, http_async_client=http_async_client)
+    return Provider(name, llm, max_concurrency)
+
+def run_demo(args):
+    """启动两个桩 LLM 服务（主服务会随机变慢或失败），并发调用网关并打印各服务的统计。"""
+    from langchain_core.messages import HumanMessage
+    from src.stub_servers import StubLLMServer, start_site
+
+    primary = StubLLMServer(first_token_delay=args.first_token_delay, token_delay=0.005,
+                            failure_rate=args.failure_rate, slow_rate=args.slow_rate, slow_delay=args.slow_delay)
+    backup = StubLLMServer(first_token_delay=args.first_token_delay * 1.5, token_delay=0.005)
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    for server, port in ((primary, args.port), (backup, args.port + 1)):
+        asyncio.run_coroutine_threadsafe(start_site(server.app, "127.0.0.1", port), loop).result()
+
+    model = GatewayChatModel(gateway=LLMGateway([
+        _stub_provider("primary", args.port, args.concurrency),
+        _stub_provider("backup", args.port + 1, args.concurrency),
+    ], hedging=not args.no_hedging))
+    latencies, failures = [], 0
+
+    def call(i):
+        start = time.perf_counter()
+        first_token = None
+        for _ in model.stream([HumanMessage(content=f"问题 {i}")]):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+        return first_token
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in [executor.submit(call, i) for i in range(args.requests)]:
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                failures += 1
+                print(f"请求失败: {e}")
+    elapsed = time.perf_counter() - start
+
+    print(f"\n===== LLM 网关演示（{args.requests} 个请求，并发 {args.concurrency}，"
+          f"对冲{'关闭' if args.no_hedging else '开启'}）=====")
+    print(f"用时 {elapsed:.2f}s，失败 {failures}，首字延迟 p50 {_percentile(latencies, 0.5) * 1000:.0f} ms，"
+          f"p95 {_percentile(latencies, 0.95) * 1000:.0f} ms，p99 {_percentile(latencies, 0.99) * 1000:.0f} ms")
+    for name, stats in model.stats().items():
+        print(f"{name}: {stats}")
+    print(f"桩服务收到请求：primary {primary.requests}（提前断开 {primary.disconnected}），"
+          f"backup {backup.requests}（提前断开 {backup.disconnected}）")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="用本地桩服务演示 LLM 网关的对冲请求和熔断")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--port", type=int, default=18011, help="主桩服务端口，备用桩服务使用下一个端口")
+    parser.add_argument("--first-token-delay", type=float, default=0.05)
+    parser.add_argument("--slow-rate", type=float, default=0.03, help="主服务变慢的请求比例")
+    parser.add_argument("--slow-delay", type=float, default=3.0, help="变慢的请求额外增加的首字延迟（秒）")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="主服务直接返回 500 的请求比例")
+    parser.add_argument("--no-hedging", action="store_true")
+    run_demo(parser.parse_args())
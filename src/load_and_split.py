@@ -1,36 +1,253 @@
 import os
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import TextLoader
+import re
+import sys
+import time
+import codecs
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from langchain_core.documents import Document
 
-def load_and_split_text(file_path):
+# 句末标点，切分时尽量在这些字符（及紧随其后的引号、括号）之后断开
+SENTENCE_ENDINGS = "。！？!?"
+_SENTENCE_RE = re.compile(r"[^。！？!?]*[。！？!?]+[”’」』）)\"']*|[^。！？!?]+")
+# 过长的句子再按逗号、分号等切开
+_CLAUSE_RE = re.compile(r"[^，,；;：:、]*[，,；;：:、]+|[^，,；;：:、]+")
+# 章节标题：“第一部”“第12章 ……”“上部　危机纪元”或“1.疯狂年代”这类较短的独立行
+_HEADING_RE = re.compile(
+    r"^(第[一二三四五六七八九十百千零〇\d]+[部章节卷篇回](?:[\s　]+\S.{0,20})?"
+    r"|[上中下]部[\s　]+\S.{0,20}"
+    r"|\d{1,3}\.[^\s：:，,。！？【（(]{1,20})$"
+)
+
+# “第一部”“上部　面壁者”这类标题是部名，其后的章节都属于该部；编号为 1 的章节表示新的一本书开始
+_PART_RE = re.compile(r"^(第[一二三四五六七八九十百千零〇\d]+部|[上中下]部)")
+_FIRST_CHAPTER_RE = re.compile(r"^(1\.|第[一1]章)")
+
+# 默认的人物名单：规范名 -> 文本中的写法（含别名），构建索引时记录每个文档块提到了哪些人物
+DEFAULT_CHARACTERS = {
+    "叶文洁": ["叶文洁"],
+    "汪淼": ["汪淼"],
+    "史强": ["史强", "大史"],
+    "杨冬": ["杨冬"],
+    "丁仪": ["丁仪"],
+    "申玉菲": ["申玉菲"],
+    "魏成": ["魏成"],
+    "常伟思": ["常伟思"],
+    "雷志成": ["雷志成"],
+    "杨卫宁": ["杨卫宁"],
+    "伊文斯": ["伊文斯"],
+    "潘寒": ["潘寒"],
+    "罗辑": ["罗辑"],
+    "章北海": ["章北海"],
+    "庄颜": ["庄颜"],
+    "泰勒": ["泰勒"],
+    "雷迪亚兹": ["雷迪亚兹"],
+    "希恩斯": ["希恩斯"],
+    "吴岳": ["吴岳"],
+    "程心": ["程心"],
+    "云天明": ["云天明", "天明"],
+    "维德": ["维德"],
+    "艾AA": ["艾AA"],
+    "关一帆": ["关一帆"],
+    "智子": ["智子"],
+}
+
+def is_heading(line: str) -> bool:
+    """判断一行文本是否为章节标题。"""
+    line = line.strip()
+    return 0 < len(line) <= 30 and bool(_HEADING_RE.match(line))
+
+def is_part_heading(line: str) -> bool:
+    """判断章节标题是否为部名（“第一部”“上部　面壁者”）。"""
+    return bool(_PART_RE.match(line.strip()))
+
+def load_character_list(path: str) -> dict:
+    """
+    读取人物名单文件：每行一个人物，第一个词为规范名，其后为别名（空格分隔），# 开头的行为注释。
+    返回 规范名 -> [规范名, 别名...]。
+    """
+    characters = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            names = line.split("#", 1)[0].split()
+            if names:
+                characters[names[0]] = list(dict.fromkeys(names))
+    return characters
+
+def find_characters(text: str, characters: dict) -> list:
+    """返回文本中提到的人物规范名（按名单顺序）。"""
+    return [name for name, aliases in characters.items() if any(alias in text for alias in aliases)]
+
+# --- 单个片段的切分（在子进程中执行） ---
+
+def _pieces(text: str, start: int, end: int, chunk_size: int):
+    """句子不超过 chunk_size 时原样返回，否则按子句切开，仍然过长的子句按 chunk_size 硬切。"""
+    if end - start <= chunk_size:
+        yield start, end
+        return
+    for clause in _CLAUSE_RE.finditer(text, start, end):
+        for cut in range(clause.start(), clause.end(), chunk_size):
+            yield cut, min(cut + chunk_size, clause.end())
+
+def _sentence_spans(text: str, chunk_size: int):
+    """返回文本中每个句子（或过长句子的片段）去掉首尾空白后的 [start, end) 区间。"""
+    spans = []
+    for paragraph in re.finditer(r"[^\n]+", text):
+        for sentence in _SENTENCE_RE.finditer(text, paragraph.start(), paragraph.end()):
+            for start, end in _pieces(text, sentence.start(), sentence.end(), chunk_size):
+                segment = text[start:end]
+                stripped = segment.strip()
+                if stripped:
+                    start += len(segment) - len(segment.lstrip())
+                    spans.append((start, start + len(stripped)))
+    return spans
+
+def split_section(section, chunk_size: int = 500, chunk_overlap: int = 50):
+    """
+    把一个章节片段切分成文档块：只在句子边界断开，块长不超过 chunk_size，
+    相邻块之间重叠不超过 chunk_overlap 个字符的完整句子。
+    section 为 (来源文件, 部名, 章节标题, 片段在文件中的字符偏移, 片段文本)，返回 (正文, 元数据) 列表。
+    """
+    source, part, chapter, base, text = section
+    spans = _sentence_spans(text, chunk_size)
+    chunks = []
+    i = 0
+    while i < len(spans):
+        j = i + 1
+        while j < len(spans) and spans[j][1] - spans[i][0] <= chunk_size:
+            j += 1
+        start, end = spans[i][0], spans[j - 1][1]
+        chunks.append((text[start:end], {
+            "source": source,
+            "part": part,
+            "chapter": chapter,
+            "start_index": base + start,
+            "end_index": base + end,
+        }))
+        if j >= len(spans):
+            break
+        # 下一块从能放进 chunk_overlap 的最后几个完整句子开始（重叠部分不能挤掉下一个句子）
+        k = j
+        while (k - 1 > i and spans[j - 1][1] - spans[k - 1][0] <= chunk_overlap
+               and spans[j][1] - spans[k - 1][0] <= chunk_size):
+            k -= 1
+        i = k
+    return chunks
+
+def _split_section_job(args):
+    section, chunk_size, chunk_overlap = args
+    return split_section(section, chunk_size, chunk_overlap)
+
+# --- 流式读取 ---
+
+def iter_sections(file_path: str, section_chars: int = 200_000, window_bytes: int = 1 << 20, stats=None):
+    """
+    以有界内存流式读取文件，按章节标题切成片段；超过 section_chars 的章节在段落边界处再切开。
+    每次最多读取 window_bytes 字节，产出 (来源文件, 部名, 章节标题, 字符偏移, 文本)。
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    part = ""
+    chapter = ""
+    lines = []
+    section_start = 0
+    section_length = 0
+    offset = 0
+    with open(file_path, "rb") as f:
+        while True:
+            raw = f.readline(window_bytes)
+            line = decoder.decode(raw, final=not raw)
+            if stats is not None:
+                stats["bytes"] += len(raw)
+            if line:
+                if is_heading(line):
+                    if section_length:
+                        yield file_path, part, chapter, section_start, "".join(lines)
+                    chapter = line.strip()
+                    if is_part_heading(chapter):
+                        # 统一全角/半角空格，同一部的名称在不同版本中保持一致
+                        part = " ".join(chapter.split())
+                    elif _FIRST_CHAPTER_RE.match(chapter):
+                        part = ""
+                    lines, section_length = [], 0
+                    section_start = offset + len(line)
+                else:
+                    lines.append(line)
+                    section_length += len(line)
+                    if section_length >= section_chars:
+                        yield file_path, part, chapter, section_start, "".join(lines)
+                        lines, section_length = [], 0
+                        section_start = offset + len(line)
+                offset += len(line)
+            if not raw:
+                break
+    if section_length:
+        yield file_path, part, chapter, section_start, "".join(lines)
+
+def iter_split_documents(file_paths, chunk_size: int = 500, chunk_overlap: int = 50, workers: int = 1,
+                         section_chars: int = 200_000, characters: dict = None):
+    """
+    流式切分一个或多个文本文件，逐个产出带部名、章节和偏移元数据的 Document；
+    提供人物名单 characters（规范名 -> 写法列表）时，元数据中的 characters 为文档块提到的人物。
+    workers > 1 时各章节片段分发到进程池并行切分，同时在途的片段数有上限，内存占用与文件大小无关。
+    全部产出后打印切分吞吐量（MB/s）。
+    """
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    stats = {"bytes": 0, "chunks": 0}
+    start = time.perf_counter()
+
+    def sections():
+        for file_path in file_paths:
+            yield from iter_sections(file_path, section_chars, stats=stats)
+
+    def emit(chunks):
+        for text, metadata in chunks:
+            stats["chunks"] += 1
+            if characters:
+                metadata["characters"] = find_characters(text, characters)
+            yield Document(page_content=text, metadata=metadata)
+
+    if workers <= 1:
+        for section in sections():
+            yield from emit(split_section(section, chunk_size, chunk_overlap))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for section in sections():
+                pending.append(executor.submit(_split_section_job, (section, chunk_size, chunk_overlap)))
+                # 按提交顺序产出，保证文档块顺序与文件顺序一致
+                while len(pending) >= workers * 2:
+                    yield from emit(pending.popleft().result())
+            while pending:
+                yield from emit(pending.popleft().result())
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    mb = stats["bytes"] / 1024 / 1024
+    print(f"切分完成：{len(file_paths)} 个文件，{mb:.1f} MB，{stats['chunks']} 个文档块，"
+          f"用时 {elapsed:.2f} 秒，{mb / elapsed:.1f} MB/s（{workers} 个进程）。")
+
+def load_and_split_text(file_path, workers: int = 1):
     """
     加载文本文件并将其分割成小块。
+    按句子和章节边界切分，每个文档块带有 part / chapter / start_index / end_index / characters 元数据。
     """
-    loader = TextLoader(file_path, encoding='utf-8')
-    documents = loader.load()
-
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,
-        chunk_overlap=50,
-        separators=["\n\n", "\n", "。", "，", "、", ""]
-    )
-    
-    split_docs = text_splitter.split_documents(documents)
-    
+    split_docs = list(iter_split_documents(file_path, workers=workers, characters=DEFAULT_CHARACTERS))
+
     print(f"文件 {os.path.basename(file_path)} 被成功加载并切分。")
-    print(f"原始文档数量: {len(documents)}")
     print(f"切分后文档块数量: {len(split_docs)}")
-    
+
     return split_docs
 
 if __name__ == '__main__':
     data_dir = 'data'
     file_name = '三体 (刘慈欣) (Z-Library).txt' # 使用完整版文件
     file_path = os.path.join(data_dir, file_name)
+    # 可选参数：并行切分的进程数
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
 
     if os.path.exists(file_path):
-        chunks = load_and_split_text(file_path)
-        
+        chunks = load_and_split_text(file_path, workers=workers)
+
         # 将分割示例写入文件，方便PPT引用
         with open('split_demo.txt', 'w', encoding='utf-8') as f:
             f.write(f"源文件: {file_name}\n")
@@ -39,10 +256,11 @@ if __name__ == '__main__':
             f.write("以下是前5个知识片段的示例：\n\n")
 
             for i, chunk in enumerate(chunks[:5]):
-                f.write(f"--- 片段 {i+1} (长度: {len(chunk.page_content)} 字符) ---\n")
+                f.write(f"--- 片段 {i+1} (长度: {len(chunk.page_content)} 字符，"
+                        f"章节: {chunk.metadata['chapter'] or '无'}，偏移: {chunk.metadata['start_index']}) ---\n")
                 f.write(chunk.page_content)
                 f.write("\n" + "-"*40 + "\n\n")
-        
+
         print("已生成分割示例文件: split_demo.txt")
         print("您可以在PPT中引用此文件的内容。")
 
@@ -0,0 +1,197 @@
+"""
+微信后端压测脚本：在本地启动桩 LLM 和桩客服消息服务，以子进程方式启动后端，
+然后并发发送表单请求，统计即时回复延迟、端到端完成延迟、吞吐量和后端线程数。
+
+示例：
+    python src/load_test.py --requests 2000 --concurrency 500 --first-token-delay 5
+    python src/load_test.py --server flask --requests 200
+"""
+import os
+import sys
+# 将项目根目录添加到 sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import asyncio
+import shlex
+import subprocess
+import time
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, ClientError
+
+from src.stub_servers import StubLLMServer, StubCustomerServiceServer, start_site
+
+QUESTIONS = [
+    "黑暗森林法则是什么？",
+    "智子是什么？",
+    "叶文洁为什么要回复三体文明？",
+    "古筝行动是怎么执行的？",
+    "红岸基地是做什么的？",
+]
+
+SERVER_SCRIPTS = {
+    "async": "src/wechat_async_app.py",
+    "flask": "src/wechat_app.py",
+}
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def read_thread_count(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+async def wait_until_ready(url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    async with ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url + "/stats") as res:
+                    if res.status == 200:
+                        return
+            except ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"后端在 {timeout} 秒内未就绪: {url}")
+
+async def fetch_stats(url: str) -> dict:
+    async with ClientSession() as session:
+        async with session.get(url + "/stats") as res:
+            return await res.json()
+
+def backend_idle(stats: dict) -> bool:
+    """根据 /stats 判断后端是否已处理完所有请求（兼容 async 与 flask 两种后端）。"""
+    if "inflight" in stats:
+        return stats["inflight"] == 0
+    pool = stats.get("pool", {})
+    return pool.get("queue_depth", 0) == 0 and pool.get("active", 0) == 0
+
+async def run_load(args):
+    # 1. 启动桩服务
+    llm_stub = StubLLMServer(first_token_delay=args.first_token_delay, token_delay=args.token_delay)
+    cs_stub = StubCustomerServiceServer()
+    runners = [
+        await start_site(llm_stub.app, "127.0.0.1", args.llm_port),
+        await start_site(cs_stub.app, "127.0.0.1", args.cs_port),
+    ]
+
+    # 2. 启动被测后端
+    env = dict(os.environ)
+    env.update({
+        "DEEPSEEK_API_KEY": "stub-key",
+        "DEEPSEEK_API_BASE": f"http://127.0.0.1:{args.llm_port}/v1",
+        # 只压测桩服务，不向真实的智谱接口发对冲请求
+        "LLM_PROVIDERS": "deepseek",
+        "WECHAT_CUSTOMER_SERVICE_URL": f"http://127.0.0.1:{args.cs_port}/send_custom_message",
+        "WECHAT_PORT": str(args.app_port),
+        # 压测时关闭答案缓存和 LLM 回答缓存，保证每个请求都真正调用 LLM
+        "ANSWER_CACHE_SIZE": "0",
+        "LLM_MEMO_SIZE": "0",
+    })
+    command = shlex.split(args.app_cmd) if args.app_cmd else [sys.executable, SERVER_SCRIPTS[args.server]]
+    app_process = subprocess.Popen(command, env=env)
+    app_url = f"http://127.0.0.1:{args.app_port}"
+    try:
+        await wait_until_ready(app_url, args.startup_timeout)
+        print(f"后端已就绪: {app_url}（pid {app_process.pid}）")
+
+        # 3. 并发发送请求
+        ack_latencies = []
+        sent_at = {}
+        busy = 0
+        errors = 0
+        peak_threads = read_thread_count(app_process.pid)
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def send_one(session, i):
+            nonlocal busy, errors
+            user_id = f"load-user-{i}"
+            data = {"from_user": user_id, "content": QUESTIONS[i % len(QUESTIONS)], "type": "text"}
+            async with semaphore:
+                start = time.time()
+                try:
+                    async with session.post(app_url + "/", data=data) as res:
+                        text = await res.text()
+                except (ClientError, asyncio.TimeoutError):
+                    errors += 1
+                    return
+                ack_latencies.append(time.time() - start)
+                if "繁忙" in text or "较多" in text:
+                    busy += 1
+                else:
+                    sent_at[user_id] = start
+
+        async def sample_threads():
+            nonlocal peak_threads
+            while True:
+                peak_threads = max(peak_threads, read_thread_count(app_process.pid))
+                await asyncio.sleep(0.2)
+
+        sampler = asyncio.create_task(sample_threads())
+        load_start = time.time()
+        connector = TCPConnector(limit=args.concurrency)
+        async with ClientSession(connector=connector, timeout=ClientTimeout(total=30)) as session:
+            await asyncio.gather(*(send_one(session, i) for i in range(args.requests)))
+        send_seconds = time.time() - load_start
+
+        # 4. 等待所有已接受请求的回复送达桩客服服务
+        deadline = time.monotonic() + args.completion_timeout
+        while time.monotonic() < deadline and not set(sent_at) <= cs_stub.users_served():
+            await asyncio.sleep(0.2)
+        # 首条回复全部送达后，继续等待后续分段推送完成再关闭桩服务
+        while time.monotonic() < deadline and not backend_idle(await fetch_stats(app_url)):
+            await asyncio.sleep(0.2)
+        sampler.cancel()
+        total_seconds = time.time() - load_start
+
+        first_reply = {}
+        for message in cs_stub.messages:
+            first_reply.setdefault(message["openid"], message["received_at"])
+        e2e = [first_reply[u] - t for u, t in sent_at.items() if u in first_reply]
+
+        # 5. 输出报告
+        print("\n===== 压测报告 =====")
+        print(f"后端: {' '.join(command)}")
+        print(f"请求数 {args.requests}，客户端并发 {args.concurrency}，桩 LLM 首字延迟 {args.first_token_delay}s")
+        print(f"已接受 {len(sent_at)}，繁忙拒绝 {busy}，连接错误 {errors}")
+        print(f"即时回复延迟: p50 {percentile(ack_latencies, 0.5) * 1000:.1f} ms，"
+              f"p99 {percentile(ack_latencies, 0.99) * 1000:.1f} ms，"
+              f"max {max(ack_latencies, default=0) * 1000:.1f} ms（要求 < 5000 ms）")
+        print(f"发送耗时 {send_seconds:.2f}s，接收吞吐 {args.requests / send_seconds:.1f} 请求/秒")
+        print(f"完成回复 {len(e2e)}/{len(sent_at)}，首条回复延迟: p50 {percentile(e2e, 0.5):.2f}s，"
+              f"p95 {percentile(e2e, 0.95):.2f}s，p99 {percentile(e2e, 0.99):.2f}s")
+        print(f"端到端吞吐 {len(e2e) / total_seconds:.1f} 回答/秒")
+        print(f"桩 LLM 收到 {llm_stub.requests} 次调用，最大并发 {llm_stub.max_in_flight}")
+        print(f"后端进程峰值线程数: {peak_threads}")
+    finally:
+        app_process.terminate()
+        app_process.wait()
+        for runner in runners:
+            await runner.cleanup()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="微信后端本地压测（桩 LLM + 桩客服消息服务）")
+    parser.add_argument("--server", choices=sorted(SERVER_SCRIPTS), default="async")
+    parser.add_argument("--app-cmd", default=None, help="自定义后端启动命令，覆盖 --server")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--first-token-delay", type=float, default=3.0)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--llm-port", type=int, default=18001)
+    parser.add_argument("--cs-port", type=int, default=18002)
+    parser.add_argument("--app-port", type=int, default=18081)
+    parser.add_argument("--startup-timeout", type=float, default=120)
+    parser.add_argument("--completion-timeout", type=float, default=300)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    asyncio.run(run_load(parse_args()))
@@ -0,0 +1,294 @@
+"""
+文档块元数据的过滤索引：来源文件、部名、章节和出场人物 -> 文档块编号集合，用于检索前过滤。
+
+检索时先按过滤条件取出允许的文档编号（多个条件取交集，同一字段的多个取值取并集），
+再把它们作为 FAISS 的 IDSelector 和 BM25 的掩码传入检索，只在这些文档块中计算距离和得分，
+不需要先多取候选再丢弃，过滤条件很严时也能返回足够的结果。
+
+磁盘格式（与 index.faiss 位于同一目录，文档编号与 FAISS 向量位置一一对应）：
+- filters.keys:         每行一个 "字段\t取值"，行号即键 ID
+- filters.offsets.npy:  int64 数组，长度为键数 + 1，键 t 的文档编号为 [offsets[t], offsets[t+1])
+- filters.ids.npy:      int32 数组，所有键的文档编号依次拼接，每段内递增
+- filters.json:         文档总数、已建索引的字段和人物别名表
+
+人物提及在构建时直接从正文中匹配（见 src/load_and_split.DEFAULT_CHARACTERS），不依赖文档块中已保存的元数据，
+所以增量构建留下的旧文档块也能被人物过滤命中；部名和章节来自切分时写入的元数据。
+
+用法：
+    python src/metadata_index.py build --index-path vector_store/faiss_index_three_body_full [--characters names.txt]
+    python src/metadata_index.py benchmark --index-path vector_store/faiss_index_three_body_full
+"""
+import os
+import sys
+# 将项目根目录添加到 sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from src.load_and_split import DEFAULT_CHARACTERS, find_characters, load_character_list
+
+KEYS_FILE = "filters.keys"
+OFFSETS_FILE = "filters.offsets.npy"
+IDS_FILE = "filters.ids.npy"
+META_FILE = "filters.json"
+
+# 直接取自文档块元数据的字段；characters 字段由正文匹配得到
+METADATA_FIELDS = ("source", "part", "chapter")
+# 缓存最近使用的过滤条件对应的 Selection（含位图和 IDSelector）
+SELECTION_CACHE_SIZE = 64
+
+def has_metadata_index(index_path: str) -> bool:
+    """判断索引目录下是否已有元数据过滤索引。"""
+    return all(os.path.exists(os.path.join(index_path, name)) for name in (KEYS_FILE, OFFSETS_FILE, IDS_FILE, META_FILE))
+
+class Selection:
+    """
+    一组允许检索的文档编号，按需生成 BM25 使用的布尔掩码和 FAISS 使用的 IDSelector。
+    同一个 Selection 由 MetadataIndex 缓存并在多个线程间共享，生成过程加锁，掩码和位图只生成一次。
+    """
+
+    def __init__(self, ids, total: int):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.total = total
+        self._lock = threading.Lock()
+        self._mask = None
+        self._bitmap = None
+        self._selector = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def mask(self) -> np.ndarray:
+        with self._lock:
+            return self._build_mask()
+
+    def _build_mask(self) -> np.ndarray:
+        if self._mask is None:
+            mask = np.zeros(self.total, dtype=bool)
+            mask[self.ids] = True
+            self._mask = mask
+        return self._mask
+
+    def selector(self):
+        """
+        FAISS 的 IDSelector：文档编号较多时使用位图（每个向量 1 bit），较少时使用哈希集合。
+        位图和编号数组由本对象持有，保证检索期间不会被回收；IDSelectorBitmap 只保存位图的裸指针，
+        所以位图一经生成就不再替换（加锁保证并发调用时只生成一份）。
+        """
+        with self._lock:
+            if self._selector is None:
+                import faiss
+                if len(self.ids) * 64 > self.total:
+                    self._bitmap = np.packbits(self._build_mask(), bitorder="little")
+                    self._selector = faiss.IDSelectorBitmap(self.total, faiss.swig_ptr(self._bitmap))
+                else:
+                    self._selector = faiss.IDSelectorBatch(len(self.ids), faiss.swig_ptr(self.ids))
+            return self._selector
+
+class MetadataIndex:
+    """字段取值 -> 文档编号集合的倒排表，文档编号即 FAISS 向量位置。"""
+
+    def __init__(self, keys, offsets, ids, total: int, fields, aliases: dict = None):
+        self.keys = keys
+        self._key_ids = {key: i for i, key in enumerate(keys)}
+        self.offsets = offsets
+        self.ids = ids
+        self.total = total
+        self.fields = set(fields)
+        self.aliases = aliases or {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.total
+
+    @classmethod
+    def build(cls, metadatas, texts, characters: dict = DEFAULT_CHARACTERS):
+        """从按向量位置排列的元数据和正文构建索引。"""
+        postings = defaultdict(list)
+        total = 0
+        for doc_no, (metadata, text) in enumerate(zip(metadatas, texts)):
+            total += 1
+            for field in METADATA_FIELDS:
+                value = (metadata or {}).get(field)
+                if value:
+                    postings[f"{field}\t{value}"].append(doc_no)
+            for name in find_characters(text, characters):
+                postings[f"characters\t{name}"].append(doc_no)
+
+        keys = sorted(postings)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(postings[key]) for key in keys], out=offsets[1:])
+        ids = np.fromiter((doc_no for key in keys for doc_no in postings[key]), dtype=np.int32, count=int(offsets[-1]))
+        aliases = {alias: name for name, names in characters.items() for alias in names}
+        return cls(keys, offsets, ids, total, METADATA_FIELDS + ("characters",), aliases)
+
+    def save(self, index_path: str):
+        """写入索引目录，先写临时文件再原子替换。"""
+        os.makedirs(index_path, exist_ok=True)
+        written = []
+        for name, array in ((OFFSETS_FILE, self.offsets), (IDS_FILE, self.ids)):
+            tmp = os.path.join(index_path, name.replace(".npy", ".tmp.npy"))
+            np.save(tmp, np.asarray(array))
+            written.append((tmp, os.path.join(index_path, name)))
+        for name, content in (
+            (KEYS_FILE, "\n".join(self.keys)),
+            (META_FILE, json.dumps({"total": self.total, "fields": sorted(self.fields), "aliases": self.aliases},
+                                   ensure_ascii=False)),
+        ):
+            tmp = os.path.join(index_path, name + ".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(content)
+            written.append((tmp, os.path.join(index_path, name)))
+        for tmp, final in written:
+            os.replace(tmp, final)
+
+    @classmethod
+    def load(cls, index_path: str):
+        """以 mmap 方式加载文档编号数组。"""
+        with open(os.path.join(index_path, KEYS_FILE), encoding="utf-8") as f:
+            content = f.read()
+        keys = content.split("\n") if content else []
+        with open(os.path.join(index_path, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        offsets = np.load(os.path.join(index_path, OFFSETS_FILE), mmap_mode="r")
+        ids = np.load(os.path.join(index_path, IDS_FILE), mmap_mode="r")
+        return cls(keys, offsets, ids, meta["total"], meta["fields"], meta.get("aliases"))
+
+    def values(self, field: str) -> dict:
+        """返回字段的所有取值及其文档块数。"""
+        prefix = field + "\t"
+        return {key[len(prefix):]: int(self.offsets[i + 1] - self.offsets[i])
+                for i, key in enumerate(self.keys) if key.startswith(prefix)}
+
+    def ids_for(self, field: str, value) -> np.ndarray:
+        """返回字段取值为 value 的文档编号（递增），人物名可以使用别名。"""
+        if field == "characters":
+            value = self.aliases.get(value, value)
+        key_id = self._key_ids.get(f"{field}\t{value}")
+        if key_id is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.asarray(self.ids[int(self.offsets[key_id]):int(self.offsets[key_id + 1])], dtype=np.int64)
+
+    def select(self, conditions: dict):
+        """
+        返回满足所有过滤条件的 Selection；条件的取值可以是单个值或列表（满足其一即可）。
+        条件中有未建索引的字段时返回 None，由调用方退回到检索后过滤。
+        """
+        if any(field not in self.fields for field in conditions):
+            return None
+        cache_key = tuple(sorted((field, repr(value)) for field, value in conditions.items()))
+        with self._lock:
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                self._cache.move_to_end(cache_key)
+                return cached
+
+        ids = None
+        for field, expected in conditions.items():
+            values = expected if isinstance(expected, (list, tuple, set, frozenset)) else [expected]
+            field_ids = np.zeros(0, dtype=np.int64)
+            for value in values:
+                field_ids = np.union1d(field_ids, self.ids_for(field, value))
+            ids = field_ids if ids is None else np.intersect1d(ids, field_ids, assume_unique=True)
+        selection = Selection(ids if ids is not None else np.arange(self.total), self.total)
+
+        with self._lock:
+            self._cache[cache_key] = selection
+            while len(self._cache) > SELECTION_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return selection
+
+def build_metadata_index(vector_store, index_path: str, characters: dict = DEFAULT_CHARACTERS) -> MetadataIndex:
+    """按 FAISS 向量位置顺序读取 docstore 中的元数据和正文，构建并保存元数据过滤索引。"""
+    start = time.perf_counter()
+    mapping = vector_store.index_to_docstore_id
+    docs = [vector_store.docstore.search(mapping[i]) for i in range(len(mapping))]
+    index = MetadataIndex.build([doc.metadata for doc in docs], [doc.page_content for doc in docs], characters)
+    index.save(index_path)
+    size = sum(os.path.getsize(os.path.join(index_path, name)) for name in (KEYS_FILE, OFFSETS_FILE, IDS_FILE, META_FILE))
+    counts = {field: len(index.values(field)) for field in sorted(index.fields)}
+    print(f"元数据过滤索引已保存到 {index_path}：{len(index)} 个文档，"
+          f"{'，'.join(f'{field} {n} 个取值' for field, n in counts.items())}，"
+          f"{size / 1024:.1f} KB，用时 {time.perf_counter() - start:.1f} 秒。")
+    return index
+
+# --- 基准测试 ---
+
+# 固定问题集：(问题, 人物)
+BENCHMARK_QUESTIONS = [
+    ("叶文洁在红岸基地做了什么？", "叶文洁"),
+    ("罗辑是怎么成为面壁者的？", "罗辑"),
+    ("史强是个什么样的人？", "史强"),
+    ("章北海为什么要劫持自然选择号？", "章北海"),
+    ("程心为什么没有按下发射按钮？", "程心"),
+    ("云天明送给程心的礼物是什么？", "云天明"),
+    ("汪淼看到的倒计时是怎么回事？", "汪淼"),
+    ("维德说的前进是什么意思？", "维德"),
+]
+
+def run_benchmark(index_path: str, embedding_model_name: str, k: int = 4, oversample: int = 4, repeat: int = 5):
+    """比较检索后过滤与检索前过滤在人物问题上的精确率（返回的文档块中提到该人物的比例）、返回数量和延迟。"""
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    from src.chunk_store import load_vector_store
+    from src.lexical_index import dense_search_with_scores, documents_at
+
+    embeddings = HuggingFaceEmbeddings(model_name=embedding_model_name)
+    vector_store = load_vector_store(index_path, embeddings)
+    index = MetadataIndex.load(index_path)
+    vectors = embeddings.embed_documents([q for q, _ in BENCHMARK_QUESTIONS])
+
+    def post_filter(vector, name):
+        hits = dense_search_with_scores(vector_store, vector, k * oversample)
+        allowed = set(index.ids_for("characters", name).tolist())
+        return [position for position, _ in hits if position in allowed][:k]
+
+    def pre_filter(vector, name):
+        hits = dense_search_with_scores(vector_store, vector, k, selection=index.select({"characters": name}))
+        return [position for position, _ in hits]
+
+    methods = {"none": lambda v, name: [p for p, _ in dense_search_with_scores(vector_store, v, k)],
+               "post": post_filter, "pre": pre_filter}
+    precision = {name: [] for name in methods}
+    returned = {name: 0 for name in methods}
+    latencies = {name: [] for name in methods}
+    for (question, character), vector in zip(BENCHMARK_QUESTIONS, vectors):
+        for name, search in methods.items():
+            for _ in range(repeat):
+                start = time.perf_counter()
+                positions = search(vector, character)
+                latencies[name].append(time.perf_counter() - start)
+            docs = documents_at(vector_store, positions)
+            returned[name] += len(docs)
+            precision[name].append(sum(character in d.page_content for d in docs) / k)
+
+    print(f"\n===== 人物过滤基准（k={k}，检索后过滤多取 {oversample} 倍候选）=====")
+    for name in methods:
+        values = sorted(latencies[name])
+        print(f"{name:>5}: 精确率 {sum(precision[name]) / len(precision[name]):.0%}，"
+              f"共返回 {returned[name]}/{k * len(BENCHMARK_QUESTIONS)} 块，"
+              f"延迟 p50 {values[len(values) // 2] * 1000:.2f} ms，"
+              f"p95 {values[min(len(values) - 1, int(0.95 * len(values)))] * 1000:.2f} ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="元数据过滤索引的构建与基准测试工具")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--index-path", default='vector_store/faiss_index_three_body_full')
+    parser.add_argument("--characters", default=None, help="人物名单文件（每行：规范名 别名...），默认使用内置名单")
+    parser.add_argument("--model", default='moka-ai/m3e-base')
+    parser.add_argument("--k", type=int, default=4)
+    parsed = parser.parse_args()
+
+    if parsed.command == "build":
+        # 只需要 docstore，不加载 Embedding 模型
+        from src.chunk_store import load_vector_store
+        characters = load_character_list(parsed.characters) if parsed.characters else DEFAULT_CHARACTERS
+        build_metadata_index(load_vector_store(parsed.index_path, None), parsed.index_path, characters)
+    else:
+        run_benchmark(parsed.index_path, parsed.model, parsed.k)
@@ -0,0 +1,318 @@
+"""
+图片问答流水线（命令行和微信后端共用）：
+1. 读取图片：本地文件或 URL 只读取一次，计算内容哈希并编码成 base64 data URL，后续两次 GLM-4V 调用复用；
+   下载 URL 时拒绝内网、回环等非公网地址（每次重定向都重新检查，并直接连接检查过的 IP，防止 DNS 重绑定），
+   限制大小并要求 image/* 类型；
+2. 描述图片：GLM-4V 生成图片描述，按“图片内容哈希 + 描述 prompt”缓存；有用户问题时，与此同时先用问题检索知识库；
+3. 检索知识：用图片描述检索知识库（只检索，不调用 LLM 生成中间回答），与问题检索结果按倒数排名融合（RRF）后取前 k 个；
+4. 生成回答：GLM-4V 结合图片、描述和检索到的上下文给出最终回答。
+
+每次调用都会记录各阶段耗时，stats() 汇总各阶段的延迟分位数和描述缓存命中率。
+"""
+import os
+import asyncio
+import base64
+import hashlib
+import ipaddress
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin, urlsplit
+from langchain_core.messages import HumanMessage
+
+from src.answer_cache import template_key
+from src.tracing import record_span
+from src.rag_chain import format_docs, get_multimodal_llm, retrieve_documents, RETRIEVER_K
+
+DESCRIPTION_PROMPT = "你是一个专业的图像分析师。请详细、客观地描述这幅图像的内容，重点描述其主要物体、场景和风格。"
+
+# 按图片内容哈希缓存的图片描述条数
+DESCRIPTION_CACHE_SIZE = int(os.getenv("IMAGE_DESCRIPTION_CACHE_SIZE", "256"))
+
+# 下载图片的大小上限（字节）和最多跟随的重定向次数
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_MAX_REDIRECTS = 3
+
+STAGES = ("load_image", "describe", "retrieve", "answer", "total")
+
+_MAGIC_MIME_TYPES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"BM", "image/bmp"),
+]
+
+def _guess_mime(data: bytes, fallback: str = "image/jpeg") -> str:
+    for magic, mime in _MAGIC_MIME_TYPES:
+        if data.startswith(magic):
+            return mime
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return fallback
+
+def _check_public_url(url: str) -> str:
+    """
+    解析 URL 的主机名，任一地址不是公网地址（内网、回环、链路本地、保留、组播）时拒绝，
+    否则返回检查过的第一个地址（下载时直接连接这个地址）。
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError(f"只接受 http(s) 图片地址: {url[:100]}")
+    try:
+        infos = socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80),
+                                   proto=socket.IPPROTO_TCP)
+    except socket.gaierror as e:
+        raise ValueError(f"无法解析图片地址的主机名 {parts.hostname}: {e}")
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if (address.is_private or address.is_loopback or address.is_link_local or address.is_reserved
+                or address.is_multicast or address.is_unspecified):
+            raise ValueError(f"拒绝访问非公网地址的图片: {parts.hostname} ({address})")
+    return infos[0][4][0].split("%")[0]
+
+class _PinnedHostAdapter(HTTPAdapter):
+    """
+    连接固定到已检查过的 IP：请求 URL 中的主机名换成该 IP，TLS 的 SNI 和证书校验仍使用原主机名。
+    requests 不会再自己解析主机名，检查之后 DNS 结果被改成内网地址（DNS 重绑定）也不会连过去。
+    """
+
+    def __init__(self, hostname: str):
+        self.hostname = hostname
+        super().__init__(max_retries=0)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.update(server_hostname=self.hostname, assert_hostname=self.hostname)
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+
+def _pinned_get(url: str, address: str, timeout: float):
+    """向 address 发送 GET url 请求（Host 头为原主机名），流式读取，不跟随重定向。"""
+    parts = urlsplit(url)
+    host = f"[{address}]" if ":" in address else address
+    netloc = f"{host}:{parts.port}" if parts.port else host
+    host_header = f"{parts.hostname}:{parts.port}" if parts.port else parts.hostname
+    with requests.Session() as session:
+        # 不使用环境变量中的代理：经代理转发时连接的不是检查过的地址
+        session.trust_env = False
+        session.mount(f"{parts.scheme}://", _PinnedHostAdapter(parts.hostname))
+        return session.get(parts._replace(netloc=netloc).geturl(), headers={"Host": host_header},
+                           timeout=timeout, stream=True, allow_redirects=False)
+
+def _download_image(url: str, timeout: float):
+    """下载图片：手动跟随重定向并逐跳检查地址，流式读取且不超过 IMAGE_MAX_BYTES。"""
+    for _ in range(IMAGE_MAX_REDIRECTS + 1):
+        address = _check_public_url(url)
+        response = _pinned_get(url, address, timeout)
+        with response:
+            if response.is_redirect:
+                url = urljoin(url, response.headers["Location"])
+                continue
+            response.raise_for_status()
+            mime = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+            if not mime.startswith("image/"):
+                raise ValueError(f"图片地址返回的不是图片: {mime or '未知类型'}")
+            if int(response.headers.get("Content-Length") or 0) > IMAGE_MAX_BYTES:
+                raise ValueError(f"图片超过大小上限 {IMAGE_MAX_BYTES} 字节")
+            data = bytearray()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                data.extend(chunk)
+                if len(data) > IMAGE_MAX_BYTES:
+                    raise ValueError(f"图片超过大小上限 {IMAGE_MAX_BYTES} 字节")
+            return bytes(data), mime
+    raise ValueError(f"图片地址重定向次数超过 {IMAGE_MAX_REDIRECTS} 次")
+
+class ImageInput:
+    """读取一次的图片：原始字节的 SHA-256 和可直接放进多模态消息的 base64 data URL。"""
+
+    def __init__(self, data: bytes, mime: str = None):
+        self.sha256 = hashlib.sha256(data).hexdigest()
+        self.size = len(data)
+        mime = mime or _guess_mime(data)
+        self.data_url = f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+    @classmethod
+    def load(cls, source: str, allow_local_files: bool = True, timeout: float = 10):
+        """
+        source 为 http(s) URL 时下载图片（只允许公网地址，见 _download_image），
+        否则按本地文件路径读取（allow_local_files=False 时拒绝）。
+        """
+        if source.startswith(("http://", "https://")):
+            data, mime = _download_image(source, timeout)
+            return cls(data, mime)
+        if not allow_local_files:
+            raise ValueError(f"只接受 http(s) 图片地址: {source[:100]}")
+        with open(source, "rb") as f:
+            return cls(f.read())
+
+def image_message(image: ImageInput, text: str) -> HumanMessage:
+    return HumanMessage(
+        content=[
+            {"type": "text", "text": text},
+            {"type": "image_url", "image_url": {"url": image.data_url}},
+        ]
+    )
+
+def _merge_documents(*groups, k: int, rrf_k: int = 60):
+    """
+    用倒数排名融合（RRF）合并多组检索结果：文档块得分为各组中 1 / (rrf_k + 名次) 之和，
+    同时出现在多组中的块排在前面，各组的靠前结果交替入选，再截取前 k 个。
+    """
+    scores = {}
+    docs_by_content = {}
+    for docs in groups:
+        for rank, doc in enumerate(docs, start=1):
+            docs_by_content.setdefault(doc.page_content, doc)
+            scores[doc.page_content] = scores.get(doc.page_content, 0.0) + 1.0 / (rrf_k + rank)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [docs_by_content[content] for content in ranked[:k]]
+
+class ImagePipeline:
+    """
+    图片问答流水线。build_prompt(description, context, question) 生成最终回答的 prompt，
+    description_prompt 为第一阶段描述图片使用的 prompt，profile 为知识库检索使用的检索配置。
+    处理外部用户发来的图片地址时应设置 allow_local_files=False，避免读取服务器本地文件。
+    """
+
+    def __init__(self, build_prompt, description_prompt: str = DESCRIPTION_PROMPT,
+                 cache_size: int = DESCRIPTION_CACHE_SIZE, k: int = RETRIEVER_K, sample_size: int = 500,
+                 allow_local_files: bool = True, profile: str = "image"):
+        self.build_prompt = build_prompt
+        self.allow_local_files = allow_local_files
+        self.description_prompt = description_prompt
+        self.cache_size = cache_size
+        self.k = k
+        self.profile = profile
+        self._prompt_key = template_key(description_prompt)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="image-retrieval")
+        self._timings = {stage: deque(maxlen=sample_size) for stage in STAGES}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    # --- 图片描述缓存 ---
+
+    def _cached_description(self, image: ImageInput):
+        key = (image.sha256, self._prompt_key)
+        with self._lock:
+            description = self._cache.get(key)
+            if description is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+            return description
+
+    def _remember_description(self, image: ImageInput, description: str):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[(image.sha256, self._prompt_key)] = description
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _retrieval_query(self, description: str, question: str = None) -> str:
+        return f"关于“{description}”，{question}" if question else description
+
+    def _record(self, timings: dict, cached: bool, start: float):
+        # 各阶段依次执行，按累计耗时还原每个阶段的起点，写入请求追踪
+        stage_start = start
+        for stage, seconds in timings.items():
+            self._timings[stage].append(seconds)
+            if stage != "total":
+                record_span(f"image_{stage}", stage_start, seconds)
+                stage_start += seconds
+        print("图片流水线耗时: " + "，".join(f"{stage} {seconds * 1000:.0f} ms" for stage, seconds in timings.items())
+              + ("（描述缓存命中）" if cached else ""))
+
+    # --- 同步执行 ---
+
+    def run(self, source: str, question: str = None):
+        """执行完整流水线，返回 (最终回答, 图片描述, 各阶段耗时)。"""
+        llm = get_multimodal_llm()
+        if llm is None:
+            raise RuntimeError("多模态模型初始化失败，请检查 ZHIPUAI_API_KEY。")
+        timings = {}
+        start = time.perf_counter()
+
+        image = ImageInput.load(source, self.allow_local_files)
+        timings["load_image"] = time.perf_counter() - start
+
+        # 图片描述与基于问题的检索并行进行
+        question_docs = self._executor.submit(retrieve_documents, question, self.k, self.profile) if question else None
+        stage_start = time.perf_counter()
+        description = self._cached_description(image)
+        cached = description is not None
+        if not cached:
+            description = llm.invoke([image_message(image, self.description_prompt)]).content
+            self._remember_description(image, description)
+        timings["describe"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        docs = retrieve_documents(self._retrieval_query(description, question), self.k, self.profile)
+        if question_docs is not None:
+            docs = _merge_documents(docs, question_docs.result(), k=self.k)
+        timings["retrieve"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        final_prompt = self.build_prompt(description, format_docs(docs), question)
+        answer = llm.invoke([image_message(image, final_prompt)]).content
+        timings["answer"] = time.perf_counter() - stage_start
+        timings["total"] = time.perf_counter() - start
+
+        self._record(timings, cached, start)
+        return answer, description, timings
+
+    # --- 异步执行 ---
+
+    async def arun(self, source: str, question: str = None):
+        """run 的异步版本：模型调用在事件循环中进行，读取图片和检索放到线程中执行。"""
+        llm = get_multimodal_llm()
+        if llm is None:
+            raise RuntimeError("多模态模型初始化失败，请检查 ZHIPUAI_API_KEY。")
+        timings = {}
+        start = time.perf_counter()
+
+        image = await asyncio.to_thread(ImageInput.load, source, self.allow_local_files)
+        timings["load_image"] = time.perf_counter() - start
+
+        question_docs = asyncio.create_task(asyncio.to_thread(retrieve_documents, question, self.k, self.profile)) if question else None
+        stage_start = time.perf_counter()
+        description = self._cached_description(image)
+        cached = description is not None
+        if not cached:
+            description = (await llm.ainvoke([image_message(image, self.description_prompt)])).content
+            self._remember_description(image, description)
+        timings["describe"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        docs = await asyncio.to_thread(retrieve_documents, self._retrieval_query(description, question), self.k,
+                                       self.profile)
+        if question_docs is not None:
+            docs = _merge_documents(docs, await question_docs, k=self.k)
+        timings["retrieve"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        final_prompt = self.build_prompt(description, format_docs(docs), question)
+        answer = (await llm.ainvoke([image_message(image, final_prompt)])).content
+        timings["answer"] = time.perf_counter() - stage_start
+        timings["total"] = time.perf_counter() - start
+
+        self._record(timings, cached, start)
+        return answer, description, timings
+
+    def stats(self) -> dict:
+        result = {
+            "description_cache_entries": len(self._cache),
+            "description_cache_hits": self.cache_hits,
+            "description_cache_misses": self.cache_misses,
+        }
+        for stage, samples in self._timings.items():
+            values = sorted(samples)
+            result[f"{stage}_p50_ms"] = round(values[len(values) // 2] * 1000, 1) if values else 0.0
+            result[f"{stage}_p95_ms"] = round(values[min(len(values) - 1, int(0.95 * len(values)))] * 1000, 1) if values else 0.0
+        return result
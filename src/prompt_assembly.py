@@ -0,0 +1,80 @@
+"""
+Prompt 组装：把 prompt 模板拆成固定指令和可变部分，按“前缀尽量稳定”的顺序排列消息。
+
+    system  模板中的固定指令（同一模板的所有请求完全相同）
+    system  检索到的上下文（带模板中的标签，例如“背景资料:”）
+    ...     对话历史（MessagesPlaceholder）
+    human   问题（模板末尾的回答提示，例如“【罗辑】的回答:”，附在问题之后）
+
+DeepSeek 等服务会缓存相同的 prompt 前缀（命中部分按更低的价格计费，首字延迟也更短）；
+原来把上下文、问题和历史直接填进 system 消息，每次请求从第一个 token 起就不同，前缀缓存无法命中。
+
+模板仍然是普通字符串，占位符 {context}、{question}、{chat_history} 可以单独成行，也可以跟在标签后面；
+独占一行的标签（以冒号结尾）会随占位符一起移出固定指令。模板可以带统一的缩进（会被去掉）。
+"""
+import re
+import textwrap
+from functools import lru_cache
+
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+PLACEHOLDERS = ("context", "question", "chat_history")
+_PLACEHOLDER_RE = re.compile(r"\{(%s)\}" % "|".join(PLACEHOLDERS))
+
+def _is_label(line: str) -> bool:
+    line = line.strip()
+    return bool(line) and line.endswith((":", "：")) and len(line) <= 20
+
+class PromptLayout:
+    """一个 prompt 模板拆分后的结果：固定指令、上下文标签和回答提示。"""
+
+    def __init__(self, instructions: str, context_label: str = "", answer_cue: str = ""):
+        self.instructions = instructions
+        self.context_label = context_label
+        self.answer_cue = answer_cue
+
+    @classmethod
+    def parse(cls, prompt_template: str) -> "PromptLayout":
+        lines = textwrap.dedent(prompt_template).strip("\n").splitlines()
+        kept = []
+        labels = {}
+        last_placeholder = -1
+        for line in lines:
+            match = _PLACEHOLDER_RE.search(line)
+            if match is None:
+                kept.append(line)
+                continue
+            label = line[:match.start()].strip()
+            if not label and kept and _is_label(kept[-1]):
+                label = kept.pop().strip()
+            labels[match.group(1)] = label
+            last_placeholder = len(kept)
+        # 最后一个占位符之后的内容是回答提示（例如“回答:”），属于可变部分
+        answer_cue = ""
+        if last_placeholder >= 0:
+            answer_cue = "\n".join(line.strip() for line in kept[last_placeholder:] if line.strip())
+            kept = kept[:last_placeholder]
+        instructions = re.sub(r"\n{3,}", "\n\n", "\n".join(kept)).strip()
+        return cls(instructions, labels.get("context", ""), answer_cue)
+
+    def static_text(self) -> str:
+        """不随请求变化的文本（用于估算模板本身的 token 数）。"""
+        return "\n".join(part for part in (self.instructions, self.context_label, self.answer_cue) if part)
+
+    def chat_prompt(self) -> ChatPromptTemplate:
+        context = f"{self.context_label}\n{{context}}" if self.context_label else "{context}"
+        question = f"{{question}}\n\n{self.answer_cue}" if self.answer_cue else "{question}"
+        return ChatPromptTemplate.from_messages([
+            ("system", self.instructions),
+            ("system", context),
+            MessagesPlaceholder(variable_name="chat_history"),
+            ("human", question),
+        ])
+
+@lru_cache(maxsize=64)
+def parse_template(prompt_template: str) -> PromptLayout:
+    return PromptLayout.parse(prompt_template)
+
+def build_chat_prompt(prompt_template: str) -> ChatPromptTemplate:
+    """按固定指令 -> 上下文 -> 历史 -> 问题的顺序，为 prompt 模板创建 ChatPromptTemplate。"""
+    return parse_template(prompt_template).chat_prompt()
@@ -1,48 +1,283 @@
 import os
 import sys
+import time
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables import RunnablePassthrough, RunnableConfig
+from langchain_core.runnables import RunnablePassthrough, RunnableConfig, RunnableLambda, RunnableGenerator
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.messages import HumanMessage, AIMessage
-from langchain_deepseek import ChatDeepSeek
-from langchain_community.chat_models import ChatZhipuAI
-from prompt_toolkit import prompt
 
-from src.history import get_session_history
+from src.history import get_session_history, estimate_tokens
+from src.context_packing import PromptTokenMeter, pack_context
+from src.tracing import LLMSpanHandler, span
+from src.answer_cache import SemanticAnswerCache, template_key
+from src.chunk_store import load_vector_store
+from src.faiss_index import set_search_params
+from src.embedding_service import EmbeddingService, set_torch_threads
+from src.reranker import CrossEncoderReranker
+from src.index_registry import IndexRegistry, RetrievalProfile, load_profile_overrides, parse_index_paths
+from src.llm_gateway import GatewayChatModel, LLMGateway, create_chat_gateway, zhipu_provider
+from src.prompt_assembly import build_chat_prompt, parse_template
+from src.response_memo import MemoizedChatModel, ResponseMemo
 
 # 将项目根目录添加到 sys.path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # --- LLM 初始化 ---
+# 客户端由 LLM 网关（src/llm_gateway.py）统一创建：连接池、并发上限、超时、对冲请求和熔断都在网关中处理
 
 def get_deepseek_llm():
-    """获取并初始化 DeepSeek LLM"""
-    deepseek_api_key = os.getenv("DEEPSEEK_API_KEY")
-    if not deepseek_api_key:
-        print("错误: 未找到 DEEPSEEK_API_KEY。")
-        return None
-    return ChatDeepSeek(
-        api_key=deepseek_api_key,
-        model="deepseek-chat",
-        temperature=0.1,
-    )
+    """
+    获取进程内共享的文本模型：按 LLM_PROVIDERS 顺序使用 DeepSeek 和智谱 GLM-4，
+    DeepSeek 慢时向 GLM-4 发对冲请求、出错或熔断时切换到 GLM-4。未配置任何 API Key 时返回 None。
+    """
+    global _chat_llm
+    if _chat_llm is None:
+        with _resource_lock:
+            if _chat_llm is None:
+                _chat_llm = create_chat_gateway()
+                if _chat_llm is None:
+                    print("错误: 未找到 DEEPSEEK_API_KEY 或 ZHIPUAI_API_KEY。")
+    return _chat_llm
 
 def get_zhipu_llm(is_multimodal=False):
-    """获取并初始化 ZhipuAI LLM"""
-    zhipuai_api_key = os.getenv("ZHIPUAI_API_KEY")
-    if not zhipuai_api_key:
+    """创建只使用智谱模型（GLM-4 或 GLM-4V）的网关模型，复用同一个连接池，不做对冲。"""
+    provider = zhipu_provider(model="glm-4v" if is_multimodal else "glm-4")
+    if provider is None:
         print("错误: 未找到 ZHIPUAI_API_KEY。")
         return None
-    model_name = "glm-4v" if is_multimodal else "glm-4"
-    return ChatZhipuAI(
-        api_key=zhipuai_api_key,
-        model=model_name,
-        temperature=0.1,
-    )
+    return GatewayChatModel(gateway=LLMGateway([provider]))
+
+# --- 共享资源（进程级单例） ---
+
+VECTOR_STORE_PATH = os.getenv("RAG_VECTOR_STORE_PATH", 'vector_store/faiss_index_three_body_full')
+# 多索引：默认索引名为 DEFAULT_INDEX_NAME（路径为 VECTOR_STORE_PATH），
+# 其他索引用 RAG_INDEXES="characters=path,wiki=path" 登记，首次检索时才加载；RAG_SEARCH_THREADS 为并行检索的线程数
+DEFAULT_INDEX_NAME = "three_body"
+EXTRA_INDEXES = os.getenv("RAG_INDEXES", "")
+SEARCH_THREADS = int(os.getenv("RAG_SEARCH_THREADS", "4"))
+EMBEDDING_MODEL_NAME = 'moka-ai/m3e-base'
+RETRIEVER_K = 3
+# 问题向量服务：LRU 缓存条数、微批等待窗口（毫秒，0 表示不合批）、最大批大小和 torch CPU 线程数（0 表示默认）
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_MAX_BATCH = int(os.getenv("EMBEDDING_MAX_BATCH", "32"))
+EMBEDDING_TORCH_THREADS = int(os.getenv("EMBEDDING_TORCH_THREADS", "0"))
+# IVF / HNSW 索引的查询参数（flat 索引会忽略）
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "8"))
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+# 混合检索：向量检索与字符二元组 BM25 各取 HYBRID_CANDIDATES 个候选，用倒数排名融合（RRF）合并；
+# RAG_HYBRID=0 或索引目录下没有倒排索引时只使用向量检索
+HYBRID_RETRIEVAL = os.getenv("RAG_HYBRID", "1") == "1"
+HYBRID_CANDIDATES = int(os.getenv("RAG_HYBRID_CANDIDATES", "20"))
+RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+# 可选的交叉编码器重排序：先取 RERANK_CANDIDATES 个候选，重排后保留 RETRIEVER_K 个；
+# 预计耗时超过 RERANK_BUDGET_MS 或排队的重排请求达到 RERANK_MAX_WAITING 时跳过重排
+RERANK_ENABLED = os.getenv("RAG_RERANK", "0") == "1"
+RERANK_MODEL_NAME = os.getenv("RERANK_MODEL", "BAAI/bge-reranker-base")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "30"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "300"))
+RERANK_MAX_WAITING = int(os.getenv("RERANK_MAX_WAITING", "2"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "10000"))
+# prompt token 预算：上下文最多 CONTEXT_TOKEN_BUDGET 个 token，且模板 + 上下文 + 历史 + 问题合计不超过
+# PROMPT_TOKEN_BUDGET；历史较长时压缩上下文，但至少保留 CONTEXT_MIN_TOKENS 个 token
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+CONTEXT_MIN_TOKENS = int(os.getenv("CONTEXT_MIN_TOKENS", "300"))
+# 按 prompt 模板缓存的已编译链数量上限（LRU 淘汰）
+CHAIN_CACHE_SIZE = int(os.getenv("RAG_CHAIN_CACHE_SIZE", "16"))
+
+_resource_lock = threading.RLock()
+_embeddings = None
+_index_registry = None
+_chat_llm = None
+_multimodal_llm = None
+_reranker = None
+
+_chain_cache = OrderedDict()
+_chain_cache_lock = threading.Lock()
+_prompt_meter = PromptTokenMeter()
+
+# 语义答案缓存配置：ANSWER_CACHE_SIZE=0 表示关闭；ANSWER_CACHE_PATH 为空表示只保存在内存中
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600)))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "")
+_answer_cache = None
+
+# LLM 回答的精确匹配缓存（最终消息 + 模型参数完全相同才命中）：LLM_MEMO_SIZE=0 表示关闭；LLM_MEMO_PATH 为空表示只保存在内存中
+LLM_MEMO_SIZE = int(os.getenv("LLM_MEMO_SIZE", "1000"))
+LLM_MEMO_TTL = float(os.getenv("LLM_MEMO_TTL", str(24 * 3600)))
+LLM_MEMO_PATH = os.getenv("LLM_MEMO_PATH", "")
+_response_memo = None
+
+def get_embeddings():
+    """获取进程内共享的问题向量服务（带缓存和微批处理的 Embedding 模型），首次调用时加载。"""
+    global _embeddings
+    if _embeddings is None:
+        with _resource_lock:
+            if _embeddings is None:
+                print(f"正在加载 Embedding 模型: {EMBEDDING_MODEL_NAME}")
+                from langchain_community.embeddings import HuggingFaceEmbeddings
+                set_torch_threads(EMBEDDING_TORCH_THREADS)
+                _embeddings = EmbeddingService(
+                    HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME),
+                    cache_size=EMBEDDING_CACHE_SIZE,
+                    batch_window_ms=EMBEDDING_BATCH_WINDOW_MS,
+                    max_batch=EMBEDDING_MAX_BATCH,
+                )
+    return _embeddings
+
+def embedding_stats():
+    """返回问题向量服务的缓存命中率、批大小和延迟统计，模型尚未加载时返回 None。"""
+    return _embeddings.stats() if isinstance(_embeddings, EmbeddingService) else None
+
+def _load_index(path: str):
+    vector_store = load_vector_store(path, get_embeddings())
+    set_search_params(vector_store.index, nprobe=FAISS_NPROBE, ef_search=FAISS_EF_SEARCH)
+    return vector_store
+
+def get_index_registry() -> IndexRegistry:
+    """获取进程内共享的索引注册表：登记默认索引和 RAG_INDEXES 中的索引，索引本身在首次使用时加载。"""
+    global _index_registry
+    if _index_registry is None:
+        with _resource_lock:
+            if _index_registry is None:
+                registry = IndexRegistry(_load_index, hybrid=HYBRID_RETRIEVAL, max_workers=SEARCH_THREADS)
+                registry.register(DEFAULT_INDEX_NAME, VECTOR_STORE_PATH)
+                for name, path in parse_index_paths(EXTRA_INDEXES).items():
+                    registry.register(name, path)
+                _index_registry = registry
+    return _index_registry
+
+def get_vector_store(name: str = DEFAULT_INDEX_NAME):
+    """
+    获取进程内共享的 FAISS 向量数据库（默认为《三体》全文索引），首次调用时加载，加载失败会抛出异常。
+    文档块从 mmap 文档块存储按需读取（只有 index.pkl 的旧索引需要先用 src/chunk_store.py migrate 转换）。
+    """
+    return get_index_registry().get(name).vector_store
+
+def get_lexical_index(name: str = DEFAULT_INDEX_NAME):
+    """获取与向量数据库配套的 BM25 倒排索引；未启用混合检索或索引不存在时返回 None。"""
+    if not HYBRID_RETRIEVAL:
+        return None
+    return get_index_registry().get(name).lexical_index
+
+def index_stats():
+    """返回已登记索引的加载状态、向量数和检索次数。"""
+    return _index_registry.stats() if _index_registry is not None else None
+
+def get_reranker():
+    """获取进程内共享的交叉编码器重排序器，未启用重排时返回 None（模型在首次重排时加载）。"""
+    global _reranker
+    if not RERANK_ENABLED:
+        return None
+    if _reranker is None:
+        with _resource_lock:
+            if _reranker is None:
+                _reranker = CrossEncoderReranker(
+                    RERANK_MODEL_NAME,
+                    batch_size=RERANK_BATCH_SIZE,
+                    cache_size=RERANK_CACHE_SIZE,
+                    budget_ms=RERANK_BUDGET_MS,
+                    max_waiting=RERANK_MAX_WAITING,
+                )
+    return _reranker
+
+def rerank_stats():
+    """返回重排序的执行/跳过次数、打分缓存命中率和延迟统计，未启用时返回 None。"""
+    return _reranker.stats() if _reranker is not None else None
+
+def get_multimodal_llm():
+    """获取进程内共享的多模态模型（GLM-4V）客户端，初始化失败时返回 None，下次调用会重试。"""
+    global _multimodal_llm
+    if _multimodal_llm is None:
+        with _resource_lock:
+            if _multimodal_llm is None:
+                _multimodal_llm = get_zhipu_llm(is_multimodal=True)
+    return _multimodal_llm
+
+def llm_stats():
+    """
+    返回文本模型和多模态模型各服务的请求数、失败/超时/繁忙次数、对冲胜出次数、延迟分位数和熔断状态，
+    以及精确匹配回答缓存的命中率。
+    """
+    return {
+        "chat": _chat_llm.stats() if _chat_llm is not None else None,
+        "multimodal": _multimodal_llm.stats() if _multimodal_llm is not None else None,
+        "memo": _response_memo.stats() if _response_memo is not None else None,
+    }
+
+def get_response_memo():
+    """获取进程内共享的 LLM 回答精确匹配缓存，未启用时返回 None。"""
+    global _response_memo
+    if LLM_MEMO_SIZE <= 0:
+        return None
+    if _response_memo is None:
+        with _resource_lock:
+            if _response_memo is None:
+                _response_memo = ResponseMemo(
+                    max_entries=LLM_MEMO_SIZE,
+                    ttl_seconds=LLM_MEMO_TTL,
+                    persist_path=LLM_MEMO_PATH or None,
+                )
+    return _response_memo
+
+def get_answer_cache():
+    """获取进程内共享的语义答案缓存，未启用时返回 None。"""
+    global _answer_cache
+    if ANSWER_CACHE_SIZE <= 0:
+        return None
+    if _answer_cache is None:
+        with _resource_lock:
+            if _answer_cache is None:
+                _answer_cache = SemanticAnswerCache(
+                    max_entries=ANSWER_CACHE_SIZE,
+                    ttl_seconds=ANSWER_CACHE_TTL,
+                    similarity_threshold=ANSWER_CACHE_THRESHOLD,
+                    persist_path=ANSWER_CACHE_PATH or None,
+                )
+    return _answer_cache
+
+def clear_rag_chain_cache():
+    """清空已编译的 RAG 链缓存（共享的模型和索引不受影响）。"""
+    with _chain_cache_lock:
+        _chain_cache.clear()
+
+# --- 检索配置 ---
+
+# 每种对话模式绑定一个检索配置；未登记的索引（如尚未构建的角色档案、百科）会被跳过。
+# 可用 RAG_RETRIEVAL_PROFILES（JSON）覆盖，见 src/index_registry.py
+RETRIEVAL_PROFILES = load_profile_overrides({
+    # 普通问答：只查全文，少量文档块即可
+    "qa": RetrievalProfile("qa", [DEFAULT_INDEX_NAME, "wiki"], k=RETRIEVER_K, candidates=HYBRID_CANDIDATES),
+    # 角色扮演：全文加角色档案；"role_play:<角色>" 只检索提到该角色的文档块，见 get_retrieval_profile
+    "role_play": RetrievalProfile("role_play", [DEFAULT_INDEX_NAME, "characters"], k=4,
+                                  candidates=HYBRID_CANDIDATES),
+    # 决策模拟：需要更多背景资料，上下文预算更大
+    "decision": RetrievalProfile("decision", [DEFAULT_INDEX_NAME, "wiki"], k=6, candidates=HYBRID_CANDIDATES,
+                                 context_tokens=int(CONTEXT_TOKEN_BUDGET * 1.5)),
+    # 图片问答：按图片描述检索全文
+    "image": RetrievalProfile("image", [DEFAULT_INDEX_NAME], k=RETRIEVER_K, candidates=HYBRID_CANDIDATES),
+}, os.getenv("RAG_RETRIEVAL_PROFILES", ""))
+
+def get_retrieval_profile(profile="qa") -> RetrievalProfile:
+    """
+    按名称获取检索配置（也可以直接传入 RetrievalProfile），未知名称时使用 qa。
+    "<配置>:<角色>" 在该配置上加上人物过滤，例如 "role_play:叶文洁" 只检索提到叶文洁的文档块
+    （有元数据过滤索引时在检索前过滤，没有结果时退回不过滤的检索）。
+    """
+    if isinstance(profile, RetrievalProfile):
+        return profile
+    base, _, character = profile.partition(":")
+    if character:
+        return get_retrieval_profile(base).with_overrides(name=profile, filter={"characters": character})
+    if profile not in RETRIEVAL_PROFILES:
+        print(f"未知的检索配置 {profile}，使用 qa。")
+        profile = "qa"
+    return RETRIEVAL_PROFILES[profile]
 
 # --- RAG 链构建 ---
 
@@ -58,51 +293,167 @@ DEFAULT_PROMPT_TEMPLATE = """
 {question}
 """
 
-def create_rag_chain(llm, prompt_template: str = DEFAULT_PROMPT_TEMPLATE):
+def create_rag_chain(llm, prompt_template: str = DEFAULT_PROMPT_TEMPLATE, profile="qa"):
     """
-    创建并返回一个支持对话历史的 RAG 链。
+    创建并返回一个支持对话历史的 RAG 链，检索使用 profile 指定的检索配置（名称或 RetrievalProfile）。
+    Embedding 模型和向量数据库在进程内只加载一次；相同 llm + prompt 模板 + 检索配置的链会被复用。
     """
     # 加载环境变量
     load_dotenv()
 
-    # 1. 加载向量数据库
-    vector_store_path = 'vector_store/faiss_index_three_body_full'
-    embedding_model_name = 'moka-ai/m3e-base'
-    embeddings = HuggingFaceEmbeddings(model_name=embedding_model_name)
+    profile = get_retrieval_profile(profile)
+    cache_key = (id(llm), prompt_template, profile.cache_key())
+    with _chain_cache_lock:
+        cached = _chain_cache.get(cache_key)
+        if cached is not None:
+            _chain_cache.move_to_end(cache_key)
+            return cached[1]
+
+    # 1. 获取共享的向量数据库（profile 中的其他索引在首次检索时加载）
     try:
-        vector_store = FAISS.load_local(
-            vector_store_path, 
-            embeddings, 
-            allow_dangerous_deserialization=True
-        )
+        vector_store = get_vector_store(profile.indexes[0] if profile.indexes else DEFAULT_INDEX_NAME)
     except Exception as e:
         print(f"加载向量数据库失败: {e}")
         return None
-    retriever = vector_store.as_retriever(search_kwargs={"k": 3})
 
-    # 2. 创建带有历史记录的 Prompt 模板
-    # MessagesPlaceholder 用于为历史消息列表提供占位符
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", prompt_template),
-        MessagesPlaceholder(variable_name="chat_history"),
-        ("human", "{question}"),
-    ])
+    chain_with_history = _build_rag_chain(
+        llm, prompt_template, vector_store.embedding_function, profile, get_answer_cache(),
+        reranker=get_reranker(), response_memo=get_response_memo()
+    )
 
-    # 3. 构建 RAG 链
-    def format_docs(docs):
-        return "\n\n".join(doc.page_content for doc in docs)
+    with _chain_cache_lock:
+        # 缓存中同时保存 llm 引用，保证 id(llm) 在条目存活期间不会被复用
+        _chain_cache[cache_key] = (llm, chain_with_history)
+        _chain_cache.move_to_end(cache_key)
+        while len(_chain_cache) > CHAIN_CACHE_SIZE:
+            _chain_cache.popitem(last=False)
 
-    # 核心链：接收包含 question 和 chat_history 的字典，
-    # 添加 context，然后传递给 prompt, llm, parser
-    rag_chain = (
-        RunnablePassthrough.assign(
-            context=lambda x: format_docs(retriever.invoke(x["question"]))
-        )
+    return chain_with_history
+
+def format_docs(docs, token_budget: int = CONTEXT_TOKEN_BUDGET):
+    """去重、合并重叠的文档块，并在 token 预算内拼接成上下文文本。"""
+    return pack_context(docs, token_budget)[0]
+
+def prompt_stats():
+    """返回每次请求 prompt token 数（总计/上下文/历史）的分位数。"""
+    stats = _prompt_meter.snapshot()
+    stats["budget"] = PROMPT_TOKEN_BUDGET
+    return stats
+
+def search_documents(profile, question: str, question_vector, k: int = None, reranker=None):
+    """
+    按检索配置在一个或多个索引上并行检索（向量检索，以及可选的倒排索引），按分数合并后返回 k 个文档块（默认 profile.k）。
+    提供 reranker 时先取 RERANK_CANDIDATES 个候选，再用交叉编码器重排后保留 k 个。
+    """
+    profile = get_retrieval_profile(profile)
+    k = k or profile.k
+    fetch_k = max(k, RERANK_CANDIDATES) if reranker is not None else k
+    docs = get_index_registry().search(profile, question, question_vector, k=fetch_k, rrf_k=RRF_K)
+    if reranker is not None:
+        docs = reranker.rerank(question, docs, top_n=k)
+    return docs
+
+def retrieve_documents(question: str, k: int = None, profile="qa"):
+    """只做检索、不调用 LLM：使用共享的索引和重排序器返回与问题最相关的文档块。"""
+    question_vector = get_embeddings().embed_query(question)
+    return search_documents(profile, question, question_vector, k, get_reranker())
+
+def answer_cache_partition(prompt_template: str, profile) -> str:
+    """语义答案缓存的分区键：同一 prompt 模板 + 检索配置的链共享一个分区。"""
+    return template_key(prompt_template + repr(get_retrieval_profile(profile).cache_key()))
+
+def _build_rag_chain(llm, prompt_template, embeddings, profile, answer_cache=None, reranker=None,
+                     response_memo=None):
+    """根据 prompt 模板和检索配置组装带历史记录的 RAG 链。"""
+    # 1. 创建带有历史记录的 Prompt 模板
+    # 按固定指令 -> 上下文 -> 历史 -> 问题排列消息，同一模板的请求共享尽量长的 prompt 前缀（见 src/prompt_assembly.py）
+    prompt = build_chat_prompt(prompt_template)
+    if response_memo is not None:
+        llm = MemoizedChatModel(llm=llm, memo=response_memo)
+
+    # 2. 构建 RAG 链
+    # 问题向量只计算一次，同时用于答案缓存查找和向量检索；
+    # 调用方（例如离线批处理 src/batch_qa.py）可以在输入中直接给出 question_vector 和检索结果 docs
+    def embed_question(x):
+        if x.get("question_vector") is not None:
+            return x["question_vector"]
+        with span("embed"):
+            return embeddings.embed_query(x["question"])
+
+    async def aembed_question(x):
+        if x.get("question_vector") is not None:
+            return x["question_vector"]
+        with span("embed"):
+            return await embeddings.aembed_query(x["question"])
+
+    # 模板本身（固定指令和标签）的 token 数只计算一次
+    template_tokens = estimate_tokens(parse_template(prompt_template).static_text())
+
+    context_budget = profile.context_tokens or CONTEXT_TOKEN_BUDGET
+
+    def pack_prompt_context(docs, x):
+        history_tokens = sum(estimate_tokens(m.content) for m in x.get("chat_history", []))
+        question_tokens = estimate_tokens(x["question"])
+        budget = min(context_budget, PROMPT_TOKEN_BUDGET - template_tokens - history_tokens - question_tokens)
+        context, info = pack_context(docs, max(budget, CONTEXT_MIN_TOKENS))
+        total = _prompt_meter.record(template_tokens, info["tokens"], history_tokens, question_tokens, PROMPT_TOKEN_BUDGET)
+        print(f"prompt tokens: 模板 {template_tokens} + 上下文 {info['tokens']}"
+              f"（{info['chunks']} 块 -> {info['pieces']} 段，去重 {info['duplicates']}，合并 {info['merged']}）"
+              f" + 历史 {history_tokens} + 问题 {question_tokens} = {total} / {PROMPT_TOKEN_BUDGET}")
+        return context
+
+    def retrieve_context(x):
+        docs = x.get("docs")
+        if docs is None:
+            with span("search"):
+                docs = search_documents(profile, x["question"], x["question_vector"], reranker=reranker)
+        with span("prompt"):
+            return pack_prompt_context(docs, x)
+
+    generate_chain = (
+        RunnablePassthrough.assign(context=retrieve_context)
         | prompt
-        | llm
+        | llm.with_config(callbacks=[LLMSpanHandler()])
         | StrOutputParser()
     )
 
+    # 3. 语义答案缓存（只用于没有对话历史的提问）：命中时直接返回，未命中时生成答案并写回缓存；
+    # 输入中 skip_cache_lookup 为真时不查缓存，生成的答案仍然写入（离线批处理用它保证每个问题都由链生成）
+    cache_partition = answer_cache_partition(prompt_template, profile)
+    def answer_or_generate(x):
+        # 有对话历史时回答依赖上下文（例如“他后来呢”），不能与其他会话共享，既不查缓存也不写入
+        if answer_cache is None or x.get("chat_history"):
+            return generate_chain
+        cached_answer = None if x.get("skip_cache_lookup") else answer_cache.lookup(cache_partition, x["question_vector"])
+        if cached_answer is not None:
+            print("语义答案缓存命中。")
+            return cached_answer
+
+        parts = []
+        def remember(answer):
+            answer_cache.put(cache_partition, x["question_vector"], x["question"], answer)
+
+        def remember_answer(chunks):
+            for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+            remember("".join(parts))
+
+        async def aremember_answer(chunks):
+            async for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+            remember("".join(parts))
+
+        return generate_chain | RunnableGenerator(remember_answer, aremember_answer)
+
+    # 核心链：接收包含 question 和 chat_history 的字典，
+    # 添加 question_vector 和 context，然后传递给 prompt, llm, parser
+    rag_chain = (
+        RunnablePassthrough.assign(question_vector=RunnableLambda(embed_question, afunc=aembed_question))
+        | RunnableLambda(answer_or_generate)
+    )
+
     # 4. 使用 RunnableWithMessageHistory 包装 RAG 链
     chain_with_history = RunnableWithMessageHistory(
         rag_chain,
@@ -113,25 +464,103 @@ def create_rag_chain(llm, prompt_template: str = DEFAULT_PROMPT_TEMPLATE):
     
     return chain_with_history
 
-def invoke_multimodal_chain(llm, image_url: str, question: str) -> str:
+# --- 流式输出 ---
+
+SENTENCE_ENDINGS = "。！？!?；;\n"
+
+class TimedStream:
     """
-    调用多模态 LLM (如 GLM-4V) 来处理结合了图片和文本的问题。
-    
-    参数:
-    - llm: 一个已经初始化的多模态聊天模型实例。
-    - image_url: 指向图片的公开可访问 URL。
-    - question: 关于图片的文本问题或提示。
-    
-    返回:
-    - LLM 生成的文本回答。
-    """
-    msg = HumanMessage(
-        content=[
-            {"type": "text", "text": question},
-            {"type": "image_url", "image_url": {"url": image_url}},
-        ]
-    )
-    response = llm.invoke([msg])
-    return response.content
+    包装 chain.stream，逐块产出生成的文本，同时记录首字延迟（TTFT）和总耗时。
+    迭代结束后可通过 text / first_token_seconds / total_seconds 读取结果。
+    """
+
+    def __init__(self, chain, inputs: dict, config=None):
+        self.chain = chain
+        self.inputs = inputs
+        self.config = config
+        self.text = ""
+        self.first_token_seconds = None
+        self.total_seconds = None
+
+    def __iter__(self):
+        start = time.perf_counter()
+        parts = []
+        for chunk in self.chain.stream(self.inputs, config=self.config):
+            if self._record(chunk, start, parts):
+                yield chunk
+        self._finish(start, parts)
+
+    async def __aiter__(self):
+        start = time.perf_counter()
+        parts = []
+        async for chunk in self.chain.astream(self.inputs, config=self.config):
+            if self._record(chunk, start, parts):
+                yield chunk
+        self._finish(start, parts)
+
+    def _record(self, chunk, start, parts) -> bool:
+        if not chunk:
+            return False
+        if self.first_token_seconds is None:
+            self.first_token_seconds = time.perf_counter() - start
+        parts.append(chunk)
+        return True
+
+    def _finish(self, start, parts):
+        self.total_seconds = time.perf_counter() - start
+        self.text = "".join(parts)
+
+    def summary(self) -> str:
+        ttft = f"{self.first_token_seconds:.2f}s" if self.first_token_seconds is not None else "-"
+        total = f"{self.total_seconds:.2f}s" if self.total_seconds is not None else "-"
+        return f"首字延迟 {ttft}，总耗时 {total}"
+
+class _SentenceBatcher:
+    """按句子边界累积文本；第一段达到 min_chars 后产出，之后每段的最小长度按 growth 倍增。"""
+
+    def __init__(self, min_chars: int, growth: float):
+        self.buffer = ""
+        self.threshold = min_chars
+        self.growth = growth
+
+    def feed(self, chunk: str):
+        self.buffer += chunk
+        if len(self.buffer) < self.threshold:
+            return None
+        cut = max(self.buffer.rfind(ch) for ch in SENTENCE_ENDINGS)
+        if cut + 1 < self.threshold:
+            return None
+        segment, self.buffer = self.buffer[:cut + 1], self.buffer[cut + 1:]
+        self.threshold = int(self.threshold * self.growth)
+        return segment.strip() or None
+
+    def flush(self):
+        segment, self.buffer = self.buffer.strip(), ""
+        return segment or None
+
+def iter_sentence_batches(chunks, min_chars: int = 60, growth: float = 2.0):
+    """
+    把流式文本块按句子边界合并成若干段产出。
+    第一段达到 min_chars 后立即产出，之后每段的最小长度按 growth 倍增，使总段数保持在少数几段。
+    """
+    batcher = _SentenceBatcher(min_chars, growth)
+    for chunk in chunks:
+        segment = batcher.feed(chunk)
+        if segment:
+            yield segment
+    segment = batcher.flush()
+    if segment:
+        yield segment
+
+async def aiter_sentence_batches(chunks, min_chars: int = 60, growth: float = 2.0):
+    """iter_sentence_batches 的异步版本，输入为异步迭代器。"""
+    batcher = _SentenceBatcher(min_chars, growth)
+    async for chunk in chunks:
+        segment = batcher.feed(chunk)
+        if segment:
+            yield segment
+    segment = batcher.flush()
+    if segment:
+        yield segment
 
 # (移除主执行块)
@@ -0,0 +1,236 @@
+"""
+可选的交叉编码器（cross-encoder）重排序阶段：检索阶段多取 20~50 个候选，
+用本地 CPU 上的小型交叉编码器对 (问题, 文档块) 打分，只保留得分最高的几个作为上下文。
+
+- 批量推理：一次 predict 处理一个问题的全部未缓存候选；
+- 打分缓存：以 (规范化问题, 文档块内容哈希) 为键的 LRU 缓存；
+- 延迟预算：根据最近的单对打分耗时估算本次重排的耗时，超出预算或排队的重排请求过多时跳过重排，
+  直接使用检索阶段的排序。
+
+对比有无重排时的命中率和延迟：
+    python src/reranker.py --index-path vector_store/faiss_index_three_body_full --candidates 20 50
+"""
+import os
+import sys
+# 将项目根目录添加到 sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import hashlib
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+
+from src.embedding_service import normalize_query
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def _doc_key(doc) -> str:
+    return hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()[:16]
+
+class CrossEncoderReranker:
+    """
+    交叉编码器重排序器，模型在首次使用时加载。
+    budget_ms 为单次重排允许的预计耗时；同时等待推理的请求超过 max_waiting 时视为高负载并跳过重排。
+    """
+
+    def __init__(self, model_name: str = "BAAI/bge-reranker-base", batch_size: int = 16, max_length: int = 512,
+                 cache_size: int = 10000, budget_ms: float = 300, max_waiting: int = 2, model=None):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.cache_size = cache_size
+        self.budget_ms = budget_ms
+        self.max_waiting = max_waiting
+        self._model = model
+        self._model_lock = threading.Lock()
+        # 推理锁：CPU 上同一时刻只做一次批量推理，避免多个线程争抢核心
+        self._inference_lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._waiting = 0
+        # 最近的单对打分耗时（秒），用于估算重排耗时；首次推理前不做预算检查
+        self._pair_seconds = None
+        self._latencies = deque(maxlen=1000)
+        self.reranked = 0
+        self.skipped_budget = 0
+        self.skipped_load = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    from sentence_transformers import CrossEncoder
+                    print(f"正在加载重排序模型: {self.model_name}")
+                    self._model = CrossEncoder(self.model_name, max_length=self.max_length, device="cpu")
+        return self._model
+
+    def _cached_scores(self, query_key: str, docs, count: bool = True):
+        scores = {}
+        with self._cache_lock:
+            for doc in docs:
+                key = (query_key, _doc_key(doc))
+                score = self._cache.get(key)
+                if score is not None:
+                    self._cache.move_to_end(key)
+                    scores[key[1]] = score
+            if count:
+                self.cache_hits += len(scores)
+                self.cache_misses += len(docs) - len(scores)
+        return scores
+
+    def _remember(self, query_key: str, scores: dict):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            for doc_key, score in scores.items():
+                self._cache[(query_key, doc_key)] = score
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def score(self, query: str, docs) -> list:
+        """返回每个文档块与问题的相关性得分（不做预算检查）。"""
+        query_key = normalize_query(query)
+        scores = self._cached_scores(query_key, docs)
+        missing = {}
+        for doc in docs:
+            key = _doc_key(doc)
+            if key not in scores:
+                missing.setdefault(key, doc.page_content)
+        if missing:
+            with self._cache_lock:
+                self._waiting += 1
+            try:
+                with self._inference_lock:
+                    start = time.perf_counter()
+                    predicted = self.model.predict(
+                        [(query_key, text) for text in missing.values()], batch_size=self.batch_size
+                    )
+                    elapsed = time.perf_counter() - start
+            finally:
+                with self._cache_lock:
+                    self._waiting -= 1
+            per_pair = elapsed / len(missing)
+            self._pair_seconds = per_pair if self._pair_seconds is None else 0.8 * self._pair_seconds + 0.2 * per_pair
+            fresh = {key: float(s) for key, s in zip(missing, predicted)}
+            self._remember(query_key, fresh)
+            scores.update(fresh)
+        return [scores[_doc_key(doc)] for doc in docs]
+
+    def rerank(self, query: str, docs, top_n: int) -> list:
+        """按交叉编码器得分重排并保留前 top_n 个；超出延迟预算或负载过高时保持原顺序。"""
+        if len(docs) <= 1:
+            return list(docs[:top_n])
+        if self._waiting >= self.max_waiting:
+            self.skipped_load += 1
+            return list(docs[:top_n])
+        if self._pair_seconds is not None and self.budget_ms > 0:
+            uncached = len(docs) - len(self._cached_scores(normalize_query(query), docs, count=False))
+            if uncached * self._pair_seconds * 1000 > self.budget_ms:
+                self.skipped_budget += 1
+                # 估计值逐次衰减，负载恢复后会重新尝试重排并得到新的耗时测量
+                self._pair_seconds *= 0.9
+                return list(docs[:top_n])
+
+        start = time.perf_counter()
+        scores = self.score(query, docs)
+        order = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)
+        self._latencies.append(time.perf_counter() - start)
+        self.reranked += 1
+        return [docs[i] for i in order[:top_n]]
+
+    def stats(self) -> dict:
+        latencies = list(self._latencies)
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "model": self.model_name,
+            "reranked": self.reranked,
+            "skipped_budget": self.skipped_budget,
+            "skipped_load": self.skipped_load,
+            "pair_cache_entries": len(self._cache),
+            "pair_cache_hit_rate": round(self.cache_hits / lookups, 3) if lookups else 0.0,
+            "pair_ms_estimate": round(self._pair_seconds * 1000, 2) if self._pair_seconds else None,
+            "rerank_p50_ms": round(_percentile(latencies, 0.5) * 1000, 1),
+            "rerank_p95_ms": round(_percentile(latencies, 0.95) * 1000, 1),
+        }
+
+# --- 基准测试 ---
+
+# 留出问题集：不参与检索参数调整，(问题, 正确上下文中必须出现的关键词)
+HELD_OUT_QUESTIONS = [
+    ("汪淼参加的那个网络游戏叫什么？", "三体"),
+    ("纳米材料飞刃是谁研究的？", "汪淼"),
+    ("杨冬为什么自杀？", "杨冬"),
+    ("丁仪是做什么研究的？", "丁仪"),
+    ("伊文斯为什么要建立第二红岸基地？", "伊文斯"),
+    ("审判日号上发生了什么？", "审判日"),
+    ("三体人是怎样脱水的？", "脱水"),
+    ("罗辑为什么被选为面壁者？", "罗辑"),
+    ("章北海为什么要劫持自然选择号？", "章北海"),
+    ("水滴是怎样摧毁人类舰队的？", "水滴"),
+    ("程心为什么被选为执剑人？", "执剑人"),
+    ("云天明送给程心的礼物是什么？", "星星"),
+    ("二向箔是什么？", "二向箔"),
+    ("维德说的“前进！不择手段地前进！”是在什么场合？", "维德"),
+]
+
+def run_benchmark(index_path: str, embedding_model_name: str, reranker: CrossEncoderReranker,
+                  candidate_counts=(20, 50), k: int = 3):
+    """在留出问题集上比较“只检索 k 个”与“多取候选再重排”的 hit@k 和单次检索延迟。"""
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    from src.chunk_store import load_vector_store
+    from src.lexical_index import LexicalIndex, has_lexical_index, hybrid_search
+
+    embeddings = HuggingFaceEmbeddings(model_name=embedding_model_name)
+    vector_store = load_vector_store(index_path, embeddings)
+    lexical_index = LexicalIndex.load(index_path) if has_lexical_index(index_path) else None
+
+    def retrieve(question, vector, n):
+        if lexical_index is not None:
+            return hybrid_search(vector_store, lexical_index, question, vector, k=n, candidates=max(20, n))
+        return vector_store.similarity_search_by_vector(vector, k=n)
+
+    questions = [q for q, _ in HELD_OUT_QUESTIONS]
+    vectors = embeddings.embed_documents(questions)
+    # 关闭预算检查和缓存，测量真实的重排耗时
+    reranker.budget_ms = 0
+    reranker.cache_size = 0
+    reranker.score(questions[0], retrieve(questions[0], vectors[0], 2))
+
+    configs = [("检索 top-%d" % k, 0)] + [(f"候选 {n} + 重排", n) for n in candidate_counts]
+    print(f"{'配置':<16}{'hit@' + str(k):>8}{'p50(ms)':>10}{'p95(ms)':>10}")
+    for name, candidates in configs:
+        hits, latencies = 0, []
+        for (question, keyword), vector in zip(HELD_OUT_QUESTIONS, vectors):
+            start = time.perf_counter()
+            docs = retrieve(question, vector, candidates or k)
+            if candidates:
+                docs = reranker.rerank(question, docs, top_n=k)
+            latencies.append(time.perf_counter() - start)
+            hits += any(keyword.lower() in unicodedata.normalize("NFKC", d.page_content).lower() for d in docs)
+        print(f"{name:<16}{f'{hits}/{len(HELD_OUT_QUESTIONS)}':>8}"
+              f"{_percentile(latencies, 0.5) * 1000:>10.1f}{_percentile(latencies, 0.95) * 1000:>10.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="交叉编码器重排序的命中率/延迟基准测试")
+    parser.add_argument("--index-path", default='vector_store/faiss_index_three_body_full')
+    parser.add_argument("--model", default='moka-ai/m3e-base', help="Embedding 模型")
+    parser.add_argument("--rerank-model", default="BAAI/bge-reranker-base")
+    parser.add_argument("--candidates", type=int, nargs="+", default=[20, 50])
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+
+    run_benchmark(
+        args.index_path, args.model,
+        CrossEncoderReranker(args.rerank_model, batch_size=args.batch_size),
+        candidate_counts=args.candidates, k=args.k,
+    )
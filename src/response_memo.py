@@ -0,0 +1,216 @@
+"""
+LLM 回答的精确匹配缓存：键为最终发送给模型的消息（角色 + 内容）和模型参数（模型名、温度、stop 等）的哈希。
+
+与语义答案缓存（src/answer_cache.py，按问题向量相似度命中，只看问题）不同，这里只有 prompt 完全相同时才命中：
+上下文、对话历史、模板任何一处不同都会重新生成。适合确定性的重放（压测、回归评估）和重复的决策分析。
+
+- 条目数量受 max_entries 限制（LRU 淘汰），并在 ttl_seconds 后过期；
+- 指定 persist_path 时写入 SQLite 文件，重启后自动恢复；
+- MemoizedChatModel 包装任意 LangChain 聊天模型：命中时直接返回（流式调用一次性产出整段回答），
+  未命中时调用原模型，完整生成后写入缓存；生成中途出错的回答不会写入。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from pydantic import ConfigDict
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+def _content_text(content) -> str:
+    return content if isinstance(content, str) else json.dumps(content, ensure_ascii=False, sort_keys=True)
+
+def messages_key(messages, params: dict) -> str:
+    """最终消息列表 + 模型参数的 SHA-256。"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(params, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+    for message in messages:
+        digest.update(b"\x00" + message.type.encode("utf-8") + b"\x00")
+        digest.update(_content_text(message.content).encode("utf-8"))
+    return digest.hexdigest()
+
+class ResponseMemo:
+    """按 prompt 哈希保存完整回答的 LRU + TTL 缓存，可选 SQLite 持久化。"""
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 24 * 3600, persist_path: str = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+
+        self._lock = threading.Lock()
+        # key: prompt 哈希, value: (answer, created_at)
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._saved_chars = 0
+
+        self._db = None
+        if persist_path:
+            self._open_db()
+            # SQLite 连接不能跨 fork 使用：pre-fork 部署时 worker 进程重新打开连接（内存中的条目保留）
+            if hasattr(os, "register_at_fork"):
+                ref = weakref.ref(self)
+                os.register_at_fork(after_in_child=lambda: ref() is not None and ref()._reconnect())
+
+    # --- 持久化 ---
+
+    def _open_db(self):
+        directory = os.path.dirname(self.persist_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.persist_path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, answer TEXT, created_at REAL)")
+        self._db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        self._db.commit()
+        rows = self._db.execute("SELECT key, answer, created_at FROM responses ORDER BY created_at").fetchall()
+        for key, answer, created_at in rows:
+            self._entries[key] = (answer, created_at)
+        while len(self._entries) > self.max_entries:
+            self._evict_oldest()
+        if rows:
+            print(f"已从 {self.persist_path} 恢复 {len(self._entries)} 条 LLM 回答。")
+
+    def _reconnect(self):
+        self._db = sqlite3.connect(self.persist_path, check_same_thread=False)
+
+    def _db_delete(self, key):
+        if self._db is not None:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+
+    # --- 查询与写入 ---
+
+    def get(self, key: str):
+        """返回缓存的回答，未命中或已过期时返回 None。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] > self.ttl_seconds:
+                del self._entries[key]
+                self._db_delete(key)
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            self._saved_chars += len(entry[0])
+            return entry[0]
+
+    def put(self, key: str, answer: str):
+        if not answer:
+            return
+        now = time.time()
+        with self._lock:
+            self._entries[key] = (answer, now)
+            self._entries.move_to_end(key)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses (key, answer, created_at) VALUES (?, ?, ?)",
+                                 (key, answer, now))
+                self._db.commit()
+            while len(self._entries) > self.max_entries:
+                self._evict_oldest()
+
+    def _evict_oldest(self):
+        key, _ = self._entries.popitem(last=False)
+        self._evictions += 1
+        self._db_delete(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / total, 4) if total else 0.0,
+                "evictions": self._evictions,
+                "saved_chars": self._saved_chars,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+class MemoizedChatModel(BaseChatModel):
+    """在聊天模型外加一层精确匹配缓存；缓存键包含原模型的 _identifying_params 以及 stop 和调用参数。"""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    llm: BaseChatModel
+    memo: ResponseMemo
+
+    @property
+    def _llm_type(self) -> str:
+        return f"memoized-{self.llm._llm_type}"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return self.llm._identifying_params
+
+    def _key(self, messages, stop, kwargs) -> str:
+        return messages_key(messages, {"llm": self.llm._identifying_params, "stop": stop, "kwargs": kwargs})
+
+    def _cached_chunk(self, answer: str) -> ChatGenerationChunk:
+        return ChatGenerationChunk(message=AIMessageChunk(content=answer, response_metadata={"memoized": True}))
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        key = self._key(messages, stop, kwargs)
+        answer = self.memo.get(key)
+        if answer is not None:
+            chunk = self._cached_chunk(answer)
+            if run_manager:
+                run_manager.on_llm_new_token(answer, chunk=chunk)
+            yield chunk
+            return
+        parts = []
+        for message in self.llm.stream(messages, stop=stop, **kwargs):
+            chunk = ChatGenerationChunk(message=message)
+            parts.append(chunk.text)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+        self.memo.put(key, "".join(parts))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        key = self._key(messages, stop, kwargs)
+        answer = self.memo.get(key)
+        if answer is not None:
+            chunk = self._cached_chunk(answer)
+            if run_manager:
+                await run_manager.on_llm_new_token(answer, chunk=chunk)
+            yield chunk
+            return
+        parts = []
+        async for message in self.llm.astream(messages, stop=stop, **kwargs):
+            chunk = ChatGenerationChunk(message=message)
+            parts.append(chunk.text)
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+        self.memo.put(key, "".join(parts))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        key = self._key(messages, stop, kwargs)
+        answer = self.memo.get(key)
+        if answer is None:
+            answer = self.llm.invoke(messages, stop=stop, **kwargs).content
+            self.memo.put(key, answer)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=answer))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        key = self._key(messages, stop, kwargs)
+        answer = self.memo.get(key)
+        if answer is None:
+            answer = (await self.llm.ainvoke(messages, stop=stop, **kwargs)).content
+            self.memo.put(key, answer)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=answer))])
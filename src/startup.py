@@ -0,0 +1,194 @@
+"""
+启动耗时分析与预热。
+
+- StartupProfile：按阶段记录启动耗时（解释器启动、导入依赖、LLM 客户端、Embedding 模型、向量数据库、编译链……），
+  就绪时打印耗时分解，/stats 中也可以看到；
+- warm_up：加载 Embedding 模型、向量数据库和倒排索引并编译链，可以在启动时同步执行，
+  也可以用 start_background_warm_up 放到后台线程，HTTP 服务先开始接收请求；
+  预热完成前到达的请求在获取共享资源时等待，不会重复加载；
+- 启动方式由 RAG_WARMUP_MODE 决定：
+    sync        导入时同步加载，加载完成后才开始服务（默认）；
+    background  先开始服务，后台加载；
+    prefork     由 gunicorn --preload 在 master 进程中同步加载，worker 进程 fork 后以写时复制方式共享
+                模型和索引（见 src/gunicorn_conf.py）。master 中不做推理，避免 fork 后 OpenMP 线程池失效。
+
+分析导入耗时（在新的子进程中用 -X importtime 导入模块，按顶层包汇总）：
+    python src/startup.py --module src.wechat_app
+"""
+import os
+import sys
+# 将项目根目录添加到 sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+WARMUP_MODES = ("sync", "background", "prefork")
+WARMUP_MODE = os.getenv("RAG_WARMUP_MODE", "sync")
+if WARMUP_MODE not in WARMUP_MODES:
+    print(f"未知的 RAG_WARMUP_MODE={WARMUP_MODE}，使用 sync。")
+    WARMUP_MODE = "sync"
+
+def _process_age() -> float:
+    """当前进程已运行的秒数（Linux 下读取 /proc），无法获取时返回 None。"""
+    try:
+        with open("/proc/self/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except (OSError, IndexError, ValueError):
+        return None
+
+class StartupProfile:
+    """按阶段记录启动耗时；checkpoint 记录两次调用之间的耗时，phase 记录 with 块的耗时。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._last = self._origin
+        self.phases = []
+        interpreter = _process_age()
+        if interpreter is not None:
+            self.phases.append(("解释器启动与早期导入", interpreter, "main"))
+        self.ready = threading.Event()
+        self.ready_seconds = None
+        self.error = None
+
+    def _add(self, name: str, seconds: float):
+        thread = "main" if threading.current_thread() is threading.main_thread() else "background"
+        with self._lock:
+            self.phases.append((name, seconds, thread))
+
+    def checkpoint(self, name: str):
+        now = time.perf_counter()
+        with self._lock:
+            seconds, self._last = now - self._last, now
+        self._add(name, seconds)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(name, time.perf_counter() - start)
+            with self._lock:
+                self._last = time.perf_counter()
+
+    def mark_ready(self, report: bool = True):
+        self.ready_seconds = time.perf_counter() - self._origin
+        self.ready.set()
+        if report:
+            print(self.report())
+
+    def report(self) -> str:
+        with self._lock:
+            phases = list(self.phases)
+        total = sum(seconds for _, seconds, _ in phases) or 1e-9
+        lines = ["===== 启动耗时分解 =====", f"{'阶段':<20}{'耗时(s)':>10}{'占比':>8}  线程"]
+        for name, seconds, thread in phases:
+            lines.append(f"{name:<20}{seconds:>10.2f}{seconds / total:>8.0%}  {thread}")
+        if self.ready_seconds is not None:
+            lines.append(f"从导入 startup 模块到就绪共 {self.ready_seconds:.2f}s")
+        return "\n".join(lines)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            phases = {name: round(seconds, 3) for name, seconds, _ in self.phases}
+        return {
+            "mode": WARMUP_MODE,
+            "ready": self.ready.is_set(),
+            "ready_seconds": round(self.ready_seconds, 3) if self.ready_seconds is not None else None,
+            "error": self.error,
+            "phases": phases,
+        }
+
+startup_profile = StartupProfile()
+
+def warm_up(llm, prompt_templates=(), probe: bool = True, profile: StartupProfile = startup_profile):
+    """
+    加载 Embedding 模型、向量数据库和倒排索引，并为每个 prompt 模板编译 RAG 链。
+    prompt_templates 的元素可以是模板字符串（使用 qa 检索配置），也可以是 (模板, 检索配置) 二元组。
+    其他已登记的索引默认在首次检索时才加载；prefork 模式下在 master 中一并加载，worker 以写时复制方式共享。
+    probe=True 时再计算一次问题向量，让模型完成首次前向计算的初始化（prefork 的 master 中应关闭）。
+    """
+    from src import rag_chain
+
+    with profile.phase("Embedding 模型"):
+        embeddings = rag_chain.get_embeddings()
+    with profile.phase("向量数据库"):
+        rag_chain.get_vector_store()
+        if WARMUP_MODE == "prefork":
+            registry = rag_chain.get_index_registry()
+            for name in registry.names():
+                try:
+                    registry.get(name)
+                except Exception as e:
+                    print(f"预加载索引 [{name}] 失败，检索时将跳过: {e}")
+    with profile.phase("倒排索引"):
+        rag_chain.get_lexical_index()
+    with profile.phase("编译 RAG 链"):
+        for template in prompt_templates:
+            template, retrieval_profile = template if isinstance(template, tuple) else (template, "qa")
+            if not rag_chain.create_rag_chain(llm, prompt_template=template, profile=retrieval_profile):
+                raise RuntimeError("无法创建 RAG 链，请检查向量数据库。")
+    if probe:
+        with profile.phase("首次问题向量"):
+            embeddings.embed_query("预热")
+
+def start_background_warm_up(llm, prompt_templates=(), profile: StartupProfile = startup_profile,
+                             report: bool = True):
+    """在后台线程中执行 warm_up，完成后标记就绪；失败时记录错误（请求处理时会再次尝试加载）。"""
+    def run():
+        try:
+            warm_up(llm, prompt_templates, profile=profile)
+        except Exception as e:
+            profile.error = str(e)
+            print(f"后台预热失败: {e}")
+            return
+        profile.mark_ready(report)
+
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+# --- 导入耗时分析 ---
+
+def import_time_report(module: str, top: int = 15):
+    """在新的子进程中导入 module，按顶层包汇总 -X importtime 的自身耗时。"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=root, capture_output=True, text=True,
+        env=dict(os.environ, RAG_WARMUP_MODE="background"),
+    )
+    wall = time.perf_counter() - start
+    by_package = defaultdict(int)
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        try:
+            self_us = int(line.split("|")[0].split(":")[1])
+        except ValueError:
+            continue
+        by_package[line.split("|")[2].strip().split(".")[0]] += self_us
+    total = sum(by_package.values()) or 1
+    print(f"导入 {module} 用时 {wall:.2f}s（子进程墙钟时间，含解释器启动）")
+    print(f"{'顶层包':<28}{'耗时(ms)':>10}{'占比':>8}")
+    for package, us in sorted(by_package.items(), key=lambda kv: kv[1], reverse=True)[:top]:
+        print(f"{package:<28}{us / 1000:>10.1f}{us / total:>8.0%}")
+    if result.returncode != 0:
+        print(f"导入失败（返回码 {result.returncode}）：\n{result.stderr.splitlines()[-1] if result.stderr else ''}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="分析模块导入耗时")
+    parser.add_argument("--module", default="src.wechat_app")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+    import_time_report(args.module, args.top)
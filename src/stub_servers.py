@@ -0,0 +1,175 @@
+"""
+本地桩服务，用于在没有网络和 API Key 的情况下做压测和基准测试：
+- StubLLMServer: OpenAI 兼容的 /v1/chat/completions 接口（支持 stream），延迟可配置
+- StubCustomerServiceServer: 客服消息接口 /send_custom_message，记录收到的每条消息
+
+单独运行时会同时启动两个服务：
+    python src/stub_servers.py --llm-port 18001 --cs-port 18002 --first-token-delay 1.0
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+DEFAULT_ANSWER = (
+    "黑暗森林法则是《三体》中的宇宙社会学核心理论。宇宙就是一座黑暗森林，每个文明都是带枪的猎人。"
+    "一旦暴露自己的位置，就会被其他文明消灭。因此最好的生存策略是隐藏自己，并在发现其他文明时先下手为强。"
+)
+
+async def start_site(app: web.Application, host: str, port: int) -> web.AppRunner:
+    """在当前事件循环中启动一个 aiohttp 应用，返回 runner 以便之后 cleanup。"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+class StubLLMServer:
+    """
+    OpenAI 兼容的聊天补全桩服务。
+    first_token_delay 模拟首字延迟，token_delay 模拟逐字生成速度，回答内容固定，便于结果可复现。
+    slow_rate 比例的请求额外等待 slow_delay 秒，模拟长尾延迟；failure_rate 比例的请求返回 500。
+    """
+
+    def __init__(self, answer: str = DEFAULT_ANSWER, first_token_delay: float = 0.5,
+                 token_delay: float = 0.01, chunk_chars: int = 4, failure_rate: float = 0.0,
+                 slow_rate: float = 0.0, slow_delay: float = 0.0, model: str = "stub-chat"):
+        self.answer = answer
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.chunk_chars = chunk_chars
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.model = model
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.disconnected = 0
+
+        self.app = web.Application()
+        self.app.router.add_post("/v1/chat/completions", self.handle)
+        self.app.router.add_post("/chat/completions", self.handle)
+
+    async def handle(self, request: web.Request):
+        body = await request.json()
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.first_token_delay)
+            if self.slow_rate and random.random() < self.slow_rate:
+                await asyncio.sleep(self.slow_delay)
+            if self.failure_rate and random.random() < self.failure_rate:
+                return web.json_response({"error": {"message": "stub failure", "type": "server_error"}}, status=500)
+            if body.get("stream"):
+                return await self._stream(request)
+            # 非流式：一次性返回，生成耗时按字数折算
+            await asyncio.sleep(self.token_delay * len(self.answer) / self.chunk_chars)
+            return web.json_response({
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": self.model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": self.answer},
+                    "finish_reason": "stop",
+                }],
+                "usage": self._usage(body),
+            })
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(self, request: web.Request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+        pieces = [self.answer[i:i + self.chunk_chars] for i in range(0, len(self.answer), self.chunk_chars)]
+        try:
+            await response.prepare(request)
+            for i, piece in enumerate(pieces):
+                delta = {"content": piece}
+                if i == 0:
+                    delta["role"] = "assistant"
+                await response.write(self._sse(chunk_id, delta, None))
+                await asyncio.sleep(self.token_delay)
+            await response.write(self._sse(chunk_id, {}, "stop"))
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # 客户端提前断开（例如对冲请求落选后被取消）
+            self.disconnected += 1
+        return response
+
+    def _sse(self, chunk_id, delta, finish_reason) -> bytes:
+        payload = {
+            "id": chunk_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": self.model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+    def _usage(self, body) -> dict:
+        prompt_chars = sum(len(str(m.get("content", ""))) for m in body.get("messages", []))
+        return {
+            "prompt_tokens": prompt_chars,
+            "completion_tokens": len(self.answer),
+            "total_tokens": prompt_chars + len(self.answer),
+        }
+
+class StubCustomerServiceServer:
+    """客服消息接口桩服务，记录每条消息的接收时间，可模拟延迟和失败。"""
+
+    def __init__(self, delay: float = 0.0, failure_rate: float = 0.0):
+        self.delay = delay
+        self.failure_rate = failure_rate
+        # 每条记录: {"openid", "message_type", "content", "received_at"}
+        self.messages = []
+        self.failures = 0
+
+        self.app = web.Application()
+        self.app.router.add_post("/send_custom_message", self.handle)
+
+    async def handle(self, request: web.Request):
+        payload = json.loads(await request.read())
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.failures += 1
+            return web.json_response({"errcode": -1, "errmsg": "stub failure"}, status=503)
+        payload["received_at"] = time.time()
+        self.messages.append(payload)
+        return web.json_response({"errcode": 0, "errmsg": "ok"})
+
+    def users_served(self) -> set:
+        return {m["openid"] for m in self.messages}
+
+async def _serve_forever(args):
+    llm = StubLLMServer(first_token_delay=args.first_token_delay, token_delay=args.token_delay)
+    cs = StubCustomerServiceServer(delay=args.cs_delay, failure_rate=args.cs_failure_rate)
+    await start_site(llm.app, args.host, args.llm_port)
+    await start_site(cs.app, args.host, args.cs_port)
+    print(f"桩 LLM 服务: http://{args.host}:{args.llm_port}/v1")
+    print(f"桩客服消息服务: http://{args.host}:{args.cs_port}/send_custom_message")
+    while True:
+        await asyncio.sleep(10)
+        print(f"LLM 请求数 {llm.requests}（最大并发 {llm.max_in_flight}），客服消息 {len(cs.messages)} 条")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="启动本地桩 LLM 与客服消息服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--llm-port", type=int, default=18001)
+    parser.add_argument("--cs-port", type=int, default=18002)
+    parser.add_argument("--first-token-delay", type=float, default=0.5)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument("--cs-delay", type=float, default=0.0)
+    parser.add_argument("--cs-failure-rate", type=float, default=0.0)
+    try:
+        asyncio.run(_serve_forever(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,274 @@
+"""
+RAG 流水线的分阶段埋点：
+- span(stage)：记录一个阶段（embed / search / prompt / llm / delivery ……）的耗时，写入该阶段的直方图，
+  若当前有活动的请求追踪，同时追加到它的 span 列表；
+- trace(kind)：包住一次完整的后台处理，结束时记录请求耗时和成功/失败计数，
+  按 TRACE_SAMPLE_RATE 抽样（以及所有超过 TRACE_SLOW_MS 的慢请求）把完整的 span 列表写入 JSON 追踪日志；
+- render_metrics()：以 Prometheus 文本格式输出直方图、计数器和各组件 stats() 中的数值。
+
+当前请求的追踪保存在 contextvars 中：LangChain 在线程池中执行子步骤、asyncio.to_thread 都会复制上下文，
+所以在链内部任意位置调用 span() 都能找到所属的请求。每个 span 只有一次加锁的直方图更新，可以常开。
+"""
+import os
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# RAG_TRACING=0 时 span/trace 不做任何记录
+TRACING_ENABLED = os.getenv("RAG_TRACING", "1") == "1"
+# JSON 追踪日志：路径为空表示不写日志；抽样比例；超过该耗时（毫秒）的请求总是写入；单个文件的大小上限
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "runtime/traces.jsonl")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "10000"))
+TRACE_LOG_MAX_BYTES = int(os.getenv("TRACE_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# 直方图桶上限（秒），覆盖从毫秒级的检索到几十秒的 LLM 生成
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    """Prometheus 风格的累积直方图（按标签值分组）。"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # key: 标签值, value: [各桶计数..., +Inf 计数, 总和]
+        self._series = {}
+
+    def observe(self, label: str, seconds: float):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {label: list(series) for label, series in self._series.items()}
+
+class Trace:
+    """一次后台请求的追踪记录。"""
+
+    def __init__(self, kind: str, attrs: dict):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.kind = kind
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.spans = []
+        self.status = "ok"
+        self.error = None
+
+    def add_span(self, name: str, start: float, seconds: float, attrs: dict = None):
+        span = {"name": name, "offset_ms": round((start - self.start) * 1000, 2), "duration_ms": round(seconds * 1000, 2)}
+        if attrs:
+            span.update(attrs)
+        self.spans.append(span)
+
+    def to_dict(self, seconds: float) -> dict:
+        result = {
+            "trace_id": self.trace_id,
+            "kind": self.kind,
+            "started_at": round(self.started_at, 3),
+            "duration_ms": round(seconds * 1000, 2),
+            "status": self.status,
+            "spans": self.spans,
+        }
+        result.update(self.attrs)
+        if self.error:
+            result["error"] = self.error
+        return result
+
+class TraceLog:
+    """追加写入的 JSONL 追踪日志，超过大小上限时把旧文件改名为 .1。"""
+
+    def __init__(self, path: str, max_bytes: int = TRACE_LOG_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._file = None
+        self.written = 0
+
+    def write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            elif self.max_bytes and self._file.tell() > self.max_bytes:
+                self._file.close()
+                os.replace(self.path, self.path + ".1")
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+            self.written += 1
+
+_current_trace = ContextVar("rag_trace", default=None)
+_stage_histogram = Histogram()
+_request_histogram = Histogram()
+_counter_lock = threading.Lock()
+_request_counts = {}
+_trace_log = TraceLog(TRACE_LOG_PATH) if TRACE_LOG_PATH else None
+
+# trace() 的 kind 作为指标标签，只能取有限的几个值
+REQUEST_KINDS = ("text", "image")
+
+def request_kind(msg_type) -> str:
+    """把请求里的消息类型（用户可控）映射为 text / image / other，避免标签基数无限增长。"""
+    return msg_type if msg_type in REQUEST_KINDS else "other"
+
+def current_trace():
+    return _current_trace.get()
+
+def record_span(name: str, start: float, seconds: float, **attrs):
+    """记录一个已经结束的阶段：start 为 time.perf_counter() 起点，seconds 为耗时。"""
+    if not TRACING_ENABLED:
+        return
+    _stage_histogram.observe(name, seconds)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, start, seconds, attrs)
+
+@contextmanager
+def span(name: str, **attrs):
+    """记录 with 块的耗时，作为阶段 name。"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, start, time.perf_counter() - start, **attrs)
+
+def mark_error(error):
+    """把当前请求标记为失败（异常在业务代码中被捕获、转成友好回复时调用）。"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.status = "error"
+        trace.error = f"{type(error).__name__}: {error}"
+
+@contextmanager
+def trace(kind: str, **attrs):
+    """追踪一次完整的请求处理；attrs 会写入追踪日志（不要放入用户消息正文）。"""
+    if not TRACING_ENABLED:
+        yield None
+        return
+    current = Trace(kind, attrs)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        mark_error(e)
+        raise
+    finally:
+        _current_trace.reset(token)
+        seconds = time.perf_counter() - current.start
+        _request_histogram.observe(kind, seconds)
+        with _counter_lock:
+            key = (kind, current.status)
+            _request_counts[key] = _request_counts.get(key, 0) + 1
+        if _trace_log is not None and (random.random() < TRACE_SAMPLE_RATE or seconds * 1000 >= TRACE_SLOW_MS):
+            try:
+                _trace_log.write(current.to_dict(seconds))
+            except OSError as e:
+                print(f"写入追踪日志失败: {e}")
+
+class LLMSpanHandler(BaseCallbackHandler):
+    """LangChain 回调：把每次 LLM 调用记为 llm 阶段，首个 token 的到达时间记为 llm_first_token 阶段。"""
+
+    # 回调只做计时，直接在调用线程/事件循环中执行，保证能读到当前请求的追踪
+    run_inline = True
+
+    def __init__(self):
+        self._runs = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._runs[run_id] = [time.perf_counter(), False]
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._runs[run_id] = [time.perf_counter(), False]
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self._runs.get(run_id)
+        if run is not None and not run[1]:
+            run[1] = True
+            record_span("llm_first_token", run[0], time.perf_counter() - run[0])
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            record_span("llm", run[0], time.perf_counter() - run[0])
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is not None:
+            record_span("llm", run[0], time.perf_counter() - run[0], error=type(error).__name__)
+
+# --- Prometheus 文本格式 ---
+
+def _metric_name(*parts) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join(str(p) for p in parts if p))
+
+def _label_value(value) -> str:
+    """按 Prometheus 文本格式转义标签值中的反斜杠、双引号和换行。"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _render_histogram(lines, name: str, help_text: str, label: str, histogram: Histogram):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for value, series in sorted(histogram.snapshot().items()):
+        value = _label_value(value)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, series):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}')
+        cumulative += series[len(histogram.buckets)]
+        lines.append(f'{name}_bucket{{{label}="{value}",le="+Inf"}} {cumulative}')
+        lines.append(f'{name}_sum{{{label}="{value}"}} {series[-1]:.6f}')
+        lines.append(f'{name}_count{{{label}="{value}"}} {cumulative}')
+
+def _render_gauges(lines, prefix: str, stats: dict):
+    """把 stats 字典（可以多层嵌套）中的数值输出为 gauge，例如 llm.deepseek.errors -> rag_llm_deepseek_errors。"""
+    for key, value in sorted(stats.items()):
+        if not str(key).isascii():
+            # 中文键（例如启动阶段名）不适合作为指标名
+            continue
+        name = _metric_name(prefix, key)
+        if isinstance(value, dict):
+            _render_gauges(lines, name, value)
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+def render_metrics(stats: dict = None) -> str:
+    """生成 Prometheus 文本格式的指标；stats 为 /stats 接口返回的字典，其中的数值作为 gauge 输出。"""
+    lines = []
+    _render_histogram(lines, "rag_stage_duration_seconds", "Duration of each RAG pipeline stage.",
+                      "stage", _stage_histogram)
+    _render_histogram(lines, "rag_request_duration_seconds", "End-to-end background request duration.",
+                      "kind", _request_histogram)
+    lines.append("# HELP rag_requests_total Background requests by kind and status.")
+    lines.append("# TYPE rag_requests_total counter")
+    with _counter_lock:
+        counts = sorted(_request_counts.items())
+    for (kind, status), count in counts:
+        lines.append(f'rag_requests_total{{kind="{_label_value(kind)}",status="{_label_value(status)}"}} {count}')
+    if _trace_log is not None:
+        lines.append("# TYPE rag_traces_logged_total counter")
+        lines.append(f"rag_traces_logged_total {_trace_log.written}")
+    if stats:
+        _render_gauges(lines, "rag", stats)
+    return "\n".join(lines) + "\n"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
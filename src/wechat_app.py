@@ -1,131 +1,128 @@
 import sys
 import os
-import json
-import threading
-import requests
-from flask import Flask, request, Response
+from flask import Flask, request, Response, jsonify
 from dotenv import load_dotenv
 from langchain_core.runnables import RunnableConfig
 
 # --- 项目初始化 ---
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.startup import WARMUP_MODE, startup_profile, start_background_warm_up, warm_up
 from src.rag_chain import (
     create_rag_chain, 
     get_deepseek_llm, 
-    get_zhipu_llm, 
-    invoke_multimodal_chain
+    get_answer_cache,
+    get_multimodal_llm,
+    embedding_stats,
+    index_stats,
+    llm_stats,
+    rerank_stats,
+    prompt_stats,
+    TimedStream,
+    iter_sentence_batches
+)
+from src.worker_pool import BoundedWorkerPool, UserSerialDispatcher
+from src.delivery import CustomerServiceClient
+from src.multimodal_pipeline import ImagePipeline
+from src.tracing import PROMETHEUS_CONTENT_TYPE, mark_error, render_metrics, request_kind, span, trace
+from src.history import HISTORY_SUMMARY_ENABLED, history_stats, make_llm_summarizer, set_history_summarizer
+from src.wechat_modes import (
+    PROMPT_TEMPLATE,
+    IMAGE_DESCRIPTION_PROMPT,
+    can_coalesce,
+    image_analysis_prompt,
+    resolve_text_request
 )
 
 load_dotenv()
+startup_profile.checkpoint("导入依赖")
 
 # --- 全局变量和配置 ---
 app = Flask(__name__)
 # 客服消息接口的 URL，根据老师提供的 demo.py 进行修正
-CUSTOMER_SERVICE_API_URL = "http://1.95.125.201/send_custom_message"
-
-# 用于存储每个用户会话状态的全局字典
-# key: user_id, value: {"mode": "role_play", "prompt_template": "..."}
-user_session_states = {}
+CUSTOMER_SERVICE_API_URL = os.getenv("WECHAT_CUSTOMER_SERVICE_URL", "http://1.95.125.201/send_custom_message")
+# 投递失败的回复写入该 SQLite 发件箱并定期补发，设为空字符串则直接丢弃
+DELIVERY_OUTBOX_PATH = os.getenv("WECHAT_OUTBOX_PATH", "runtime/delivery_outbox.sqlite3")
+DELIVERY_MAX_RETRIES = int(os.getenv("WECHAT_DELIVERY_MAX_RETRIES", "3"))
+
+# 后台处理线程池：最大并发数和等待队列长度均可通过环境变量配置
+WORKER_POOL_MAX_WORKERS = int(os.getenv("WECHAT_POOL_MAX_WORKERS", "8"))
+WORKER_POOL_QUEUE_SIZE = int(os.getenv("WECHAT_POOL_QUEUE_SIZE", "64"))
+BUSY_REPLY = "当前咨询人数较多，请稍后再试。"
+# 同一用户在该窗口（毫秒）内连续发送的普通文本会合并为一次 RAG 调用，0 表示不合并
+COALESCE_WINDOW_MS = int(os.getenv("WECHAT_COALESCE_WINDOW_MS", "0"))
+# 单个用户允许积压的未处理消息数
+MAX_PENDING_PER_USER = int(os.getenv("WECHAT_MAX_PENDING_PER_USER", "10"))
+# 流式推送：长回答按句子边界分几次发送，第一段至少 WECHAT_STREAM_MIN_CHARS 个字符
+STREAMING_ENABLED = os.getenv("WECHAT_STREAMING", "1") == "1"
+STREAM_MIN_CHARS = int(os.getenv("WECHAT_STREAM_MIN_CHARS", "60"))
 
 # --- RAG 链预加载 ---
 print("正在初始化微信后端服务...")
 llm = get_deepseek_llm()
 if not llm:
     raise RuntimeError("DeepSeek LLM 初始化失败，请检查 API Key。")
-
-PROMPT_TEMPLATE = """
-你是一个关于科幻小说《三体》的知识问答助手。
-请根据下面提供的上下文和对话历史来连贯地回答问题。
-**你的回答需要简明扼要，概括核心信息，总长度不要超过200字。**
-如果你在上下文中找不到答案，就说你不知道。
-
-对话历史:
-{chat_history}
-
-上下文: 
-{context}
-
-问题: 
-{question}
-
-回答:
-"""
-rag_chain_with_history = create_rag_chain(llm, prompt_template=PROMPT_TEMPLATE)
-if not rag_chain_with_history:
-    raise RuntimeError("无法创建 RAG 链，请检查向量数据库。")
-
-print("微信后端服务已就绪，等待请求...")
+startup_profile.checkpoint("LLM 客户端")
+
+if HISTORY_SUMMARY_ENABLED:
+    set_history_summarizer(make_llm_summarizer(llm))
+
+# 加载 Embedding 模型和索引并编译默认链：background 模式下在后台线程中进行，服务先开始接收请求；
+# prefork 模式下在 gunicorn master 中加载，供 worker 进程共享，但不做首次推理
+if WARMUP_MODE == "background":
+    start_background_warm_up(llm, [PROMPT_TEMPLATE])
+else:
+    warm_up(llm, [PROMPT_TEMPLATE], probe=WARMUP_MODE != "prefork")
+
+# 图片消息流水线：多模态客户端在首次使用时创建一次，图片描述按内容哈希缓存
+image_pipeline = ImagePipeline(
+    lambda description, context, _question: image_analysis_prompt(description, context),
+    description_prompt=IMAGE_DESCRIPTION_PROMPT,
+    allow_local_files=False,
+)
 
 # --- 辅助函数 ---
 
 def send_custom_message(user_id: str, content: str, msg_type: str = "text"):
-    """调用客服消息 API 异步发送消息给用户。"""
-    payload = {
-        "openid": user_id,
-        "message_type": msg_type,
-        "content": content
-    }
-    try:
-        print(f"正在向用户 [{user_id}] 发送异步客服消息...")
-        # 根据老师的 demo.py 修正数据发送方式
-        res = requests.post(
-            CUSTOMER_SERVICE_API_URL,
-            data=json.dumps(payload, ensure_ascii=False).encode('utf-8'),
-            headers={"Content-Type": "application/json"},
-            timeout=10
-        )
-        res.raise_for_status() # 如果请求失败则抛出异常
-        print(f"异步消息发送成功: {res.json()}")
-    except requests.exceptions.RequestException as e:
-        print(f"错误：调用客服消息 API 失败: {e}")
+    """调用客服消息 API 异步发送消息给用户（复用连接池，失败重试，最终失败写入发件箱）。"""
+    print(f"正在向用户 [{user_id}] 发送异步客服消息...")
+    with span("delivery"):
+        ok = delivery_client.send(user_id, content, msg_type)
+    if ok:
+        print("异步消息发送成功。")
+
+def deliver_answer(user_id: str, chain, inputs: dict, config):
+    """调用 RAG 链并把回答发送给用户；开启流式时按句子边界分几次推送。"""
+    if not STREAMING_ENABLED:
+        send_custom_message(user_id, chain.invoke(inputs, config=config))
+        return
+
+    stream = TimedStream(chain, inputs, config=config)
+    pushes = 0
+    for segment in iter_sentence_batches(stream, min_chars=STREAM_MIN_CHARS):
+        send_custom_message(user_id, segment)
+        pushes += 1
+    print(f"用户 [{user_id}] 的回答分 {pushes} 次推送完成，{stream.summary()}")
 
 def process_request_in_background(user_id: str, content: str, msg_type: str):
-    """在后台线程中处理用户的请求并异步回复。"""
+    """在后台线程中处理用户的请求并异步回复（整个处理过程记为一次请求追踪）。"""
+    with trace(request_kind(msg_type), user_id=user_id, content_chars=len(content)):
+        _process_request(user_id, content, msg_type)
+
+def _process_request(user_id: str, content: str, msg_type: str):
     print(f"后台线程开始处理用户 [{user_id}] 的请求...")
     answer = ""
 
     if msg_type == "image":
-        print("检测到图片消息，正在执行复杂多模态分析流程...")
-        image_url = content
-        
-        # 1. 初始化多模态 LLM
-        multimodal_llm = get_zhipu_llm(is_multimodal=True)
-        if not multimodal_llm:
-            answer = "抱歉，多模态模型初始化失败，请检查ZhipuAI API Key。"
-            send_custom_message(user_id, answer)
+        print("检测到图片消息，正在执行多模态分析流水线...")
+        if get_multimodal_llm() is None:
+            send_custom_message(user_id, "抱歉，多模态模型初始化失败，请检查ZhipuAI API Key。")
             return
-
         try:
-            # 2. [步骤1/3] 图片描述阶段
-            print("[步骤 1/3] 正在识别和描述图片内容...")
-            desc_prompt = "你是一个专业的图像分析师。请详细、客观地描述这幅图像的内容，重点描述其主要物体、场景和风格。"
-            image_description = invoke_multimodal_chain(multimodal_llm, image_url, desc_prompt)
+            answer, image_description, _ = image_pipeline.run(content)
             print(f"图片描述: {image_description[:100]}...")
-
-            # 3. [步骤2/3] 文本检索阶段
-            print("[步骤 2/3] 正在基于图片描述检索相关知识...")
-            # 使用图片描述去文本知识库中检索
-            config = RunnableConfig(configurable={"session_id": f"session_image_{user_id}"})
-            retrieved_context = rag_chain_with_history.invoke({"question": image_description}, config=config)
-            print("相关知识检索完成。")
-
-            # 4. [步骤3/3] 最终回答生成阶段
-            print("[步骤 3/3] 正在结合图文信息生成最终回答...")
-            final_prompt = f"""
-            你是一个知识渊博的《三体》专家。请结合以下所有信息，对用户提供的图片进行全面分析和解读。
-
-            ---
-            分析任务：
-            - 原始图片内容描述: {image_description}
-            - 从《三体》知识库中检索到的相关背景知识: {retrieved_context}
-            ---
-
-            请根据以上所有信息，给出一个关于这张图片的、结合了《三体》知识的、全面而深刻的分析。
-            """
-            answer = invoke_multimodal_chain(multimodal_llm, image_url, final_prompt)
-
         except Exception as e:
-            print(f"后台处理复杂多模态链时出错: {e}")
+            print(f"后台处理多模态流水线时出错: {e}")
+            mark_error(e)
             answer = "抱歉，分析图片时遇到了内部错误。"
 
     else:  # 默认为 text
@@ -133,74 +130,71 @@ def process_request_in_background(user_id: str, content: str, msg_type: str):
         config = RunnableConfig(configurable={"session_id": user_id})
         
         try:
-            # --- 步骤1: 检查是否为模式切换命令 ---
-            is_command = False
-            if question.startswith("扮演：") or question.startswith("扮演:"):
-                is_command = True
-                char_name = question.split("：", 1)[-1].split(":", 1)[-1].strip()
-                print(f"切换到角色扮演模式，角色：{char_name}")
-                
-                ROLE_PLAY_TEMPLATE = f"""
-                你正在扮演科幻小说《三体》中的角色：【{char_name}】。
-                请严格以【{char_name}】的口吻、性格、知识和视角来回答问题。
-                在回答时，请自然地融入角色的特点，不要暴露你是一个AI模型。
-                
-
-                对话历史: {{chat_history}}
-                上下文: {{context}}
-                问题: {{question}}
-                【{char_name}】的回答:
-                """
-                user_session_states[user_id] = {"mode": "role_play", "prompt_template": ROLE_PLAY_TEMPLATE}
-                answer = f"模式已切换：我现在是【{char_name}】。你可以开始与我对话了。"
-
-            elif question.startswith("分析：") or question.startswith("分析:"):
-                # 分析模式是一次性的，不需要保存状态
-                is_command = True
-                decision_question = question.split("：", 1)[-1].split(":", 1)[-1].strip()
-                print(f"执行一次性决策模拟，问题：{decision_question}")
-
-                DECISION_TEMPLATE = """
-                你是一位冷静、客观的《三体》世界战略分析家。
-                请根据下面提供的背景资料，**简明扼要地**分析用户提出的决策问题。
-                你的分析需要**概括核心要点**，并给出一个**不超过200字**的总结性结论。
-
-                背景资料: {context}
-                决策问题: {question}
-                精简战略分析:
-                """
-                decision_rag_chain = create_rag_chain(llm, prompt_template=DECISION_TEMPLATE)
-                answer = decision_rag_chain.invoke({"question": decision_question}, config=config)
-
-            elif question in ["重置模式", "普通模式"]:
-                is_command = True
-                if user_id in user_session_states:
-                    del user_session_states[user_id]
-                answer = "模式已重置为普通问答模式。"
-
-            # --- 步骤2: 如果不是命令，则根据当前状态处理 ---
-            if not is_command:
-                current_state = user_session_states.get(user_id)
-                
-                if current_state and current_state["mode"] == "role_play":
-                    # 用户处于角色扮演模式
-                    print(f"用户 [{user_id}] 处于角色扮演模式，使用专用链...")
-                    prompt_template = current_state["prompt_template"]
-                    dynamic_chain = create_rag_chain(llm, prompt_template=prompt_template)
-                    answer = dynamic_chain.invoke({"question": question}, config=config)
-                else:
-                    # 默认使用普通问答模式
-                    print(f"用户 [{user_id}] 处于普通模式，使用默认链...")
-                    answer = rag_chain_with_history.invoke({"question": question}, config=config)
+            # --- 步骤1: 处理模式切换命令，确定使用哪个 prompt 模板 ---
+            reply, prompt_template, chain_question, profile = resolve_text_request(user_id, question)
+
+            # --- 步骤2: 如果不是切换命令，则用对应模板和检索配置的 RAG 链回答 ---
+            if reply is not None:
+                answer = reply
+            else:
+                # create_rag_chain 会按模板和检索配置复用已编译的链，不会重复加载模型和索引
+                chain = create_rag_chain(llm, prompt_template=prompt_template, profile=profile)
+                deliver_answer(user_id, chain, {"question": chain_question}, config)
 
         except Exception as e:
             print(f"后台处理 RAG 链时出错: {e}")
+            mark_error(e)
             answer = "抱歉，处理您的问题时遇到了内部错误。"
 
-    # 将最终答案通过客服消息接口发回
-    send_custom_message(user_id, answer)
+    # 将最终答案通过客服消息接口发回（RAG 回答已由 deliver_answer 推送）
+    if answer:
+        send_custom_message(user_id, answer)
     print(f"后台线程处理完成。")
 
+worker_pool = delivery_client = user_dispatcher = None
+# 已创建上述对象的进程号：fork 出的子进程继承了变量，但没有继承线程
+_runtime_pid = None
+
+def start_runtime():
+    """
+    创建本进程的后台线程池、按用户派发器和消息投递客户端；同一进程内重复调用不会再创建。
+    这些对象持有线程和连接，不能跨 fork 共享：pre-fork 部署时 master 进程不创建，
+    由 gunicorn 的 post_fork 钩子在每个 worker 进程中创建（见 src/gunicorn_conf.py）。
+    """
+    global worker_pool, delivery_client, user_dispatcher, _runtime_pid
+    if _runtime_pid == os.getpid():
+        return
+    _runtime_pid = os.getpid()
+    worker_pool = BoundedWorkerPool(
+        max_workers=WORKER_POOL_MAX_WORKERS,
+        max_queue_size=WORKER_POOL_QUEUE_SIZE,
+        name="wechat-worker"
+    )
+
+    delivery_client = CustomerServiceClient(
+        CUSTOMER_SERVICE_API_URL,
+        pool_size=WORKER_POOL_MAX_WORKERS,
+        max_retries=DELIVERY_MAX_RETRIES,
+        outbox_path=DELIVERY_OUTBOX_PATH or None,
+    )
+    delivery_client.start_outbox_worker()
+
+    # 同一用户的消息按顺序串行处理，不同用户之间并行
+    user_dispatcher = UserSerialDispatcher(
+        worker_pool,
+        process_request_in_background,
+        coalesce_window_ms=COALESCE_WINDOW_MS,
+        max_pending_per_user=MAX_PENDING_PER_USER,
+        can_merge=can_coalesce,
+    )
+
+if WARMUP_MODE != "prefork":
+    start_runtime()
+    startup_profile.checkpoint("线程池与投递客户端")
+if WARMUP_MODE != "background":
+    startup_profile.mark_ready()
+print("微信后端服务已就绪，等待请求...")
+
 # --- Flask API 路由 ---
 
 @app.route('/', methods=['POST'])
@@ -221,18 +215,52 @@ def wechat_agent_handler():
 
     print(f"\n收到来自用户 [{user_id}] 的 [{msg_type}] 消息，内容: {content[:50]}...")
 
-    # 启动后台线程处理耗时任务
-    thread = threading.Thread(
-        target=process_request_in_background,
-        args=(user_id, content, msg_type)
-    )
-    thread.start()
+    # 按用户串行提交到有界线程池处理耗时任务，队列已满时立即回复“繁忙”
+    if not user_dispatcher.submit(user_id, content, msg_type):
+        print("后台线程池或用户队列已满，拒绝本次请求。")
+        return Response(BUSY_REPLY, mimetype='text/plain')
 
     # 立即返回纯文本响应，满足 5 秒超时要求
     print("立即返回 '正在处理' 响应...")
     return Response("您的问题正在思考中，请稍候...", mimetype='text/plain')
 
+def collect_stats() -> dict:
+    """汇总后台线程池、按用户排队、语义答案缓存、会话历史、图片流水线和消息投递的统计信息。"""
+    answer_cache = get_answer_cache()
+    return {
+        "pool": worker_pool.stats(),
+        "users": user_dispatcher.stats(),
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+        "embeddings": embedding_stats(),
+        "indexes": index_stats(),
+        "rerank": rerank_stats(),
+        "llm": llm_stats(),
+        "history": history_stats(),
+        "prompt": prompt_stats(),
+        "image_pipeline": image_pipeline.stats(),
+        "delivery": delivery_client.stats(),
+        "startup": startup_profile.snapshot(),
+    }
+
+@app.route('/stats', methods=['GET'])
+def pool_stats_handler():
+    """以 JSON 返回各组件的统计信息。"""
+    return jsonify(collect_stats())
+
+@app.route('/ready', methods=['GET'])
+def ready_handler():
+    """模型和索引加载完成后返回 200，后台预热期间返回 503（供负载均衡/滚动发布的就绪检查使用）。"""
+    if startup_profile.ready.is_set():
+        return Response("ready", mimetype='text/plain')
+    return Response("warming up", status=503, mimetype='text/plain')
+
+@app.route('/metrics', methods=['GET'])
+def metrics_handler():
+    """以 Prometheus 文本格式返回各阶段耗时直方图、请求计数和各组件统计中的数值。"""
+    return Response(render_metrics(collect_stats()), content_type=PROMETHEUS_CONTENT_TYPE)
+
 if __name__ == '__main__':
     # 注意：Flask 的 debug 模式会启动两个进程，可能导致初始化代码运行两次。
     # 在生产环境中应使用 Gunicorn 等 WSGI 服务器。
-    app.run(host='0.0.0.0', port=8081, debug=False)
+    start_runtime()
+    app.run(host='0.0.0.0', port=int(os.getenv("WECHAT_PORT", "8081")), debug=False, threaded=True)
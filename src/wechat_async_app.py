@@ -0,0 +1,263 @@
+"""
+微信后端的 asyncio 版本：与 wechat_app.py 使用相同的表单接口和模式逻辑，
+但所有慢速 I/O（LLM 调用、客服消息推送）都在同一个事件循环中以协程方式进行，
+单进程即可同时挂起数千个慢速 LLM 调用，而不需要数千个系统线程。
+
+启动方式：
+    python src/wechat_async_app.py
+"""
+import sys
+import os
+import asyncio
+import contextlib
+from aiohttp import web
+from dotenv import load_dotenv
+from langchain_core.runnables import RunnableConfig
+
+# --- 项目初始化 ---
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.startup import WARMUP_MODE, startup_profile, start_background_warm_up, warm_up
+from src.rag_chain import (
+    create_rag_chain,
+    get_deepseek_llm,
+    get_answer_cache,
+    get_multimodal_llm,
+    embedding_stats,
+    index_stats,
+    llm_stats,
+    rerank_stats,
+    prompt_stats,
+    TimedStream,
+    aiter_sentence_batches
+)
+from src.delivery import AsyncCustomerServiceClient
+from src.multimodal_pipeline import ImagePipeline
+from src.tracing import PROMETHEUS_CONTENT_TYPE, mark_error, render_metrics, request_kind, span, trace
+from src.history import HISTORY_SUMMARY_ENABLED, history_stats, make_llm_summarizer, set_history_summarizer
+from src.wechat_modes import (
+    PROMPT_TEMPLATE,
+    IMAGE_DESCRIPTION_PROMPT,
+    image_analysis_prompt,
+    resolve_text_request
+)
+
+load_dotenv()
+
+# --- 全局配置 ---
+CUSTOMER_SERVICE_API_URL = os.getenv("WECHAT_CUSTOMER_SERVICE_URL", "http://1.95.125.201/send_custom_message")
+# 同时处理中的请求上限，超过后立即回复“繁忙”
+MAX_INFLIGHT = int(os.getenv("WECHAT_ASYNC_MAX_INFLIGHT", "2000"))
+# 客服消息接口的连接池大小
+HTTP_POOL_SIZE = int(os.getenv("WECHAT_HTTP_POOL_SIZE", "100"))
+DELIVERY_OUTBOX_PATH = os.getenv("WECHAT_OUTBOX_PATH", "runtime/delivery_outbox.sqlite3")
+DELIVERY_MAX_RETRIES = int(os.getenv("WECHAT_DELIVERY_MAX_RETRIES", "3"))
+STREAMING_ENABLED = os.getenv("WECHAT_STREAMING", "1") == "1"
+STREAM_MIN_CHARS = int(os.getenv("WECHAT_STREAM_MIN_CHARS", "60"))
+PROCESSING_REPLY = "您的问题正在思考中，请稍候..."
+BUSY_REPLY = "当前咨询人数较多，请稍后再试。"
+
+class AsyncWeChatService:
+    """持有 LLM、共享的 HTTP 连接池以及并发/按用户顺序控制状态。"""
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.image_pipeline = ImagePipeline(
+            lambda description, context, _question: image_analysis_prompt(description, context),
+            description_prompt=IMAGE_DESCRIPTION_PROMPT,
+            allow_local_files=False,
+        )
+        self.delivery = AsyncCustomerServiceClient(
+            CUSTOMER_SERVICE_API_URL,
+            pool_size=HTTP_POOL_SIZE,
+            max_retries=DELIVERY_MAX_RETRIES,
+            outbox_path=DELIVERY_OUTBOX_PATH or None,
+        )
+        self.inflight = 0
+        self.max_inflight_seen = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.completed = 0
+        # key: user_id, value: [asyncio.Lock, 等待中的任务数]，保证同一用户的消息按顺序处理
+        self._user_locks = {}
+        # 持有后台任务的引用，防止被垃圾回收
+        self._tasks = set()
+
+    async def start(self, app):
+        await self.delivery.start()
+
+    async def close(self, app):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.delivery.close()
+
+    # --- 辅助函数 ---
+
+    async def send_custom_message(self, user_id: str, content: str, msg_type: str = "text"):
+        """通过共享连接池调用客服消息 API（失败重试，最终失败写入发件箱）。"""
+        with span("delivery"):
+            await self.delivery.send(user_id, content, msg_type)
+
+    async def deliver_answer(self, user_id: str, chain, inputs: dict, config):
+        """调用 RAG 链并把回答发送给用户；开启流式时按句子边界分几次推送。"""
+        if not STREAMING_ENABLED:
+            await self.send_custom_message(user_id, await chain.ainvoke(inputs, config=config))
+            return
+
+        stream = TimedStream(chain, inputs, config=config)
+        pushes = 0
+        async for segment in aiter_sentence_batches(stream, min_chars=STREAM_MIN_CHARS):
+            await self.send_custom_message(user_id, segment)
+            pushes += 1
+        print(f"用户 [{user_id}] 的回答分 {pushes} 次推送完成，{stream.summary()}")
+
+    @contextlib.asynccontextmanager
+    async def user_lock(self, user_id: str):
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user_id]
+
+    async def process_request(self, user_id: str, content: str, msg_type: str):
+        """处理用户请求并通过客服消息接口异步回复（同一用户的请求依次执行）。"""
+        try:
+            async with self.user_lock(user_id):
+                # 等待同一用户前一条消息的时间不计入追踪
+                with trace(request_kind(msg_type), user_id=user_id, content_chars=len(content)):
+                    answer = await self._answer(user_id, content, msg_type)
+                    if answer:
+                        await self.send_custom_message(user_id, answer)
+        finally:
+            self.inflight -= 1
+            self.completed += 1
+
+    async def _answer(self, user_id: str, content: str, msg_type: str):
+        if msg_type == "image":
+            return await self._answer_image(user_id, content)
+
+        config = RunnableConfig(configurable={"session_id": user_id})
+        try:
+            reply, prompt_template, chain_question, profile = resolve_text_request(user_id, content)
+            if reply is not None:
+                return reply
+            chain = create_rag_chain(self.llm, prompt_template=prompt_template, profile=profile)
+            await self.deliver_answer(user_id, chain, {"question": chain_question}, config)
+            return None
+        except Exception as e:
+            print(f"后台处理 RAG 链时出错: {e}")
+            mark_error(e)
+            return "抱歉，处理您的问题时遇到了内部错误。"
+
+    async def _answer_image(self, user_id: str, image_url: str):
+        if get_multimodal_llm() is None:
+            return "抱歉，多模态模型初始化失败，请检查ZhipuAI API Key。"
+        try:
+            answer, _, _ = await self.image_pipeline.arun(image_url)
+            return answer
+        except Exception as e:
+            print(f"后台处理多模态流水线时出错: {e}")
+            mark_error(e)
+            return "抱歉，分析图片时遇到了内部错误。"
+
+    # --- HTTP 路由 ---
+
+    async def handle(self, request: web.Request):
+        """
+        处理来自平台服务器的 POST 请求。
+        与 wechat_app.py 相同：只接受 application/x-www-form-urlencoded，并立即返回纯文本。
+        """
+        if request.content_type != 'application/x-www-form-urlencoded':
+            return web.Response(text="Error: Content-Type must be application/x-www-form-urlencoded", status=400)
+
+        form = await request.post()
+        try:
+            user_id = form['from_user']
+            content = form['content']
+            msg_type = form['type']
+        except KeyError:
+            return web.Response(text="Error: Missing required form parameters (from_user, content, type)", status=400)
+
+        if self.inflight >= MAX_INFLIGHT:
+            self.rejected += 1
+            return web.Response(text=BUSY_REPLY, content_type='text/plain')
+
+        self.inflight += 1
+        self.accepted += 1
+        self.max_inflight_seen = max(self.max_inflight_seen, self.inflight)
+        task = asyncio.create_task(self.process_request(user_id, content, msg_type))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        return web.Response(text=PROCESSING_REPLY, content_type='text/plain')
+
+    def collect_stats(self) -> dict:
+        answer_cache = get_answer_cache()
+        return {
+            "inflight": self.inflight,
+            "max_inflight_seen": self.max_inflight_seen,
+            "max_inflight": MAX_INFLIGHT,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "waiting_users": len(self._user_locks),
+            "answer_cache": answer_cache.stats() if answer_cache else None,
+            "embeddings": embedding_stats(),
+            "indexes": index_stats(),
+            "rerank": rerank_stats(),
+            "llm": llm_stats(),
+            "history": history_stats(),
+            "prompt": prompt_stats(),
+            "image_pipeline": self.image_pipeline.stats(),
+            "delivery": self.delivery.stats(),
+            "startup": startup_profile.snapshot(),
+        }
+
+    async def stats(self, request: web.Request):
+        return web.json_response(self.collect_stats())
+
+    async def metrics(self, request: web.Request):
+        """Prometheus 文本格式的指标（各阶段耗时直方图、请求计数和各组件统计中的数值）。"""
+        return web.Response(body=render_metrics(self.collect_stats()).encode("utf-8"),
+                            headers={"Content-Type": PROMETHEUS_CONTENT_TYPE})
+
+async def ready(request: web.Request):
+    """模型和索引加载完成后返回 200，后台预热期间返回 503。"""
+    if startup_profile.ready.is_set():
+        return web.Response(text="ready", content_type='text/plain')
+    return web.Response(text="warming up", status=503, content_type='text/plain')
+
+def create_app() -> web.Application:
+    """加载 LLM 和 RAG 链，创建 aiohttp 应用。"""
+    print("正在初始化微信异步后端服务...")
+    llm = get_deepseek_llm()
+    if not llm:
+        raise RuntimeError("DeepSeek LLM 初始化失败，请检查 API Key。")
+    startup_profile.checkpoint("导入依赖与 LLM 客户端")
+    if HISTORY_SUMMARY_ENABLED:
+        set_history_summarizer(make_llm_summarizer(llm))
+    # background 模式下事件循环先开始接收请求，模型和索引在后台线程中加载
+    if WARMUP_MODE == "background":
+        start_background_warm_up(llm, [PROMPT_TEMPLATE])
+    else:
+        warm_up(llm, [PROMPT_TEMPLATE])
+        startup_profile.mark_ready()
+
+    service = AsyncWeChatService(llm)
+    app = web.Application()
+    app.on_startup.append(service.start)
+    app.on_cleanup.append(service.close)
+    app.router.add_post('/', service.handle)
+    app.router.add_get('/stats', service.stats)
+    app.router.add_get('/ready', ready)
+    app.router.add_get('/metrics', service.metrics)
+    print("微信异步后端服务已就绪，等待请求...")
+    return app
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.getenv("WECHAT_PORT", "8081")))
@@ -0,0 +1,119 @@
+"""
+微信后端的对话模式：prompt 模板、模式切换命令解析和每个用户的模式状态。
+同步（Flask）和 asyncio 两个服务入口共用这里的逻辑，保证行为一致。
+模板中占位符的位置不影响消息顺序：固定指令总在最前面，见 src/prompt_assembly.py。
+"""
+from functools import lru_cache
+
+PROMPT_TEMPLATE = """
+你是一个关于科幻小说《三体》的知识问答助手。
+请根据下面提供的上下文和对话历史来连贯地回答问题。
+**你的回答需要简明扼要，概括核心信息，总长度不要超过200字。**
+如果你在上下文中找不到答案，就说你不知道。
+
+对话历史:
+{chat_history}
+
+上下文:
+{context}
+
+问题:
+{question}
+
+回答:
+"""
+
+DECISION_TEMPLATE = """
+你是一位冷静、客观的《三体》世界战略分析家。
+请根据下面提供的背景资料，**简明扼要地**分析用户提出的决策问题。
+你的分析需要**概括核心要点**，并给出一个**不超过200字**的总结性结论。
+
+背景资料: {context}
+决策问题: {question}
+精简战略分析:
+"""
+
+IMAGE_DESCRIPTION_PROMPT = "你是一个专业的图像分析师。请详细、客观地描述这幅图像的内容，重点描述其主要物体、场景和风格。"
+
+RESET_COMMANDS = ["重置模式", "普通模式"]
+
+# 用于存储每个用户会话状态的全局字典
+# key: user_id, value: {"mode": "role_play", "prompt_template": "...", "profile": "role_play:<角色>"}
+user_session_states = {}
+
+@lru_cache(maxsize=128)
+def role_play_template(char_name: str) -> str:
+    """生成指定角色的角色扮演 prompt 模板（同一角色总是返回同一个字符串，prompt 前缀和链缓存保持稳定）。"""
+    return f"""
+你正在扮演科幻小说《三体》中的角色：【{char_name}】。
+请严格以【{char_name}】的口吻、性格、知识和视角来回答问题。
+在回答时，请自然地融入角色的特点，不要暴露你是一个AI模型。
+
+对话历史: {{chat_history}}
+上下文: {{context}}
+问题: {{question}}
+【{char_name}】的回答:
+"""
+
+def image_analysis_prompt(image_description: str, retrieved_context: str) -> str:
+    """生成结合图片描述和知识库内容的最终分析 prompt。"""
+    # 固定的任务说明在前，图片描述和检索结果在后，不同图片的请求共享相同的 prompt 前缀
+    return f"""
+你是一个知识渊博的《三体》专家。请结合以下所有信息，对用户提供的图片进行全面分析和解读，
+给出一个关于这张图片的、结合了《三体》知识的、全面而深刻的分析。
+
+---
+分析任务：
+- 原始图片内容描述: {image_description}
+- 从《三体》知识库中检索到的相关背景知识: {retrieved_context}
+---
+"""
+
+def _command_argument(question: str) -> str:
+    return question.split("：", 1)[-1].split(":", 1)[-1].strip()
+
+def is_mode_command(content: str) -> bool:
+    """判断一条文本消息是否为模式切换或一次性分析命令。"""
+    return (
+        content.startswith(("扮演：", "扮演:", "分析：", "分析:"))
+        or content in RESET_COMMANDS
+    )
+
+def can_coalesce(content: str, msg_type: str) -> bool:
+    """只有普通文本提问可以合并，图片和命令必须单独按顺序处理。"""
+    return msg_type == "text" and not is_mode_command(content)
+
+def resolve_text_request(user_id: str, question: str):
+    """
+    处理模式切换命令，并确定一条文本消息该如何回答。
+    返回 (reply, prompt_template, chain_question, profile)：
+    - reply 不为 None 时直接把它回复给用户；
+    - 否则用 prompt_template 和检索配置 profile（见 rag_chain.RETRIEVAL_PROFILES）对应的 RAG 链回答 chain_question。
+    """
+    if question.startswith(("扮演：", "扮演:")):
+        char_name = _command_argument(question)
+        print(f"切换到角色扮演模式，角色：{char_name}")
+        user_session_states[user_id] = {
+            "mode": "role_play", "prompt_template": role_play_template(char_name),
+            # 只检索提到该角色的文档块
+            "profile": f"role_play:{char_name}",
+        }
+        return f"模式已切换：我现在是【{char_name}】。你可以开始与我对话了。", None, None, None
+
+    if question.startswith(("分析：", "分析:")):
+        # 分析模式是一次性的，不需要保存状态
+        decision_question = _command_argument(question)
+        print(f"执行一次性决策模拟，问题：{decision_question}")
+        return None, DECISION_TEMPLATE, decision_question, "decision"
+
+    if question in RESET_COMMANDS:
+        user_session_states.pop(user_id, None)
+        return "模式已重置为普通问答模式。", None, None, None
+
+    current_state = user_session_states.get(user_id)
+    if current_state and current_state["mode"] == "role_play":
+        print(f"用户 [{user_id}] 处于角色扮演模式，使用专用链...")
+        return None, current_state["prompt_template"], question, current_state.get("profile", "role_play")
+
+    print(f"用户 [{user_id}] 处于普通模式，使用默认链...")
+    return None, PROMPT_TEMPLATE, question, "qa"
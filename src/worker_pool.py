@@ -0,0 +1,228 @@
+import queue
+import threading
+import time
+from collections import deque
+
+
+class BoundedWorkerPool:
+    """
+    固定线程数 + 有界等待队列的后台任务池。
+    队列已满时 submit 直接返回 False，由调用方决定如何降级（例如立即回复“繁忙”）。
+    """
+
+    # 用于计算等待时间分位数的最近样本数
+    _WAIT_SAMPLE_SIZE = 1000
+
+    def __init__(self, max_workers: int = 8, max_queue_size: int = 64, name: str = "worker"):
+        if max_workers < 1:
+            raise ValueError("max_workers 必须大于 0")
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.name = name
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._failed = 0
+        self._active = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._recent_waits = deque(maxlen=self._WAIT_SAMPLE_SIZE)
+
+        self._threads = []
+        for i in range(max_workers):
+            t = threading.Thread(target=self._worker_loop, name=f"{name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, fn, *args, **kwargs) -> bool:
+        """提交任务；成功入队返回 True，队列已满返回 False。"""
+        try:
+            self._queue.put_nowait((fn, args, kwargs, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+        with self._lock:
+            self._submitted += 1
+        return True
+
+    def _worker_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            fn, args, kwargs, enqueued_at = item
+            wait = time.monotonic() - enqueued_at
+            with self._lock:
+                self._active += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+                self._recent_waits.append(wait)
+            try:
+                fn(*args, **kwargs)
+                failed = False
+            except Exception as e:
+                print(f"后台任务执行出错 [{self.name}]: {e}")
+                failed = True
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    if failed:
+                        self._failed += 1
+                    else:
+                        self._completed += 1
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        """返回队列深度、等待时间和拒绝次数等统计信息，用于评估线程池容量。"""
+        with self._lock:
+            waits = sorted(self._recent_waits)
+            started = self._completed + self._failed + self._active
+            return {
+                "max_workers": self.max_workers,
+                "max_queue_size": self.max_queue_size,
+                "queue_depth": self._queue.qsize(),
+                "active": self._active,
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "completed": self._completed,
+                "failed": self._failed,
+                "wait_avg_ms": round(self._total_wait / started * 1000, 2) if started else 0.0,
+                "wait_p95_ms": round(_percentile(waits, 0.95) * 1000, 2),
+                "wait_max_ms": round(self._max_wait * 1000, 2),
+            }
+
+    def shutdown(self, wait: bool = True):
+        """等待已入队任务执行完毕后停止所有工作线程。"""
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+
+def _percentile(sorted_values, q: float) -> float:
+    """在已排序的列表上取分位数（最近秩法），空列表返回 0。"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+class UserSerialDispatcher:
+    """
+    在 BoundedWorkerPool 之上按用户串行处理消息：同一用户的消息严格按到达顺序依次处理，
+    不同用户之间仍然并行。
+    可选的合并窗口（毫秒）会把同一用户在窗口内连续到达、且 can_merge 判定为可合并的消息
+    拼接成一条，只触发一次处理。等待窗口结束用定时器实现，不占用线程池的工作线程；
+    只有到达时间在第一条消息的窗口内的消息才会被合并。
+    """
+
+    def __init__(self, pool: BoundedWorkerPool, handler, coalesce_window_ms: int = 0,
+                 max_pending_per_user: int = 20, can_merge=None, separator: str = "\n"):
+        self.pool = pool
+        self.handler = handler
+        self.coalesce_window = max(0, coalesce_window_ms) / 1000.0
+        self.max_pending_per_user = max_pending_per_user
+        self.can_merge = can_merge or (lambda content, msg_type: False)
+        self.separator = separator
+
+        self._lock = threading.Lock()
+        # key: user_id, value: 待处理消息队列 deque[(content, msg_type, arrived_at)]
+        # 用户出现在字典中即表示已有一个排空任务在线程池中排队、运行或等待合并窗口结束
+        self._pending = {}
+        self._dispatched = 0
+        self._coalesced = 0
+        self._rejected = 0
+
+    def submit(self, user_id: str, content: str, msg_type: str) -> bool:
+        """提交一条消息；用户积压过多或线程池已满时返回 False。"""
+        with self._lock:
+            pending = self._pending.get(user_id)
+            need_schedule = pending is None
+            if need_schedule:
+                pending = self._pending[user_id] = deque()
+            elif len(pending) >= self.max_pending_per_user:
+                self._rejected += 1
+                return False
+            pending.append((content, msg_type, time.monotonic()))
+
+            if need_schedule and self.coalesce_window:
+                # 合并窗口结束后再提交排空任务
+                self._schedule_later(user_id, self.coalesce_window)
+            # 在锁内提交，保证同一用户同一时刻最多只有一个排空任务
+            elif need_schedule and not self.pool.submit(self._drain, user_id):
+                del self._pending[user_id]
+                self._rejected += 1
+                return False
+        return True
+
+    def _schedule_later(self, user_id: str, delay: float):
+        timer = threading.Timer(delay, self._dispatch, args=(user_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _dispatch(self, user_id: str):
+        """合并窗口结束：把排空任务提交到线程池；线程池已满时稍后重试（消息仍保留在用户队列中）。"""
+        if not self.pool.submit(self._drain, user_id):
+            print(f"线程池已满，用户 [{user_id}] 的消息稍后重试。")
+            self._schedule_later(user_id, self.coalesce_window)
+
+    def _drain(self, user_id: str):
+        """依次处理某个用户积压的所有消息，直到队列为空。"""
+        while True:
+            batch = self._next_batch(user_id)
+            if batch is None:
+                return
+            if isinstance(batch, float):
+                # 下一条消息的合并窗口还没结束：释放工作线程，窗口结束后重新提交
+                self._schedule_later(user_id, batch)
+                return
+            content, msg_type = batch
+            try:
+                self.handler(user_id, content, msg_type)
+            except Exception as e:
+                print(f"处理用户 [{user_id}] 的消息时出错: {e}")
+
+    def _next_batch(self, user_id: str):
+        """
+        取出下一条（可能是合并后的）消息；队列为空时注销该用户并返回 None；
+        第一条消息的合并窗口还没结束时返回剩余的等待秒数。
+        """
+        with self._lock:
+            pending = self._pending[user_id]
+            if not pending:
+                del self._pending[user_id]
+                return None
+            if self.coalesce_window:
+                delay = pending[0][2] + self.coalesce_window - time.monotonic()
+                if delay > 0:
+                    return delay
+            content, msg_type, arrived_at = pending.popleft()
+            if self.coalesce_window and self.can_merge(content, msg_type):
+                # 只合并在第一条消息的窗口内到达的消息，上一次处理期间很晚才到的消息单独处理
+                deadline = arrived_at + self.coalesce_window
+                parts = [content]
+                while pending and pending[0][2] <= deadline and self.can_merge(pending[0][0], pending[0][1]):
+                    parts.append(pending.popleft()[0])
+                if len(parts) > 1:
+                    self._coalesced += len(parts) - 1
+                    content = self.separator.join(parts)
+            self._dispatched += 1
+            return content, msg_type
+
+    def stats(self) -> dict:
+        """返回按用户排队的统计信息。"""
+        with self._lock:
+            return {
+                "active_users": len(self._pending),
+                "pending_messages": sum(len(p) for p in self._pending.values()),
+                "dispatched": self._dispatched,
+                "coalesced": self._coalesced,
+                "rejected": self._rejected,
+                "coalesce_window_ms": int(self.coalesce_window * 1000),
+            }